@@ -0,0 +1,115 @@
+'''
+micro-benchmark for the per record count extraction in the somatic
+consensus. writes a synthetic two sample mutect vcf and times:
+ - PyVCF with a scan of record.samples (skipped if vcf is not installed)
+ - VcfReader with get_sample and the caller if/elif chain
+ - VcfReader with the compiled extractor from get_counts_extractor
+
+usage: python benchmark_count_extractors.py [num_records]
+'''
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from wgs.utils import vcfutils
+from wgs.workflows.somatic_calling_consensus import consensus
+
+HEADER = [
+    '##fileformat=VCFv4.2',
+    '##tumor_sample=TUMOUR',
+    '##normal_sample=NORMAL',
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+    '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">',
+    '##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele fraction">',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+    '##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+    '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', 'TUMOUR', 'NORMAL']),
+]
+
+
+def write_vcf(filename, num_records):
+    random.seed(0)
+    with open(filename, 'wt') as writer:
+        writer.write('\n'.join(HEADER) + '\n')
+        for i in range(num_records):
+            ref, alt = random.sample('ACGT', 2)
+            samples = []
+            for _ in range(2):
+                ref_count = random.randint(0, 60)
+                alt_count = random.randint(0, 60)
+                depth = ref_count + alt_count
+                af = alt_count / float(depth) if depth else 0
+                samples.append('0/1:{},{}:{:.3f}:{}'.format(ref_count, alt_count, af, depth))
+            writer.write('\t'.join(
+                ['1', str(i + 1), '.', ref, alt, '.', 'PASS', 'DP=100', 'GT:AD:AF:DP'] + samples
+            ) + '\n')
+
+
+def pyvcf_scan(filename):
+    import vcf
+
+    reader = vcf.Reader(filename=filename)
+    tumour = reader.metadata['tumor_sample'][0]
+    normal = reader.metadata['normal_sample'][0]
+
+    for record in reader:
+        for sample_id in (tumour, normal):
+            sample = [v for v in record.samples if v.sample == sample_id][0]
+            ad = sample['AD']
+            ad[0], ad[1:], sample['DP']
+
+
+def vcfreader_if_elif(filename, caller='mutect'):
+    reader = vcfutils.VcfReader(filename)
+    tumour = reader.get_sample_index(reader.metadata['tumor_sample'][0])
+    normal = reader.get_sample_index(reader.metadata['normal_sample'][0])
+
+    for record in reader:
+        for index in (tumour, normal):
+            sample = record.get_sample(index)
+            if caller == 'museq_snv':
+                sample['RC'], [sample['AC']], sample['DP']
+            elif caller == 'mutect':
+                sample['AD'][0], sample['AD'][1:], sample['DP']
+
+
+def vcfreader_extractor(filename):
+    reader = vcfutils.VcfReader(filename)
+    extract = consensus.get_reader_counts_extractor(reader, 'mutect')
+
+    for record in reader:
+        extract(record, record.REF, record.ALT)
+
+
+def main():
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'mutect.vcf')
+        write_vcf(filename, num_records)
+
+        benchmarks = [
+            ('PyVCF + record.samples scan', pyvcf_scan),
+            ('VcfReader + get_sample + if/elif', vcfreader_if_elif),
+            ('VcfReader + compiled extractor', vcfreader_extractor),
+        ]
+
+        for name, func in benchmarks:
+            start = time.time()
+            try:
+                func(filename)
+            except ImportError:
+                print('{:<36} skipped, PyVCF not installed'.format(name))
+                continue
+            elapsed = time.time() - start
+            print('{:<36} {:>8.0f} records/s'.format(name, num_records / elapsed))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -83,6 +83,12 @@ def parse_args():
         action='store_true',
         help='''ignore the exception from bamtofastq'''
     )
+    realignment.add_argument(
+        "--streaming",
+        default=False,
+        action='store_true',
+        help='''stream reads from the bam into bwa mem without writing fastqs'''
+    )
 
     # ================
     # variant calling
@@ -174,6 +180,13 @@ def parse_args():
         action='store_true',
         default=False
     )
+    sample_qc.add_argument(
+        '--coverage_mode',
+        choices=['exact', 'approximate'],
+        default='exact',
+        help='''approximate estimates coverage from the bam index
+        in seconds, at a few percent error per bin'''
+    )
 
     # ================
     # cohort qc
@@ -203,8 +216,31 @@ def parse_args():
                                  type=json.loads,
                                  help='''json string to override the defaults in config''')
 
+    # ======================================
+    # compiles annotation databases
+    # ======================================
+    build_annotation_index = subparsers.add_parser("build_annotation_index")
+    build_annotation_index.set_defaults(which='build_annotation_index')
+
+    build_annotation_index.add_argument("--database",
+                                        required=True,
+                                        help='''vcf database (dbsnp, cosmic, 1000 genomes)
+                                        or mutation assessor directory''')
+
+    build_annotation_index.add_argument("--database_type",
+                                        required=True,
+                                        choices=['vcf', 'mutation_assessor'],
+                                        help='''type of the database''')
+
+    build_annotation_index.add_argument("--output",
+                                        help='''index directory, defaults to the database path
+                                        with an .index suffix, where the annotators look for it''')
+
     args = vars(parser.parse_args())
 
+    if 'output_prefix' not in args:
+        return args
+
     if '/' not in args['output_prefix']:
         warnings.warn('output prefix is not a path, using {} as output directory'.format(args['output_prefix']))
         args['output_prefix'] += '/'
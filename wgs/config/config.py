@@ -14,6 +14,9 @@ def default_params(mode='all'):
         'parse_museq': {
             'pr_threshold': 0.85
         },
+        'vcf_annotation': {
+            'ncores': 8,
+        },
         'museq_params': {
             'threshold': 0.5,
             'verbose': True,
@@ -126,6 +129,8 @@ def default_params(mode='all'):
         'threads': 8,
         'aligner': 'bwa-mem',
         'split_size': 1e7,
+        'min_split_size': 1e6,
+        'cluster_slots': 64,
     }
 
     config = {
@@ -11,7 +11,7 @@ from wgs.workflows import realignment
 def realign_bams(
         input, output, metrics,
         metrics_tar, refdir, ignore_bamtofastq_exception,
-        single_node=False, picard_mem=8
+        single_node=False, picard_mem=8, streaming=False
 ):
 
     workflow = pypeliner.workflow.Workflow()
@@ -29,7 +29,8 @@ def realign_bams(
         kwargs={
             'single_node': single_node,
             'ignore_bamtofastq_exception': ignore_bamtofastq_exception,
-            'picard_mem': picard_mem
+            'picard_mem': picard_mem,
+            'streaming': streaming
         }
     )
 
@@ -66,7 +67,8 @@ def realign_bam_workflow(args):
         ),
         kwargs={
             'single_node': args['single_node'],
-            'picard_mem': args['picard_mem']
+            'picard_mem': args['picard_mem'],
+            'streaming': args['streaming']
         }
     )
 
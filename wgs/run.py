@@ -14,6 +14,7 @@ from wgs.germline_calling import germline_calling_workflow
 from wgs.realign import realign_bam_workflow
 from wgs.sample_qc import sample_qc_workflow
 from wgs.somatic_calling import somatic_calling_workflow
+from wgs.utils import annotationdb
 
 
 def generate_config(args):
@@ -32,6 +33,11 @@ def main():
     if args["which"] == "generate_config":
         generate_config(args)
 
+    if args["which"] == "build_annotation_index":
+        annotationdb.build_index(
+            args["database"], args["database_type"], output=args["output"]
+        )
+
     if args["which"] == "cohort_qc":
         args = generate_config(args)
         cohort_qc_workflow(args)
@@ -52,7 +52,8 @@ def sample_qc_workflow(args):
                 args['bins'],
                 args['mapping_qual_threshold']
             ),
-            kwargs={'sex': sex,}
+            kwargs={'sex': sex,
+                    'coverage_mode': args['coverage_mode'],}
         )
         outputted_filenames = [normal_coverage, genome_wide_plot]
     else:
@@ -79,7 +80,8 @@ def sample_qc_workflow(args):
                 args['mapping_qual_threshold']
             ),
             kwargs={'single_node': args['single_node'],
-                    'sex': sex,}
+                    'sex': sex,
+                    'coverage_mode': args['coverage_mode'],}
         )
         workflow.subworkflow(
             name='generate_circos_plot',
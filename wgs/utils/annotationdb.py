@@ -0,0 +1,485 @@
+'''
+compiled, memory mapped indexes for the variant annotation databases
+(dbsnp, cosmic, 1000 genomes and mutation assessor).
+
+an index is a directory with flat binary arrays, one row per database
+record, grouped by chromosome and sorted by position within each one:
+
+    positions.bin   int64 record positions
+    alleles.bin     uint64 hash of the ref and alt alleles
+    flags.bin       uint8 record flags, DELETION_FLAG for deletions
+    offsets.bin     int64 offsets of each record's payload, one extra entry
+    payload.bin     utf-8 payload strings, ids for vcf databases and the
+                    annotation for mutation assessor
+
+metadata.yaml records the database type, the source and the row range of
+each chromosome.
+'''
+import glob
+import hashlib
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import yaml
+from wgs.utils import helpers
+
+DELETION_FLAG = 1
+
+# records parsed before flushing to disk when building an index
+BUILD_CHUNKSIZE = 10 ** 6
+
+ARRAYS = {
+    'positions': np.int64,
+    'alleles': np.uint64,
+    'flags': np.uint8,
+    'offsets': np.int64,
+}
+
+
+class AnnotationIndexError(Exception):
+    pass
+
+
+def get_index_path(database):
+    return database.rstrip('/') + '.index'
+
+
+def get_allele_hash(ref, alt):
+    '''
+    64 bit hash of the ref and alt alleles
+    '''
+    digest = hashlib.blake2b(
+        '{}\t{}'.format(ref, alt).encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def get_allele_hashes(refs, alts):
+    return np.fromiter(
+        (get_allele_hash(ref, alt) for ref, alt in zip(refs, alts)),
+        dtype=np.uint64, count=len(refs)
+    )
+
+
+class AnnotationIndexWriter(object):
+    '''
+    writes records to a new index. records must be added
+    one chromosome at a time, in position order.
+    the index is written to a unique temp directory next to
+    the output and moved in place on close.
+    '''
+
+    def __init__(self, output, database_type, source, columns=None):
+        self.output = output.rstrip('/')
+
+        parent = os.path.dirname(os.path.abspath(self.output))
+        helpers.makedirs(parent)
+        self.tempdir = tempfile.mkdtemp(
+            dir=parent, prefix=os.path.basename(self.output) + '.', suffix='.tmp'
+        )
+
+        self.metadata = {
+            'type': database_type,
+            'source': os.path.abspath(source),
+            'columns': columns,
+            'chromosomes': [],
+        }
+
+        self.writers = {
+            name: open(os.path.join(self.tempdir, name + '.bin'), 'wb')
+            for name in list(ARRAYS) + ['payload']
+        }
+
+        self.nrows = 0
+        self.payload_size = 0
+        self.chromosome = None
+        self.last_position = None
+        self.seen = set()
+
+        self.writers['offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def start_chromosome(self, chromosome):
+        if chromosome in self.seen:
+            raise AnnotationIndexError(
+                'records for {} are not contiguous in {}'.format(
+                    chromosome, self.metadata['source']
+                )
+            )
+        self.seen.add(chromosome)
+
+        self.metadata['chromosomes'].append([chromosome, self.nrows, self.nrows])
+        self.chromosome = chromosome
+        self.last_position = None
+
+    def add_records(self, chromosome, positions, alleles, flags, payloads):
+        '''
+        :param chromosome: chromosome name
+        :param positions: sorted record positions
+        :param alleles: allele hashes
+        :param flags: record flags
+        :param payloads: list of payload strings
+        '''
+        if not len(positions):
+            return
+
+        if chromosome != self.chromosome:
+            self.start_chromosome(chromosome)
+
+        positions = np.asarray(positions, dtype=np.int64)
+
+        start = positions[0] if self.last_position is None else self.last_position
+        if start > positions[0] or np.any(positions[1:] < positions[:-1]):
+            raise AnnotationIndexError(
+                'records for {} are not sorted by position in {}'.format(
+                    chromosome, self.metadata['source']
+                )
+            )
+        self.last_position = positions[-1]
+
+        payloads = [payload.encode() for payload in payloads]
+        sizes = np.fromiter(
+            (len(payload) for payload in payloads), dtype=np.int64, count=len(payloads)
+        )
+        offsets = self.payload_size + np.cumsum(sizes)
+
+        self.writers['positions'].write(positions.tobytes())
+        self.writers['alleles'].write(np.asarray(alleles, dtype=np.uint64).tobytes())
+        self.writers['flags'].write(np.asarray(flags, dtype=np.uint8).tobytes())
+        self.writers['offsets'].write(offsets.tobytes())
+        self.writers['payload'].write(b''.join(payloads))
+
+        self.nrows += len(positions)
+        self.payload_size = int(offsets[-1])
+        self.metadata['chromosomes'][-1][2] = self.nrows
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.close()
+        shutil.rmtree(self.tempdir)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+        self.metadata['records'] = self.nrows
+
+        with open(os.path.join(self.tempdir, 'metadata.yaml'), 'wt') as writer:
+            yaml.safe_dump(self.metadata, writer, default_flow_style=False)
+
+        # mkdtemp directories are private, the index is shared with other users
+        os.chmod(self.tempdir, 0o755)
+
+        try:
+            os.rename(self.tempdir, self.output)
+        except OSError:
+            if not os.path.isdir(self.output):
+                raise
+            # an older index, or one built by a concurrent job, is in the
+            # way. move it aside to a unique name before replacing it.
+            stale = tempfile.mkdtemp(
+                dir=os.path.dirname(os.path.abspath(self.output)),
+                prefix=os.path.basename(self.output) + '.', suffix='.old'
+            )
+            os.rename(self.output, stale)
+            os.rename(self.tempdir, self.output)
+            shutil.rmtree(stale)
+
+
+class AnnotationIndex(object):
+    '''
+    read only, memory mapped view of an index
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, 'metadata.yaml'), 'rt') as reader:
+            self.metadata = yaml.safe_load(reader)
+
+        self.type = self.metadata['type']
+        self.columns = self.metadata['columns']
+        self.chromosomes = {
+            str(chrom): (start, end) for chrom, start, end in self.metadata['chromosomes']
+        }
+
+        for name, dtype in ARRAYS.items():
+            setattr(self, name, self._load_array(name, dtype))
+
+        self.payload = self._load_array('payload', np.uint8)
+
+    def _load_array(self, name, dtype):
+        filename = os.path.join(self.path, name + '.bin')
+
+        # empty files cannot be memory mapped
+        if not os.path.getsize(filename):
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(filename, dtype=dtype, mode='r')
+
+    def get_chromosome(self, chromosome):
+        '''
+        index chromosome matching the name, with or without chr prefix
+        '''
+        for chrom in (chromosome, chromosome.replace('chr', ''), 'chr' + chromosome):
+            if chrom in self.chromosomes:
+                return chrom
+
+    def get_payload(self, row):
+        return self.payload[self.offsets[row]:self.offsets[row + 1]].tobytes().decode()
+
+    def get_ranges(self, chromosome, positions):
+        '''
+        rows with each position
+        :param chromosome: chromosome name
+        :param positions: numpy array of positions
+        :returns tuple of numpy arrays with the first and last + 1 row
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+
+        chrom = self.get_chromosome(chromosome)
+        if chrom is None:
+            empty = np.zeros(len(positions), dtype=np.int64)
+            return empty, empty
+
+        start, end = self.chromosomes[chrom]
+        chrom_positions = self.positions[start:end]
+
+        lower = np.searchsorted(chrom_positions, positions, side='left') + start
+        upper = np.searchsorted(chrom_positions, positions, side='right') + start
+
+        return lower, upper
+
+    def query_ids(self, chromosome, positions, input_type):
+        '''
+        payloads of the records at each position, deletions are
+        resolved the same way as add_db_anno.resolve_db_position
+        :param chromosome: chromosome name
+        :param positions: numpy array of positions
+        :param input_type: snv or indel
+        :returns list with a list of unique payloads for each position
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+
+        if input_type == 'snv':
+            # deletions are shifted one base, so they are found one position back
+            ranges = [
+                (self.get_ranges(chromosome, positions - 1), True),
+                (self.get_ranges(chromosome, positions), False),
+            ]
+        else:
+            ranges = [(self.get_ranges(chromosome, positions), None)]
+
+        values = [[] for _ in range(len(positions))]
+
+        for (lower, upper), is_deletion in ranges:
+            for i in np.flatnonzero(upper > lower):
+                for row in range(lower[i], upper[i]):
+                    if is_deletion is not None and \
+                            bool(self.flags[row] & DELETION_FLAG) != is_deletion:
+                        continue
+
+                    value = self.get_payload(row)
+                    if value not in values[i]:
+                        values[i].append(value)
+
+        return values
+
+    def query_alleles(self, chromosome, positions, refs, alts):
+        '''
+        row matching position, ref and alt. the last matching
+        row wins if the database has duplicates.
+        :param chromosome: chromosome name
+        :param positions: numpy array of positions
+        :param refs: list of ref alleles
+        :param alts: list of alt alleles
+        :returns numpy array of rows, -1 where nothing matched
+        '''
+        lower, upper = self.get_ranges(chromosome, positions)
+        hashes = get_allele_hashes(refs, alts)
+
+        matches = np.full(len(lower), -1, dtype=np.int64)
+
+        # records sharing a position are few, so scan them
+        # in lockstep for all queries at once
+        for offset in range(int(np.max(upper - lower, initial=0))):
+            rows = lower + offset
+            valid = rows < upper
+            rows = np.where(valid, rows, 0)
+            hit = valid & (self.alleles[rows] == hashes)
+            matches[hit] = rows[hit]
+
+        return matches
+
+
+def iter_vcf_records(database):
+    '''
+    yields chromosome, position, id, ref and alt for each record
+    '''
+    with helpers.GetFileHandle(database, 'rt') as reader:
+        for line in reader:
+            if line.startswith('#'):
+                continue
+
+            chrom, pos, record_id, ref, alt = line.split('\t', 5)[:5]
+
+            yield chrom, int(pos), record_id, ref, alt
+
+
+def build_vcf_index(database, output):
+    '''
+    compiles a position sorted vcf database, such as
+    dbsnp, cosmic or 1000 genomes
+    :param database: vcf file
+    :param output: index directory
+    '''
+    records = iter_vcf_records(database)
+
+    with AnnotationIndexWriter(output, 'vcf', database) as writer:
+        for chrom, chrom_records in itertools.groupby(records, key=lambda rec: rec[0]):
+            while True:
+                chunk = list(itertools.islice(chrom_records, BUILD_CHUNKSIZE))
+                if not chunk:
+                    break
+
+                _, positions, ids, refs, alts = zip(*chunk)
+
+                flags = [
+                    DELETION_FLAG if len(ref) > len(alt) else 0
+                    for ref, alt in zip(refs, alts)
+                ]
+
+                writer.add_records(
+                    chrom, positions, get_allele_hashes(refs, alts), flags, ids
+                )
+
+
+def get_mutation_assessor_files(database):
+    files = sorted(glob.glob(os.path.join(database, 'MA.chr*.txt')))
+
+    if not files:
+        raise AnnotationIndexError('no MA.chr*.txt files found in {}'.format(database))
+
+    return files
+
+
+def get_mutation_assessor_columns(database):
+    '''
+    header of the mutation assessor tables, without the key column
+    '''
+    with open(get_mutation_assessor_files(database)[0]) as reader:
+        line = reader.readline()
+
+    return line.rstrip().split('\t')[1:]
+
+
+def read_mutation_assessor_table(filename):
+    '''
+    records in a mutation assessor table, grouped by chromosome
+    :returns dict of chromosome -> list of (position, ref, alt, annotation)
+    '''
+    records = {}
+
+    with open(filename) as reader:
+        for line in reader:
+            if line.startswith('#'):
+                continue
+            line = line.strip('\n').split('\t')
+            line = [val.replace(' ', '_') for val in line]
+
+            key = line[0].split(',')[1:5]
+            if len(key) < 4 or not key[1].isdigit():
+                # header
+                continue
+
+            chrom, pos, ref, alt = key
+            records.setdefault(chrom, []).append(
+                (int(pos), ref, alt, '|'.join(line[1:]))
+            )
+
+    return records
+
+
+def build_mutation_assessor_index(database, output):
+    '''
+    compiles the MA.chr*.txt tables in a mutation assessor directory
+    :param database: mutation assessor directory
+    :param output: index directory
+    '''
+    columns = get_mutation_assessor_columns(database)
+
+    with AnnotationIndexWriter(output, 'mutation_assessor', database, columns=columns) as writer:
+        for filename in get_mutation_assessor_files(database):
+            for chrom, records in read_mutation_assessor_table(filename).items():
+                # stable, so duplicates keep their file order
+                records.sort(key=lambda rec: rec[0])
+
+                positions, refs, alts, payloads = zip(*records)
+
+                writer.add_records(
+                    chrom, positions, get_allele_hashes(refs, alts),
+                    np.zeros(len(positions), dtype=np.uint8), payloads
+                )
+
+
+def build_index(database, database_type, output=None):
+    '''
+    compiles an annotation database into an index
+    :param database: vcf file, or mutation assessor directory
+    :param database_type: vcf or mutation_assessor
+    :param output: index directory, defaults to the database path + .index
+    '''
+    output = output if output else get_index_path(database)
+
+    if database_type == 'vcf':
+        build_vcf_index(database, output)
+    elif database_type == 'mutation_assessor':
+        build_mutation_assessor_index(database, output)
+    else:
+        raise AnnotationIndexError('unknown database type {}'.format(database_type))
+
+    return output
+
+
+def load_index(database, database_type):
+    '''
+    loads the index for a database if one has been built
+    and it is not older than the database
+    :param database: vcf file, or mutation assessor directory
+    :param database_type: vcf or mutation_assessor
+    :returns AnnotationIndex or None
+    '''
+    index_path = get_index_path(database)
+    metadata = os.path.join(index_path, 'metadata.yaml')
+
+    if not os.path.exists(metadata):
+        return None
+
+    if os.path.getmtime(metadata) < os.path.getmtime(database):
+        logging.getLogger("wgs.annotationdb").warning(
+            "ignoring index {}, it is older than {}".format(index_path, database)
+        )
+        return None
+
+    index = AnnotationIndex(index_path)
+
+    if index.type != database_type:
+        raise AnnotationIndexError(
+            'index {} is for a {} database, expected {}'.format(
+                index_path, index.type, database_type
+            )
+        )
+
+    return index
@@ -1,3 +1,9 @@
+import gzip
+import logging
+import os
+import struct
+
+import numpy as np
 import pysam
 
 def get_sample_id(bamfile):
@@ -12,3 +18,331 @@ def get_sample_id(bamfile):
     assert len(samples) == 1
 
     return list(samples)[0]
+
+
+# reads skipped by samtools bedcov
+COVERAGE_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# reads held in memory before they are added to the bins
+COVERAGE_CHUNK_SIZE = 10 ** 6
+
+
+def _get_prefix_coverage(read_starts, read_ends, positions):
+    '''
+    total coverage of the reads over [0, position) for each position,
+    sum over reads of (position - start) for reads starting before
+    the position minus (position - end) for reads ending before it
+    '''
+    read_starts = np.sort(read_starts)
+    read_ends = np.sort(read_ends)
+
+    def prefix(values):
+        counts = np.searchsorted(values, positions, side='left')
+        sums = np.concatenate(([0], np.cumsum(values)))[counts]
+        return counts * positions - sums
+
+    return prefix(read_starts) - prefix(read_ends)
+
+
+def get_binned_coverage(bamfile, chrom, starts, ends, mapping_qual=0):
+    '''
+    sum of the per base depth in each bin, the same value as samtools
+    bedcov -Q mapping_qual: reads that are unmapped, secondary, qc fail
+    or duplicates are skipped and deletions and skipped regions count
+    towards the depth. coverage is accumulated from the read spans
+    without a pileup.
+    :param bamfile: indexed bam file
+    :param chrom: contig to read
+    :param starts: 0 based bin starts
+    :param ends: 0 based, exclusive bin ends
+    :param mapping_qual: minimum mapping quality
+    :returns numpy array with the coverage sum of each bin
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    positions = np.concatenate((starts, ends))
+    coverage = np.zeros(len(positions), dtype=np.int64)
+
+    if not len(starts) or ends.max() <= max(starts.min(), 0):
+        return np.zeros(len(starts), dtype=np.int64)
+
+    read_starts = []
+    read_ends = []
+
+    with pysam.AlignmentFile(bamfile, 'rb') as bam:
+        # only reads that overlap the bins are read
+        for read in bam.fetch(chrom, max(starts.min(), 0), ends.max()):
+            if read.flag & COVERAGE_SKIP_FLAGS or read.mapping_quality < mapping_qual:
+                continue
+
+            read_starts.append(read.reference_start)
+            read_ends.append(read.reference_end)
+
+            if len(read_starts) >= COVERAGE_CHUNK_SIZE:
+                coverage += _get_prefix_coverage(
+                    np.array(read_starts, dtype=np.int64),
+                    np.array(read_ends, dtype=np.int64), positions
+                )
+                read_starts = []
+                read_ends = []
+
+    if read_starts:
+        coverage += _get_prefix_coverage(
+            np.array(read_starts, dtype=np.int64),
+            np.array(read_ends, dtype=np.int64), positions
+        )
+
+    bin_coverage = coverage[len(starts):] - coverage[:len(starts)]
+
+    return np.where(ends > starts, bin_coverage, 0)
+
+
+# bins of the bai binning scheme, the same as csi with min_shift 14 and depth 5
+BAI_MIN_SHIFT = 14
+BAI_DEPTH = 5
+
+# bins sampled for exact coverage to scale approximate coverage
+COVERAGE_CALIBRATION_BINS = 20
+
+
+def _get_meta_bin(depth):
+    return ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+
+
+def _get_bin_window(bin_id, depth):
+    '''
+    first linear index window of a bin in the binning scheme
+    '''
+    for level in range(depth, -1, -1):
+        first_bin = ((1 << (level * 3)) - 1) // 7
+        if bin_id >= first_bin:
+            return (bin_id - first_bin) << (3 * (depth - level))
+
+
+def _read_index_values(reader, fmt):
+    size = struct.calcsize(fmt)
+    return struct.unpack(fmt, reader.read(size))
+
+
+def read_linear_index(bamfile):
+    '''
+    reads the linear index of a bam from its .bai or .csi file.
+    for bai the linear index is stored for every window, windows without
+    reads get the offset of the next window with reads. csi only keeps the
+    loffset of each bin, the linear index value at the start of the bin,
+    so only the windows at the start of a bin are known.
+    :param bamfile: bam file with a .bai or .csi index
+    :returns tuple of the window shift and a list with one entry
+    per reference: tuple of window indices and their virtual offsets,
+    the last window is the end of the reference. None if the reference
+    has no reads
+    '''
+    for path in (bamfile + '.bai', os.path.splitext(bamfile)[0] + '.bai', bamfile + '.csi'):
+        if os.path.exists(path):
+            break
+    else:
+        raise Exception('no .bai or .csi index found for {}'.format(bamfile))
+
+    is_csi = path.endswith('.csi')
+
+    with pysam.AlignmentFile(bamfile, 'rb') as bam:
+        lengths = list(bam.lengths)
+
+    opener = gzip.open if is_csi else open
+
+    with opener(path, 'rb') as reader:
+        magic = reader.read(4)
+
+        if is_csi:
+            assert magic == b'CSI\x01', 'invalid csi index {}'.format(path)
+            min_shift, depth, l_aux = _read_index_values(reader, '<3i')
+            reader.read(l_aux)
+        else:
+            assert magic == b'BAI\x01', 'invalid bai index {}'.format(path)
+            min_shift, depth = BAI_MIN_SHIFT, BAI_DEPTH
+
+        meta_bin = _get_meta_bin(depth)
+
+        n_ref, = _read_index_values(reader, '<i')
+
+        references = []
+        for ref_id in range(n_ref):
+            ref_end = None
+            bin_offsets = {}
+
+            n_bin, = _read_index_values(reader, '<i')
+            for _ in range(n_bin):
+                if is_csi:
+                    bin_id, loffset, n_chunk = _read_index_values(reader, '<IQi')
+                else:
+                    bin_id, n_chunk = _read_index_values(reader, '<Ii')
+                    loffset = None
+
+                chunks = np.frombuffer(reader.read(16 * n_chunk), dtype='<u8')
+
+                if bin_id == meta_bin:
+                    ref_end = int(chunks[1])
+                elif is_csi:
+                    window = _get_bin_window(bin_id, depth)
+                    bin_offsets[window] = min(loffset, bin_offsets.get(window, loffset))
+
+            if is_csi:
+                windows = np.array(sorted(bin_offsets), dtype=np.int64)
+                offsets = np.array([bin_offsets[window] for window in windows], dtype=np.uint64)
+                end_window = max(
+                    windows[-1] + 1 if len(windows) else 0,
+                    -(-lengths[ref_id] >> min_shift)
+                )
+            else:
+                n_intv, = _read_index_values(reader, '<i')
+                offsets = np.frombuffer(reader.read(8 * n_intv), dtype='<u8').astype(np.uint64)
+                windows = np.arange(n_intv, dtype=np.int64)
+                end_window = n_intv
+
+            if ref_end is None:
+                references.append(None)
+                continue
+
+            windows = np.append(windows, end_window)
+            offsets = np.append(offsets, np.uint64(ref_end))
+
+            # missing windows take the offset of the next window with reads
+            missing = (offsets == 0) | (offsets == np.iinfo(np.uint64).max)
+            offsets[missing] = np.iinfo(np.uint64).max
+            offsets = np.minimum.accumulate(offsets[::-1])[::-1]
+
+            references.append((windows, offsets))
+
+    return min_shift, references
+
+
+def _get_byte_positions(bamfile, voffsets):
+    '''
+    approximate position in the compressed file of virtual offsets,
+    the offset within a block is scaled by the compression ratio
+    of the block, read from the bgzf block header and footer
+    '''
+    voffsets = np.asarray(voffsets, dtype=np.uint64)
+
+    coffsets = (voffsets >> np.uint64(16)).astype(np.int64)
+    uoffsets = (voffsets & np.uint64(0xffff)).astype(np.int64)
+
+    unique_coffsets, inverse = np.unique(coffsets, return_inverse=True)
+
+    ratios = np.zeros(len(unique_coffsets))
+    with open(bamfile, 'rb') as reader:
+        for i, coffset in enumerate(unique_coffsets.tolist()):
+            reader.seek(coffset)
+            header = reader.read(18)
+            if len(header) < 18:
+                continue
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+
+            reader.seek(coffset + block_size - 4)
+            uncompressed_size, = struct.unpack('<I', reader.read(4))
+
+            if uncompressed_size:
+                ratios[i] = block_size / uncompressed_size
+
+    return coffsets + uoffsets * ratios[inverse]
+
+
+def get_approximate_binned_coverage(
+        bamfile, bins, mapping_qual=0, calibration_bins=COVERAGE_CALIBRATION_BINS
+):
+    '''
+    approximate coverage sum per bin from the bam index, without reading
+    the alignments. the compressed bytes spanned by each bin are taken from
+    the linear index (16kb windows for bai, interpolated between windows)
+    and scaled to coverage by the ratio of exact coverage to bytes over
+    calibration_bins bins spread across the genome.
+
+    error bound: with rho the compressed bytes per covered base in a bin,
+    rho_0 the genome wide calibrated value, W the window size, R the read
+    length and L the bin length, the relative error of a bin is at most
+    |rho / rho_0 - 1| + 2 * (W + R) / L. the first term covers changes in
+    read length, duplicate and low quality read rates and compressibility
+    along the genome, the second the bin edges, where bytes are assumed to
+    be uniform within a window and reads crossing the edge are assigned to
+    one side. with the default 2000 bins per chromosome the edge term only
+    reaches its bound if all reads in an edge window sit on one side of
+    the edge, on uniform coverage it is close to zero. csi indexes only
+    keep offsets at the start of the bins left after htslib merges sparse
+    bins, so W is the size of the smallest bin around the edge and the
+    estimate is coarser than with a bai. the relative error over the
+    calibration bins is logged for every bam.
+
+    :param bamfile: bam file with a .bai or .csi index
+    :param bins: list of chromosome, 0 based bin starts and 0 based bin ends
+    :param mapping_qual: minimum mapping quality of the calibration coverage
+    :param calibration_bins: number of bins computed exactly for the scaling
+    :returns list with a numpy array of approximate coverage sums per chromosome
+    '''
+    min_shift, references = read_linear_index(bamfile)
+
+    with pysam.AlignmentFile(bamfile, 'rb') as bam:
+        ref_ids = {name: i for i, name in enumerate(bam.references)}
+
+    window = 1 << min_shift
+
+    bins = [
+        (chrom, np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+        for chrom, starts, ends in bins
+    ]
+
+    bin_bytes = []
+    for chrom, starts, ends in bins:
+        reference = references[ref_ids[chrom]] if chrom in ref_ids else None
+
+        if reference is None:
+            bin_bytes.append(np.zeros(len(starts)))
+            continue
+
+        windows, offsets = reference
+
+        edges = np.clip(np.concatenate((starts, ends)), 0, None)
+
+        # only the windows next to a bin edge are needed
+        index = np.searchsorted(windows, edges >> min_shift, side='right')
+        needed = np.unique(np.clip(np.concatenate((index - 1, index)), 0, len(windows) - 1))
+
+        positions = np.interp(
+            edges / float(window), windows[needed],
+            _get_byte_positions(bamfile, offsets[needed])
+        )
+
+        nbytes = positions[len(starts):] - positions[:len(starts)]
+        bin_bytes.append(np.where(ends > starts, np.clip(nbytes, 0, None), 0))
+
+    # calibration bins are spread evenly over all bins with data
+    candidates = [
+        (i, j) for i, nbytes in enumerate(bin_bytes) for j in np.flatnonzero(nbytes > 0)
+    ]
+    step = max(1, len(candidates) // calibration_bins) if calibration_bins else 0
+    calibration = candidates[step // 2::step][:calibration_bins] if step else []
+
+    exact = np.array([
+        get_binned_coverage(
+            bamfile, bins[i][0], bins[i][1][j:j + 1], bins[i][2][j:j + 1], mapping_qual
+        )[0]
+        for i, j in calibration
+    ], dtype=float)
+    calibration_bytes = np.array([bin_bytes[i][j] for i, j in calibration], dtype=float)
+
+    scale = exact.sum() / calibration_bytes.sum() if calibration_bytes.sum() else 0
+
+    if len(calibration):
+        estimate = calibration_bytes * scale
+        with np.errstate(invalid='ignore', divide='ignore'):
+            error = np.abs(estimate - exact) / exact
+        error = error[np.isfinite(error)]
+        if len(error):
+            logging.getLogger("wgs.bamutils").info(
+                "approximate coverage of {}: relative error over {} calibration "
+                "bins median {:.4f} max {:.4f}".format(
+                    bamfile, len(error), np.median(error), error.max()
+                )
+            )
+
+    return [np.round(nbytes * scale).astype(np.int64) for nbytes in bin_bytes]
@@ -0,0 +1,103 @@
+'''
+vectorized per bin summaries of positional data. values are
+assigned to bins once and all bins are reduced together with
+np.bincount, instead of one boolean mask per bin.
+missing (nan) values are skipped, the same as pandas.
+'''
+import numpy as np
+
+
+def get_bin_index(positions, edges):
+    '''
+    bin of each position, bin i covers edges[i] to edges[i + 1].
+    matches np.digitize(positions, edges) - 1, positions outside
+    of the edges are assigned -1
+    :param positions: array of positions
+    :param edges: sorted bin edges
+    :returns int numpy array of bin indices
+    '''
+    positions = np.asarray(positions, dtype=float)
+
+    index = np.digitize(positions, edges) - 1
+    index[(index < 0) | (index >= len(edges) - 1)] = -1
+
+    return index
+
+
+def _get_valid(index, values):
+    index = np.asarray(index)
+    values = np.asarray(values, dtype=float)
+
+    valid = (index >= 0) & ~np.isnan(values)
+
+    return index[valid], values[valid]
+
+
+def bin_count(index, values, nbins):
+    '''
+    number of non missing values per bin
+    :param index: bin of each value, as returned by get_bin_index
+    :param values: array of values
+    :param nbins: number of bins
+    '''
+    index, _ = _get_valid(index, values)
+    return np.bincount(index, minlength=nbins)
+
+
+def bin_mean(index, values, nbins):
+    '''
+    mean of the values per bin, nan for empty bins
+    :param index: bin of each value, as returned by get_bin_index
+    :param values: array of values
+    :param nbins: number of bins
+    '''
+    index, values = _get_valid(index, values)
+
+    counts = np.bincount(index, minlength=nbins)
+    sums = np.bincount(index, weights=values, minlength=nbins)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def bin_quantile(index, values, nbins, q):
+    '''
+    quantile of the values per bin with linear interpolation,
+    nan for empty bins
+    :param index: bin of each value, as returned by get_bin_index
+    :param values: array of values
+    :param nbins: number of bins
+    :param q: quantile between 0 and 1
+    '''
+    index, values = _get_valid(index, values)
+
+    # sort by bin, then by value so each bin is a contiguous sorted run
+    order = np.lexsort((values, index))
+    values = values[order]
+
+    counts = np.bincount(index, minlength=nbins)
+    offsets = np.cumsum(counts) - counts
+
+    quantiles = np.full(nbins, np.nan)
+
+    nonempty = counts > 0
+    rank = (counts[nonempty] - 1) * q
+    lower = np.floor(rank).astype(np.int64)
+    upper = np.ceil(rank).astype(np.int64)
+
+    lower_values = values[offsets[nonempty] + lower]
+    upper_values = values[offsets[nonempty] + upper]
+
+    quantiles[nonempty] = lower_values + (upper_values - lower_values) * (rank - lower)
+
+    return quantiles
+
+
+def quantile(values, q):
+    '''
+    quantile of all non missing values, nan if there are none
+    :param values: array of values
+    :param q: quantile between 0 and 1
+    '''
+    values = np.asarray(values, dtype=float)
+    return bin_quantile(np.zeros(len(values), dtype=np.int64), values, 1, q)[0]
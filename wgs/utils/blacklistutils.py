@@ -0,0 +1,197 @@
+'''
+compiled index of blacklisted regions, such as low mappability regions.
+regions are merged and stored per chromosome as sorted numpy arrays
+in a .npz file next to the blacklist, so lookups are a single
+searchsorted call per chromosome.
+'''
+import logging
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def merge_regions(starts, ends):
+    '''
+    sort and merge overlapping or adjacent regions,
+    coordinates are inclusive on both ends
+    :param starts: region starts
+    :param ends: region ends
+    :returns tuple of numpy arrays with merged starts and ends
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    if not len(starts):
+        return starts, ends
+
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    ends = np.maximum.accumulate(ends[order])
+
+    breaks = np.ones(len(starts), dtype=bool)
+    breaks[1:] = starts[1:] > ends[:-1] + 1
+
+    group_ends = np.append(np.flatnonzero(breaks)[1:] - 1, len(starts) - 1)
+
+    return starts[breaks], ends[group_ends]
+
+
+def get_index_path(blacklist):
+    return blacklist + '.npz'
+
+
+class BlacklistIndex(object):
+    '''
+    per chromosome sorted, non overlapping regions
+    '''
+
+    def __init__(self, chromosomes, offsets, starts, ends):
+        self.regions = {}
+        for i, chrom in enumerate(chromosomes):
+            chrom_slice = slice(offsets[i], offsets[i + 1])
+            self.regions[str(chrom)] = (starts[chrom_slice], ends[chrom_slice])
+
+    @classmethod
+    def from_tsv(cls, blacklist):
+        '''
+        builds the index from a tsv with chromosome, start and end columns
+        '''
+        data = pd.read_csv(blacklist, sep='\t', dtype={'chromosome': str})
+
+        chromosomes = []
+        offsets = [0]
+        starts = []
+        ends = []
+        for chrom, chrom_data in data.groupby('chromosome', sort=True):
+            chrom_starts, chrom_ends = merge_regions(
+                chrom_data['start'].values, chrom_data['end'].values
+            )
+            chromosomes.append(chrom)
+            starts.append(chrom_starts)
+            ends.append(chrom_ends)
+            offsets.append(offsets[-1] + len(chrom_starts))
+
+        def concat(arrays):
+            if not arrays:
+                return np.zeros(0, dtype=np.int64)
+            return np.concatenate(arrays)
+
+        return cls(
+            np.array(chromosomes, dtype=str), np.array(offsets, dtype=np.int64),
+            concat(starts), concat(ends)
+        )
+
+    @classmethod
+    def from_npz(cls, path):
+        data = np.load(path, allow_pickle=False)
+        return cls(data['chromosomes'], data['offsets'], data['starts'], data['ends'])
+
+    def save(self, path):
+        chromosomes = sorted(self.regions)
+
+        offsets = [0]
+        for chrom in chromosomes:
+            offsets.append(offsets[-1] + len(self.regions[chrom][0]))
+
+        starts = [self.regions[chrom][0] for chrom in chromosomes]
+        ends = [self.regions[chrom][1] for chrom in chromosomes]
+
+        # write to a unique temp file first so readers never see a partial
+        # index and jobs building the same index don't clobber each other
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'wb') as writer:
+                np.savez(
+                    writer,
+                    chromosomes=np.array(chromosomes, dtype=str),
+                    offsets=np.array(offsets, dtype=np.int64),
+                    starts=np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64),
+                    ends=np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64),
+                )
+            # mkstemp files are private, the index is shared with other users
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def contains(self, chrom, positions):
+        '''
+        vectorized membership test for positions on one chromosome
+        :param chrom: chromosome name
+        :param positions: array of positions
+        :returns boolean numpy array, True if the position is blacklisted
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+
+        if chrom not in self.regions:
+            return np.zeros(len(positions), dtype=bool)
+
+        starts, ends = self.regions[chrom]
+        if not len(starts):
+            return np.zeros(len(positions), dtype=bool)
+
+        index = np.searchsorted(starts, positions, side='right') - 1
+        valid = index >= 0
+        index[~valid] = 0
+        return valid & (positions <= ends[index])
+
+    def mask(self, chromosomes, positions):
+        '''
+        vectorized membership test for positions on any chromosome
+        :param chromosomes: array of chromosome names
+        :param positions: array of positions
+        :returns boolean numpy array, True if the position is blacklisted
+        '''
+        chromosomes = np.asarray(chromosomes, dtype=str)
+        positions = np.asarray(positions, dtype=np.int64)
+
+        mask = np.zeros(len(positions), dtype=bool)
+        if not len(positions):
+            return mask
+
+        names, groups = np.unique(chromosomes, return_inverse=True)
+        for i, chrom in enumerate(names):
+            selected = groups == i
+            mask[selected] = self.contains(str(chrom), positions[selected])
+
+        return mask
+
+
+def build_index(blacklist, output=None):
+    '''
+    compiles the blacklist tsv into a .npz index
+    :param blacklist: tsv with chromosome, start and end columns
+    :param output: index path, defaults to the blacklist path + .npz
+    '''
+    output = output if output else get_index_path(blacklist)
+    BlacklistIndex.from_tsv(blacklist).save(output)
+
+
+def load_index(blacklist):
+    '''
+    loads the compiled index for a blacklist tsv, building
+    and caching it if it is missing or older than the tsv
+    :param blacklist: tsv with chromosome, start and end columns
+    :returns BlacklistIndex
+    '''
+    index_path = get_index_path(blacklist)
+
+    if os.path.exists(index_path) and \
+            os.path.getmtime(index_path) >= os.path.getmtime(blacklist):
+        return BlacklistIndex.from_npz(index_path)
+
+    index = BlacklistIndex.from_tsv(blacklist)
+
+    try:
+        index.save(index_path)
+    except (IOError, OSError) as exc:
+        logging.getLogger("wgs.blacklist").warning(
+            "unable to cache blacklist index {}: {}".format(index_path, exc)
+        )
+
+    return index
@@ -1,12 +1,49 @@
+import csv
 import gzip
+import itertools
 import logging
 import os
+import re
 import shutil
 
 import pandas as pd
 import yaml
 from wgs.utils import helpers
 
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_dataset
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+DTYPE_PRECEDENCE = ['str', 'float', 'int', 'bool', 'NA']
+
+# number of data lines used to infer dtypes when a file has no yaml
+DTYPE_INFERENCE_LINES = 10 ** 4
+
+# values read as missing by pandas.read_csv
+NA_VALUES = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+    'nan', 'null'
+}
+
+BOOL_REGEX = r'True|TRUE|true|False|FALSE|false'
+INT_REGEX = r'[-+]?[0-9]+'
+FLOAT_REGEX = r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?|[-+]?(?:inf|Inf|INF)'
+
+# newline terminated values that fit each dtype, ordered from the most
+# specific dtype. float also accepts ints, bools never mix with numbers:
+# pandas reads a column of bools and numbers as str.
+DTYPE_PATTERNS = [
+    ('bool', re.compile(r'(?:(?:{})\n)*'.format(BOOL_REGEX))),
+    ('int', re.compile(r'(?:(?:{})\n)*'.format(INT_REGEX))),
+    ('float', re.compile(r'(?:(?:{}|{})\n)*'.format(INT_REGEX, FLOAT_REGEX))),
+]
+
+CHROMOSOME_COLUMNS = ['chr', 'chrom', 'chromosome']
+
 
 class CsvParseError(Exception):
     pass
@@ -26,11 +63,14 @@ def get_dtypes_from_df(df, na_rep='NA'):
         "int64": "int",
         "float64": "float",
         "object": "str",
+        # arrow backed string columns read from parquet
+        "string": "str",
+        "str": "str",
     }
 
     typeinfo = {}
     for column, dtype in df.dtypes.items():
-        if column in ['chr', 'chrom', 'chromosome']:
+        if column in CHROMOSOME_COLUMNS:
             typeinfo[column] = 'str'
         else:
             if df.empty:
@@ -41,26 +81,307 @@ def get_dtypes_from_df(df, na_rep='NA'):
     return typeinfo
 
 
+def get_file_format(filepath):
+    """
+    parquet files are detected by extension, everything
+    else is treated as (optionally gzipped) text
+    :param filepath: path to file, may end with pypeliner's .tmp
+    :type filepath: str
+    :return: parquet or csv
+    :rtype: str
+    """
+    if filepath.endswith('.tmp'):
+        filepath = filepath[:-4]
+
+    _, ext = os.path.splitext(filepath)
+
+    if ext == '.parquet':
+        if pa is None:
+            raise CsvInputError(
+                "pyarrow is required to read or write {}".format(filepath)
+            )
+        return 'parquet'
+
+    return 'csv'
+
+
+def get_dtypes_from_arrow_schema(schema, na_rep='NA'):
+    """
+    yaml dtypes for the columns in an arrow schema, same
+    conventions as get_dtypes_from_df
+    :param schema: pyarrow schema
+    :param na_rep: dtype for columns with no data
+    :return: dict with column name and dtype
+    :rtype: dict
+    """
+    typeinfo = {}
+    for field in schema:
+        if field.name in CHROMOSOME_COLUMNS:
+            typeinfo[field.name] = 'str'
+        elif pa.types.is_null(field.type):
+            typeinfo[field.name] = na_rep
+        elif pa.types.is_boolean(field.type):
+            typeinfo[field.name] = 'bool'
+        elif pa.types.is_integer(field.type):
+            typeinfo[field.name] = 'int'
+        elif pa.types.is_floating(field.type):
+            typeinfo[field.name] = 'float'
+        else:
+            typeinfo[field.name] = 'str'
+
+    return typeinfo
+
+
+def get_arrow_schema(columns, dtypes, schema=None):
+    """
+    arrow schema matching yaml metadata, used to
+    cast tables before they are written to parquet
+    :param columns: column names
+    :type columns: list
+    :param dtypes: dict with column name and dtype
+    :type dtypes: dict
+    :param schema: columns with no data (NA) keep their type from
+    this schema if set, are null otherwise
+    :return: pyarrow schema
+    """
+    arrow_types = {
+        'str': pa.string(),
+        'float': pa.float64(),
+        'int': pa.int64(),
+        'bool': pa.bool_(),
+    }
+
+    fields = []
+    for column in columns:
+        if dtypes[column] in arrow_types:
+            fields.append(pa.field(column, arrow_types[dtypes[column]]))
+        elif schema is not None:
+            fields.append(schema.field(column))
+        else:
+            fields.append(pa.field(column, pa.null()))
+
+    return pa.schema(fields)
+
+
+def merge_dtype(dtype, other):
+    """
+    the more general of two dtypes as defined in DTYPE_PRECEDENCE
+    :param dtype: yaml dtype
+    :type dtype: str
+    :param other: yaml dtype
+    :type other: str
+    :return: yaml dtype
+    :rtype: str
+    """
+    if DTYPE_PRECEDENCE.index(other) < DTYPE_PRECEDENCE.index(dtype):
+        return other
+    return dtype
+
+
+def merge_dtypes(dtypes):
+    """
+    merges column dtypes across files, picking the most general
+    dtype for each column as defined in DTYPE_PRECEDENCE
+    :param dtypes: list of dicts with column name and dtype
+    :type dtypes: list
+    :return: dict with column name and merged dtype
+    :rtype: dict
+    """
+    merged_dtypes = {}
+    for dtype_val in dtypes:
+        for col, dtype in dtype_val.items():
+            if col not in merged_dtypes:
+                merged_dtypes[col] = dtype
+            else:
+                merged_dtypes[col] = merge_dtype(merged_dtypes[col], dtype)
+
+    return merged_dtypes
+
+
+def get_column_dtype(values):
+    """
+    yaml dtype for the values in a column, the most specific dtype
+    in DTYPE_PRECEDENCE that all values fit. int and bool columns
+    with missing values are float and str, which is how pandas
+    reads them.
+    :param values: fields as read from the file
+    :type values: iterable
+    :return: yaml dtype
+    :rtype: str
+    """
+    values = set(values)
+    has_na = not values.isdisjoint(NA_VALUES)
+    values -= NA_VALUES
+
+    if not values:
+        # pandas reads an all missing column as float
+        return 'float'
+
+    # match all unique values in one go instead of one by one
+    joined = '\n'.join(values) + '\n'
+
+    for dtype, pattern in DTYPE_PATTERNS:
+        if pattern.fullmatch(joined):
+            break
+    else:
+        return 'str'
+
+    if has_na and dtype == 'int':
+        return 'float'
+    if has_na and dtype == 'bool':
+        return 'str'
+    return dtype
+
+
+def infer_dtypes(rows, columns, na_rep='NA'):
+    """
+    infers column dtypes from csv rows
+    :param rows: iterable over lists of fields
+    :param columns: column names
+    :type columns: list
+    :param na_rep: dtype for columns if there are no rows
+    :type na_rep: str
+    :return: dict with column name and dtype
+    :rtype: dict
+    """
+    ncols = len(columns)
+    rows = [
+        row if len(row) >= ncols else row + [''] * (ncols - len(row))
+        for row in rows
+    ]
+
+    values = list(zip(*rows)) if rows else [()] * ncols
+
+    typeinfo = {}
+    for column, column_values in zip(columns, values):
+        if column in CHROMOSOME_COLUMNS:
+            typeinfo[column] = 'str'
+        elif not rows:
+            typeinfo[column] = na_rep
+        else:
+            typeinfo[column] = get_column_dtype(column_values)
+
+    return typeinfo
+
+
+def write_metadata(yaml_file, header, sep, columns, dtypes):
+    """
+    writes the yaml sidecar for a csv file
+    :param yaml_file: path to yaml file
+    :type yaml_file: str
+    :param header: whether the csv file has a header line
+    :type header: bool
+    :param sep: separator
+    :type sep: str
+    :param columns: column names
+    :type columns: list
+    :param dtypes: dict with column name and dtype
+    :type dtypes: dict
+    """
+    yamldata = {'header': header, 'sep': sep, 'columns': []}
+
+    for column in columns:
+        data = {'name': column, 'dtype': dtypes[column]}
+        yamldata['columns'].append(data)
+
+    with helpers.GetFileHandle(yaml_file, 'wt') as f:
+        yaml.safe_dump(yamldata, f, default_flow_style=False)
+
+
+def get_filter_mask(df, filters):
+    """
+    evaluates filters on a dataframe. filters use the pyarrow
+    format: a list of (column, op, value) tuples that are all
+    required to match, or a list of such lists, any of which
+    can match.
+    :param df: dataframe
+    :type df: pandas.DataFrame
+    :param filters: filters
+    :type filters: list
+    :return: boolean mask of matching rows
+    :rtype: pandas.Series
+    """
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    mask = pd.Series(False, index=df.index)
+    for conjunction in filters:
+        submask = pd.Series(True, index=df.index)
+        for column, op, value in conjunction:
+            values = df[column]
+            if op in ('=', '=='):
+                submask &= values == value
+            elif op == '!=':
+                submask &= values != value
+            elif op == '<':
+                submask &= values < value
+            elif op == '<=':
+                submask &= values <= value
+            elif op == '>':
+                submask &= values > value
+            elif op == '>=':
+                submask &= values >= value
+            elif op == 'in':
+                submask &= values.isin(value)
+            elif op == 'not in':
+                submask &= ~values.isin(value)
+            else:
+                raise CsvInputError("unknown filter operator {}".format(op))
+        mask |= submask
+
+    return mask
+
+
+def get_filter_columns(filters):
+    """
+    columns referenced in filters
+    :param filters: filters in the pyarrow format
+    :type filters: list
+    :return: column names
+    :rtype: set
+    """
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    return set(column for conjunction in filters for column, _, _ in conjunction)
+
+
 class CsvInput(object):
-    def __init__(self, filepath, na_rep='NA', sep=None):
+    def __init__(
+            self, filepath, na_rep='NA', sep=None,
+            inference_lines=DTYPE_INFERENCE_LINES, cache_metadata=True
+    ):
         """
         csv file and all related metadata
         :param filepath: path to csv
         :type filepath: str
         :param na_rep: replace na with this
         :type na_rep: str
+        :param inference_lines: number of lines used to infer
+        dtypes if the file has no yaml
+        :type inference_lines: int
+        :param cache_metadata: write inferred metadata to yaml
+        :type cache_metadata: bool
         """
         self.filepath = filepath
-        self.compression = self.__get_compression_type_pandas()
+        self.format = get_file_format(filepath)
+        self.compression = None
+        if self.format == 'csv':
+            self.compression = self.__get_compression_type_pandas()
         self.na_rep = na_rep
 
         self.sep = sep
 
+        self.inference_lines = inference_lines
+
         if os.path.exists(self.yaml_file):
             metadata = self.__parse_metadata()
         else:
-            metadata = self.generate_metadata()
-
+            if self.format == 'parquet':
+                metadata = self.__generate_parquet_metadata()
+            else:
+                metadata = self.generate_metadata()
+            if cache_metadata:
+                self.__cache_metadata(*metadata)
 
         self.header, self.sep, self.dtypes, self.columns = metadata
 
@@ -121,19 +442,6 @@ class CsvInput(object):
                 logging.getLogger("single_cell.utils.csv").warn("empty csv file")
                 return True
 
-    def __generate_dtypes(self, columns=None, sep=','):
-        data = pd.read_csv(
-            self.filepath, compression=self.compression, chunksize=10 ** 6,
-            sep=sep
-        )
-        data = next(data)
-
-        if columns:
-            data.columns = columns
-
-        typeinfo = get_dtypes_from_df(data)
-        return typeinfo
-
     def __parse_metadata(self):
         with helpers.GetFileHandle(self.filepath + '.yaml') as yamlfile:
             yamldata = yaml.safe_load(yamlfile)
@@ -152,46 +460,162 @@ class CsvInput(object):
 
         return header, sep, dtypes, columns
 
+    def __generate_parquet_metadata(self):
+        """
+        metadata from the parquet schema, no data is read
+        """
+        schema = pq.read_schema(self.filepath)
+        dtypes = get_dtypes_from_arrow_schema(schema, na_rep=self.na_rep)
+        return True, self.sep or ',', dtypes, list(schema.names)
+
+    def __cache_metadata(self, header, sep, dtypes, columns):
+        """
+        saves inferred metadata next to the file so
+        that later reads skip the inference
+        """
+        try:
+            write_metadata(self.yaml_file, header, sep, columns, dtypes)
+        except (IOError, OSError) as exc:
+            logging.getLogger("wgs.utils.csv").warning(
+                "unable to cache metadata for {}: {}".format(self.filepath, exc)
+            )
+
     def generate_metadata(self):
+        """
+        reads the header and infers dtypes from
+        the first inference_lines lines of the file
+        """
         with helpers.GetFileHandle(self.filepath) as inputfile:
             header = inputfile.readline().strip()
             sep = self.__detect_sep_from_header(header)
             columns = header.split(sep)
-            header = True
-            dtypes = self.__generate_dtypes(sep=sep)
-            return header, sep, dtypes, columns
 
-    def __verify_data(self, df):
+            reader = csv.reader(inputfile, delimiter=sep)
+            rows = itertools.islice(reader, self.inference_lines)
+            dtypes = infer_dtypes(rows, columns, na_rep=self.na_rep)
+
+            return True, sep, dtypes, columns
+
+    def __verify_data(self, df, columns=None):
+        columns = self.columns if columns is None else columns
         if not self.header:
-            df.columns = self.columns
+            df.columns = columns
         else:
-            if not list(df.columns.values) == self.columns:
-                print(df.columns.values, self.columns)
+            if not list(df.columns.values) == columns:
+                print(df.columns.values, columns)
                 raise CsvParseError("metadata mismatch in {}".format(self.filepath))
 
-    def read_csv(self, chunksize=None):
+    def __get_projection(self, usecols, filters):
+        """
+        columns to return and columns to load, in file order.
+        columns that are only used in filters are loaded
+        and dropped after filtering.
+        """
+        if usecols is None:
+            return list(self.columns), list(self.columns)
+
+        missing = set(usecols) - set(self.columns)
+        if missing:
+            raise CsvInputError(
+                "columns {} not in {}".format(sorted(missing), self.filepath)
+            )
+
+        load = set(usecols)
+        if filters:
+            load |= get_filter_columns(filters)
+
+        columns = [col for col in self.columns if col in usecols]
+        load = [col for col in self.columns if col in load]
+        return columns, load
+
+    def read_arrow_table(self, usecols=None, filters=None):
+        """
+        reads a parquet file into an arrow table, filters are
+        pushed down to the parquet reader so row groups that
+        can't match are skipped.
+        :param usecols: columns to read, all columns if None
+        :type usecols: list
+        :param filters: filters in the pyarrow format
+        :type filters: list
+        :return: pyarrow table
+        """
+        if not self.format == 'parquet':
+            raise CsvInputError("{} is not a parquet file".format(self.filepath))
+
+        columns, _ = self.__get_projection(usecols, filters)
+
+        dataset = pa_dataset.dataset(self.filepath, format='parquet')
+        expression = pq.filters_to_expression(filters) if filters else None
+
+        return dataset.to_table(columns=columns, filter=expression)
+
+    def __read_parquet(self, chunksize, usecols, filters):
+        columns, _ = self.__get_projection(usecols, filters)
+
+        dataset = pa_dataset.dataset(self.filepath, format='parquet')
+        expression = pq.filters_to_expression(filters) if filters else None
+
+        if not chunksize:
+            table = dataset.to_table(columns=columns, filter=expression)
+            return table.to_pandas()
+
+        def return_gen(batches):
+            for batch in batches:
+                yield batch.to_pandas()
+
+        return return_gen(
+            dataset.to_batches(
+                columns=columns, filter=expression, batch_size=chunksize
+            )
+        )
+
+    def read_csv(self, chunksize=None, usecols=None, filters=None):
+        """
+        reads the file into a dataframe
+        :param chunksize: return an iterator over dataframes
+        with chunksize rows if set
+        :type chunksize: int
+        :param usecols: columns to read, all columns if None
+        :type usecols: list
+        :param filters: only return rows that match, see get_filter_mask
+        :type filters: list
+        """
+        if self.format == 'parquet':
+            return self.__read_parquet(chunksize, usecols, filters)
+
+        columns, load = self.__get_projection(usecols, filters)
+
+        def select(df):
+            self.__verify_data(df, load)
+            if filters:
+                df = df[get_filter_mask(df, filters)]
+            if not load == columns:
+                df = df[columns]
+            return df
+
         def return_gen(df_iterator):
             for df in df_iterator:
-                self.__verify_data(df)
-                yield df
+                yield select(df)
 
-        dtypes = {k: v for k, v in self.dtypes.items() if v != "NA"}
+        dtypes = {k: v for k, v in self.dtypes.items() if v != "NA" and k in load}
         # if header exists then use first line (0) as header
         header = 0 if self.header else None
+        names = None if self.header else self.columns
+        usecols = None if load == self.columns else load
 
         try:
             data = pd.read_csv(
                 self.filepath, compression=self.compression, chunksize=chunksize,
-                sep=self.sep, header=header, dtype=dtypes
+                sep=self.sep, header=header, dtype=dtypes, names=names,
+                usecols=usecols
             )
         except pd.errors.EmptyDataError:
-            data = pd.DataFrame(columns=self.columns)
+            data = pd.DataFrame(columns=load)
 
         if chunksize:
             return return_gen(data)
         else:
-            self.__verify_data(data)
-            return data
+            return select(data)
 
 
 class CsvOutput(object):
@@ -205,11 +629,16 @@ class CsvOutput(object):
         self.sep = sep
         self.dtypes = dtypes if dtypes else {}
         self.na_rep = na_rep
+        self.format = get_file_format(filepath)
 
     @property
     def yaml_file(self):
         return self.filepath + '.yaml'
 
+    @property
+    def is_parquet(self):
+        return self.format == 'parquet'
+
     @property
     def header_line(self):
         return self.sep.join(self.columns) + '\n'
@@ -234,21 +663,22 @@ class CsvOutput(object):
             return None
 
     def __write_yaml(self):
-
-        yamldata = {'header': self.header, 'sep': self.sep, 'columns': []}
-
-        for column in self.columns:
-            data = {'name': column, 'dtype': self.dtypes[column]}
-            yamldata['columns'].append(data)
-
-        with helpers.GetFileHandle(self.yaml_file, 'wt') as f:
-            yaml.safe_dump(yamldata, f, default_flow_style=False)
+        write_metadata(
+            self.yaml_file, self.header, self.sep, self.columns, self.dtypes
+        )
 
     def write_df(self, df):
         if self.columns:
             if not self.columns == df.columns.values:
                 raise CsvWriterError("Writer initialized with wrong col names")
 
+        self.columns = list(df.columns.values)
+        self.dtypes = get_dtypes_from_df(df)
+
+        if self.is_parquet:
+            self.write_arrow_table(pa.Table.from_pandas(df, preserve_index=False))
+            return
+
         header = df.columns.values if self.header else False
         compression = self.__get_compression_type_pandas()
         df.to_csv(
@@ -256,8 +686,55 @@ class CsvOutput(object):
             index=False, header=header, compression=compression
         )
 
-        self.columns = list(df.columns.values)
-        self.dtypes = get_dtypes_from_df(df)
+        self.__write_yaml()
+
+    def write_arrow_table(self, table):
+        """
+        writes an arrow table to parquet, cast to the dtypes
+        in the yaml metadata so that readers see the same types
+        as they would from the csv.
+        :param table: pyarrow table
+        """
+        if not self.is_parquet:
+            raise CsvWriterError("{} is not a parquet file".format(self.filepath))
+
+        if not self.columns:
+            self.columns = list(table.schema.names)
+        if not self.dtypes:
+            self.dtypes = get_dtypes_from_arrow_schema(table.schema)
+
+        table = table.select(self.columns)
+        table = table.cast(
+            get_arrow_schema(self.columns, self.dtypes, schema=table.schema)
+        )
+        pq.write_table(table, self.filepath)
+
+        self.__write_yaml()
+
+    def concatenate_parquet_files(self, infiles):
+        """
+        concatenates parquet files one row group at a time,
+        data is never converted to pandas or text.
+        :param infiles: parquet files with the same columns
+        :type infiles: list
+        """
+        infiles = list(infiles)
+        for infile in infiles:
+            if not get_file_format(infile) == 'parquet':
+                raise CsvWriterError(
+                    "cannot concatenate {} into parquet".format(infile)
+                )
+
+        schema = get_arrow_schema(
+            self.columns, self.dtypes, schema=pq.read_schema(infiles[0])
+        )
+
+        with pq.ParquetWriter(self.filepath, schema) as writer:
+            for infile in infiles:
+                reader = pq.ParquetFile(infile)
+                for i in range(reader.num_row_groups):
+                    table = reader.read_row_group(i, columns=self.columns)
+                    writer.write_table(table.cast(schema))
 
         self.__write_yaml()
 
@@ -278,15 +755,24 @@ class CsvOutput(object):
             for line in reader:
                 writer.write(line)
 
-    def concatenate_files(self, infiles):
+    def concatenate_files(self, infiles, ncores=1):
+        """
+        concatenates headerless files, gzip inputs are
+        appended without recompression if the output is gzipped
+        :param infiles: headerless input files
+        :type infiles: list
+        :param ncores: threads used if data needs to be recompressed
+        :type ncores: int
+        """
+        if self.is_parquet:
+            self.concatenate_parquet_files(infiles)
+            return
+
         header = self.header_line if self.header else None
 
-        with helpers.GetFileHandle(self.filepath, 'wt') as writer:
-            if header:
-                writer.write(header)
-            for infile in infiles:
-                with helpers.GetFileHandle(infile) as reader:
-                    self.write_csv_data(reader, writer)
+        helpers.concatenate_files(
+            infiles, self.filepath, header=header, ncores=ncores
+        )
 
         self.__write_yaml()
 
@@ -326,10 +812,55 @@ def annotate_csv(infile, annotation_data, outfile, on="cell_id", write_header=Tr
     output.write_df(metrics_df)
 
 
+def concatenate_parquet(in_filenames, out_filename, key_column=None):
+    """
+    concatenates parquet files as arrow tables, columns are
+    cast to the most general dtype across all inputs.
+    :param in_filenames: dict with key and parquet file
+    :type in_filenames: dict
+    :param out_filename: output parquet file
+    :type out_filename: str
+    :param key_column: add a column with the input key if set
+    :type key_column: str
+    """
+    tables = []
+    for key, in_filename in in_filenames.items():
+        table = CsvInput(in_filename).read_arrow_table()
+
+        if key_column is not None:
+            keys = pa.array([str(key)] * table.num_rows, type=pa.string())
+            if key_column in table.schema.names:
+                index = table.schema.get_field_index(key_column)
+                table = table.set_column(index, key_column, keys)
+            else:
+                table = table.append_column(key_column, keys)
+        tables.append(table)
+
+    columns = list(tables[0].schema.names)
+    dtypes = merge_dtypes(
+        [get_dtypes_from_arrow_schema(table.schema) for table in tables]
+    )
+    schema = get_arrow_schema(columns, dtypes, schema=tables[0].schema)
+
+    for table in tables:
+        if not list(table.schema.names) == columns:
+            raise CsvWriterError("mismatched columns in {}".format(in_filenames))
+
+    data = pa.concat_tables([table.cast(schema) for table in tables])
+
+    csvoutput = CsvOutput(out_filename, columns=columns, dtypes=dtypes)
+    csvoutput.write_arrow_table(data)
+
+
 def concatenate_csv(in_filenames, out_filename, key_column=None, write_header=True):
     if not isinstance(in_filenames, dict):
         in_filenames = dict(enumerate(in_filenames))
 
+    formats = set(get_file_format(in_filename) for in_filename in in_filenames.values())
+    if formats == {'parquet'} and get_file_format(out_filename) == 'parquet':
+        concatenate_parquet(in_filenames, out_filename, key_column=key_column)
+        return
+
     data = []
     sep = None
 
@@ -352,8 +883,6 @@ def concatenate_csv(in_filenames, out_filename, key_column=None, write_header=Tr
 
 
 def extrapolate_types_from_yaml_files(csv_files):
-    precedence = ['str', 'float', 'int', 'bool', 'NA']
-
     csv_metadata = [CsvInput(csv_file) for csv_file in csv_files]
 
     header = set([val.header for val in csv_metadata])
@@ -368,35 +897,45 @@ def extrapolate_types_from_yaml_files(csv_files):
     assert len(cols) == 1, 'mismatched yaml files'
     cols = list(cols)[0]
 
-    dtypes = [val.dtypes for val in csv_metadata]
-
-    merged_dtypes = {}
-    for dtype_val in dtypes:
-        for col, dtype in dtype_val.items():
-            if col not in merged_dtypes:
-                merged_dtypes[col] = dtype
-            else:
-                og_index = precedence.index(merged_dtypes[col])
-                new_index = precedence.index(dtype)
-                if new_index < og_index:
-                    merged_dtypes[col] = dtype
+    merged_dtypes = merge_dtypes([val.dtypes for val in csv_metadata])
 
     return header, sep, cols, merged_dtypes
 
 
-def concatenate_csv_files_quick_lowmem(inputfiles, output, write_header=True):
+def concatenate_csv_files_quick_lowmem(inputfiles, output, write_header=True, ncores=1):
     if isinstance(inputfiles, dict):
         inputfiles = inputfiles.values()
 
     header, sep, cols, dtypes = extrapolate_types_from_yaml_files(inputfiles)
 
-    if header:
-        raise CsvInputError("Attempting to concatenate files with header.")
-
     csvoutput = CsvOutput(
-        output, header=write_header, sep=sep, columns=cols, dtypes=dtypes
+        output, header=write_header, sep=sep, columns=list(cols), dtypes=dtypes
     )
-    csvoutput.concatenate_files(inputfiles)
+
+    # parquet files always carry column names
+    if header and not csvoutput.is_parquet:
+        raise CsvInputError("Attempting to concatenate files with header.")
+
+    csvoutput.concatenate_files(inputfiles, ncores=ncores)
+
+
+def convert_csv(infile, outfile, header=True, sep=None):
+    """
+    rewrites a file in the format of the output
+    file extension, for conversions between csv and parquet
+    :param infile: input csv or parquet file
+    :type infile: str
+    :param outfile: output csv or parquet file
+    :type outfile: str
+    :param header: write header to csv output
+    :type header: bool
+    :param sep: input separator, detected if None
+    :type sep: str
+    """
+    csvinput = CsvInput(infile, sep=sep)
+
+    csvoutput = CsvOutput(outfile, header=header, sep=csvinput.sep)
+    csvoutput.write_df(csvinput.read_csv())
 
 
 def prep_csv_files(filepath, outputfile):
@@ -411,6 +950,10 @@ def prep_csv_files(filepath, outputfile):
     :param outputfile:
     :type outputfile:
     """
+    if 'parquet' in (get_file_format(filepath), get_file_format(outputfile)):
+        convert_csv(filepath, outputfile, header=False)
+        return
+
     csvinput = CsvInput(filepath)
 
     if csvinput.header is None:
@@ -425,6 +968,10 @@ def prep_csv_files(filepath, outputfile):
 
 
 def finalize_csv(infile, outfile, sep=None):
+    if 'parquet' in (get_file_format(infile), get_file_format(outfile)):
+        convert_csv(infile, outfile, header=True, sep=sep)
+        return
+
     csvinput = CsvInput(infile, sep=sep)
 
     csvoutput = CsvOutput(
@@ -457,16 +1004,20 @@ def merge_csv(in_filenames, out_filename, how, on, nan_val='NA', suffixes=None,
             sep = csvinput.sep
         assert sep == csvinput.sep
 
+    csvoutput = CsvOutput(out_filename, header=write_header, sep=sep)
+
     if not data:
         data = pd.DataFrame(columns=cols)
-        csvoutput = CsvOutput(out_filename, header=write_header, sep=sep)
         csvoutput.write_df(data)
         return
 
     data = merge_frames(data, how, on, suffixes=suffixes)
-    data = data.fillna(nan_val)
 
-    csvoutput = CsvOutput(out_filename, header=write_header, sep=sep)
+    # parquet stores missing values natively, filling them
+    # with a string would turn numeric columns into str
+    if not csvoutput.is_parquet:
+        data = data.fillna(nan_val)
+
     csvoutput.write_df(data)
 
 
@@ -509,8 +1060,10 @@ def merge_frames(frames, how, on, suffixes=None):
         return merged_frame
 
 
-def read_csv_and_yaml(infile, chunksize=None):
-    return CsvInput(infile).read_csv(chunksize=chunksize)
+def read_csv_and_yaml(infile, chunksize=None, usecols=None, filters=None):
+    return CsvInput(infile).read_csv(
+        chunksize=chunksize, usecols=usecols, filters=filters
+    )
 
 
 def write_dataframe_to_csv_and_yaml(df, outfile, write_header=False, sep=','):
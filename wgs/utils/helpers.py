@@ -3,6 +3,8 @@ Created on Feb 19, 2018
 
 @author: dgrewal
 '''
+import array
+import bisect
 import collections
 import errno
 import gzip
@@ -11,7 +13,9 @@ import multiprocessing
 import os
 import re
 import shutil
+import struct
 import tarfile
+import zlib
 from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 
@@ -20,6 +24,15 @@ import yaml
 
 import wgs
 
+# max uncompressed bytes per bgzf block, same as htslib
+BGZF_BLOCK_SIZE = 0xff00
+
+# empty bgzf block that htslib expects at the end of the file
+BGZF_EOF = (
+    b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+    b'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+)
+
 
 class GetFileHandle(object):
     def __init__(self, filename, mode='rt'):
@@ -259,6 +272,43 @@ def run_in_parallel(worker, args, ncores=None):
     del pool
 
 
+def _unpack_and_run(worker_args):
+    worker, args = worker_args
+    return worker(*args)
+
+
+def run_in_process_pool(worker, args, ncores=None):
+    '''
+    runs worker once per item in args in a process pool
+    and returns the results in the same order as args.
+    worker must be a module level function so it can be pickled.
+    '''
+    args = list(args)
+
+    count = multiprocessing.cpu_count()
+
+    if ncores:
+        count = min(int(ncores), count)
+
+    count = max(1, min(count, len(args)))
+
+    if count == 1:
+        return [worker(*arg) for arg in args]
+
+    pool = multiprocessing.Pool(processes=count)
+
+    try:
+        results = pool.map(_unpack_and_run, [(worker, arg) for arg in args], chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
+
+
 def run_cmd(cmd, output=None):
     stdout = PIPE
     if output:
@@ -299,6 +349,242 @@ def copy_file(infile, output):
     shutil.copy(infile, output)
 
 
+def is_gzip_file(filepath):
+    with open(filepath, 'rb') as reader:
+        return reader.read(2) == b'\x1f\x8b'
+
+
+def compress_bgzf_block(data, level=6):
+    """
+    compresses up to BGZF_BLOCK_SIZE bytes into a single bgzf block,
+    a gzip member with the block size in the BC extra field
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+
+    # total block size - 1: 18 byte header, 8 byte footer
+    bsize = len(deflated) + 25
+
+    header = struct.pack(
+        '<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize
+    )
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+    return header + deflated + footer
+
+
+def compress_bgzf_blocks(data, level=6):
+    """
+    splits data into bgzf blocks and compresses them.
+    zlib releases the gil, so this can run in a thread pool.
+    :returns list of (compressed block, uncompressed size) tuples
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[start:start + BGZF_BLOCK_SIZE]
+        blocks.append((compress_bgzf_block(block, level=level), len(block)))
+    return blocks
+
+
+class ParallelBgzfWriter(object):
+    """
+    binary file object that writes bgzf, compressing batches of
+    blocks in a thread pool in the style of pigz. output is a valid
+    gzip file that htslib can index.
+    the compressed offset of every block is kept so that uncompressed
+    offsets from tell() can be turned into bgzf virtual offsets.
+    """
+
+    def __init__(self, filename, ncores=1, level=6, blocks_per_task=64):
+        self.filename = filename
+        self.level = level
+        self.chunksize = blocks_per_task * BGZF_BLOCK_SIZE
+
+        self.handle = open(filename, 'wb')
+
+        self.ncores = max(1, int(ncores or 1))
+        self.pool = ThreadPool(processes=self.ncores)
+        self.pending = collections.deque()
+
+        self.buffer = []
+        self.buffered = 0
+
+        # uncompressed bytes written so far
+        self.offset = 0
+
+        # compressed and uncompressed start of each block
+        self.compressed_offset = 0
+        self.block_offsets = array.array('Q')
+        self.block_uoffsets = array.array('Q')
+        self.uncompressed_offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.pool.terminate()
+            self.handle.close()
+        else:
+            self.close()
+
+    def tell(self):
+        return self.offset
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.offset += len(data)
+
+        if self.buffered >= self.chunksize:
+            self.__submit(final=False)
+
+    def __submit(self, final):
+        data = b''.join(self.buffer)
+
+        # keep the partial block at the end for the next batch
+        size = len(data) if final else len(data) - len(data) % BGZF_BLOCK_SIZE
+        self.buffer = [data[size:]] if size < len(data) else []
+        self.buffered = len(data) - size
+
+        if size:
+            self.pending.append(
+                self.pool.apply_async(
+                    compress_bgzf_blocks, (data[:size],), {'level': self.level}
+                )
+            )
+
+        # bound the memory held by compressed batches waiting to be written
+        while len(self.pending) > 2 * self.ncores:
+            self.write_blocks(self.pending.popleft().get())
+
+    def write_blocks(self, blocks):
+        for block, size in blocks:
+            self.block_offsets.append(self.compressed_offset)
+            self.block_uoffsets.append(self.uncompressed_offset)
+
+            self.handle.write(block)
+
+            self.compressed_offset += len(block)
+            self.uncompressed_offset += size
+
+    def get_virtual_offset(self, offset):
+        """
+        bgzf virtual offset for an uncompressed offset,
+        only valid once the data has been flushed
+        :param offset: uncompressed offset as returned by tell()
+        :returns compressed block start << 16 | offset within block
+        """
+        if offset >= self.uncompressed_offset:
+            assert offset == self.uncompressed_offset
+            return self.compressed_offset << 16
+
+        index = bisect.bisect_right(self.block_uoffsets, offset) - 1
+
+        within = offset - self.block_uoffsets[index]
+        return (self.block_offsets[index] << 16) | within
+
+    def flush(self):
+        self.__submit(final=True)
+        while self.pending:
+            self.write_blocks(self.pending.popleft().get())
+
+    def close(self):
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+        self.pool.close()
+        self.pool.join()
+
+
+def get_binary_reader(filepath):
+    if is_gzip_file(filepath):
+        return gzip.open(filepath, 'rb')
+    return open(filepath, 'rb')
+
+
+def get_binary_writer(filepath, ncores=1):
+    if GetFileHandle(filepath).get_file_format(filepath) == 'gzip':
+        return ParallelBgzfWriter(filepath, ncores=ncores)
+    return open(filepath, 'wb')
+
+
+def copy_gzip_members(infile, writer):
+    """
+    appends the compressed bytes of infile to writer, dropping
+    the bgzf eof block so that it only appears at the end
+    """
+    size = os.path.getsize(infile)
+
+    with open(infile, 'rb') as reader:
+        if size >= len(BGZF_EOF):
+            reader.seek(size - len(BGZF_EOF))
+            if reader.read() == BGZF_EOF:
+                size -= len(BGZF_EOF)
+            reader.seek(0)
+
+        while size:
+            data = reader.read(min(size, 16 * 1024 * 1024))
+            if not data:
+                break
+            writer.write(data)
+            size -= len(data)
+
+
+def concatenate_files(
+        infiles, output, header=None, skip_header_prefixes=None, ncores=1
+):
+    """
+    concatenates plain or gzipped text files.
+    gzip inputs are appended byte for byte when the output is gzipped
+    and no lines need to be removed, since concatenated gzip members
+    are a valid gzip file. otherwise inputs are copied in blocks,
+    recompressing in parallel if the output is gzipped.
+    :param infiles: input files
+    :param output: output file, gzipped if it ends in .gz
+    :param header: text to write at the top of the output
+    :param skip_header_prefixes: tuple of prefixes, leading
+    lines in each input that start with one are skipped
+    :param ncores: threads for compression
+    """
+    infiles = list(infiles)
+
+    if header is not None:
+        header = header.encode()
+
+    output_gzip = GetFileHandle(output).get_file_format(output) == 'gzip'
+
+    if output_gzip and not skip_header_prefixes and all(
+            is_gzip_file(infile) for infile in infiles
+    ):
+        with open(output, 'wb') as writer:
+            if header:
+                for block, _ in compress_bgzf_blocks(header):
+                    writer.write(block)
+            for infile in infiles:
+                copy_gzip_members(infile, writer)
+            writer.write(BGZF_EOF)
+        return
+
+    if skip_header_prefixes:
+        skip_header_prefixes = tuple(
+            prefix.encode() for prefix in skip_header_prefixes
+        )
+
+    with get_binary_writer(output, ncores=ncores) as writer:
+        if header:
+            writer.write(header)
+        for infile in infiles:
+            with get_binary_reader(infile) as reader:
+                if skip_header_prefixes:
+                    for line in reader:
+                        if not line.startswith(skip_header_prefixes):
+                            writer.write(line)
+                            break
+                shutil.copyfileobj(reader, writer, length=16 * 1024 * 1024)
+
+
 def get_instrument_info(fastqs_file):
     data = load_yaml(fastqs_file)
 
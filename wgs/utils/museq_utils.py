@@ -140,14 +140,17 @@ def run_museq_one_job(
     merge_tempdir = os.path.join(tempdir, 'museq_merge')
     helpers.makedirs(merge_tempdir)
     temp_museq_vcf = os.path.join(merge_tempdir, 'temp_museq_merge.vcf')
-    merge_vcfs(vcf_files, temp_museq_vcf, merge_tempdir)
+    merge_vcfs(vcf_files, temp_museq_vcf, merge_tempdir, reference=reference)
 
     tumour_id = get_sample_id(tumour_bam)
     normal_id = get_sample_id(normal_bam)
     update_header_sample_ids(temp_museq_vcf, museq_vcf, tumour_id, normal_id)
 
-def merge_vcfs(inputs, outfile, tempdir):
+def merge_vcfs(inputs, outfile, tempdir, reference=None):
     helpers.makedirs(tempdir)
     mergedfile = os.path.join(tempdir, 'merged.vcf')
     vcfutils.concatenate_vcf(inputs, mergedfile)
-    vcfutils.sort_vcf(mergedfile, outfile)
+    vcfutils.sort_vcf(
+        mergedfile, outfile, reference=reference,
+        tempdir=os.path.join(tempdir, 'sort')
+    )
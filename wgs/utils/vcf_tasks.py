@@ -12,6 +12,7 @@ import pypeliner
 import shutil
 # import time
 import vcf
+from wgs.utils import vcfutils
 
 # from components_utils import flatten_input
 
@@ -89,21 +90,23 @@ def index_bcf(in_file):
     pypeliner.commandline.execute('bcftools', 'index', in_file)
 
 
-def finalise_vcf(in_file, compressed_file):
-    """ Compress a VCF using bgzip and create index.
+def finalise_vcf(in_file, compressed_file, ncores=1, reference=None, tempdir=None):
+    """ Sort, compress and index a VCF in a single pass.
 
     :param in_file: Path of file to compressed and index.
 
     :param out_file: Path where compressed file will be written. Index file will written to `out_file` + `.tbi` and `out_file` + `.csi` and .
 
-    """
-    uncompressed_file = compressed_file + '.uncompressed'
-    pypeliner.commandline.execute('vcf-sort', in_file, '>', uncompressed_file)
-    pypeliner.commandline.execute('bgzip', uncompressed_file, '-c', '>', compressed_file)
-    os.remove(uncompressed_file)
+    :param ncores: Number of threads used for bgzf compression.
+
+    :param reference: Reference fasta, contigs are sorted in .fai order.
+
+    :param tempdir: Directory for sorted runs of large files.
 
-    index_bcf(compressed_file)
-    index_vcf(compressed_file)
+    """
+    vcfutils.finalise_vcf(
+        in_file, compressed_file, ncores=ncores, reference=reference, tempdir=tempdir
+    )
 
 
 def index_vcf(vcf_file):
@@ -285,11 +288,16 @@ def convert_vcf_to_hdf5(in_file, out_file, table_name, score_callback=None):
     hdf_store.close()
 
 
-def sort_vcf(in_file, out_file):
+def sort_vcf(in_file, out_file, reference=None, tempdir=None):
+    """ Sort a VCF by contig order and position.
 
-    pypeliner.commandline.execute(
-        'vcf-sort',
-        in_file,
-        '>',
-        out_file
-    )
+    :param in_file: Path of VCF file to sort.
+
+    :param out_file: Path where sorted VCF file will be written.
+
+    :param reference: Reference fasta, contigs are sorted in .fai order.
+
+    :param tempdir: Directory for sorted runs of large files.
+
+    """
+    vcfutils.sort_vcf(in_file, out_file, reference=reference, tempdir=tempdir)
@@ -3,12 +3,551 @@ Created on Feb 27, 2018
 
 @author: dgrewal
 '''
+import collections
+import functools
+import gzip
+import heapq
+import itertools
 import os
+import shutil
+import struct
+import tempfile
 import warnings
 
 import pypeliner
+import pysam
 from wgs.utils import helpers
 
+INTEGER = 'Integer'
+FLOAT = 'Float'
+FLAG = 'Flag'
+STRING = 'String'
+
+RESERVED_INFO_TYPES = {
+    'AA': STRING, 'AC': INTEGER, 'AF': FLOAT, 'AN': INTEGER, 'BQ': FLOAT,
+    'CIGAR': STRING, 'DB': FLAG, 'DP': INTEGER, 'END': INTEGER, 'H2': FLAG,
+    'H3': FLAG, 'MQ': FLOAT, 'MQ0': INTEGER, 'NS': INTEGER, 'SB': STRING,
+    'SOMATIC': FLAG, 'VALIDATED': FLAG, '1000G': FLAG, 'IMPRECISE': FLAG,
+    'NOVEL': FLAG, 'SVTYPE': STRING, 'SVLEN': INTEGER, 'CIPOS': INTEGER,
+    'CIEND': INTEGER, 'HOMLEN': INTEGER, 'HOMSEQ': STRING, 'BKPTID': STRING,
+    'MEINFO': STRING, 'METRANS': STRING, 'DGVID': STRING, 'DBVARID': STRING,
+    'DBRIPID': STRING, 'MATEID': STRING, 'PARID': STRING, 'EVENT': STRING,
+    'CILEN': INTEGER, 'DPADJ': INTEGER, 'CN': INTEGER, 'CNADJ': INTEGER,
+    'CICN': INTEGER, 'CICNADJ': INTEGER,
+}
+
+RESERVED_FORMAT_TYPES = {
+    'GT': STRING, 'DP': INTEGER, 'FT': STRING, 'GL': FLOAT, 'GLE': STRING,
+    'PL': INTEGER, 'GP': FLOAT, 'GQ': INTEGER, 'HQ': INTEGER, 'PS': INTEGER,
+    'PQ': INTEGER, 'EC': INTEGER, 'MQ': INTEGER, 'CN': INTEGER, 'CNQ': FLOAT,
+    'CNL': FLOAT, 'NQ': INTEGER, 'HAP': INTEGER, 'AHAP': INTEGER,
+}
+
+SINGULAR_METADATA = ['fileformat', 'fileDate', 'reference']
+
+FIELD_COUNTS = {'.': None, 'A': -1, 'G': -2, 'R': -3}
+
+MISSING_VALUES = ('.', '', 'NA')
+
+VcfField = collections.namedtuple('VcfField', ['id', 'num', 'type', 'desc'])
+
+# tbx_conf_vcf in htslib: vcf format, chrom in column 1, pos in column 2
+TBX_VCF = 2
+TBX_VCF_META = (TBX_VCF, 1, 2, 0, ord('#'), 0)
+
+# binning scheme of tabix and of csi indexes written by bcftools index
+TBI_MIN_SHIFT, TBI_DEPTH = 14, 5
+CSI_MIN_SHIFT, CSI_DEPTH = 14, 6
+
+# bytes of record text held in memory by the external sort before
+# a sorted run is spilled to disk
+SORT_BUFFER_SIZE = 2 ** 29
+
+
+def _parse_meta_hash(value):
+    '''
+    parse the <key=value,...> part of a structured header line,
+    values can be quoted and contain commas.
+
+    :param value: text between the angle brackets
+    :return: OrderedDict of key value pairs
+    '''
+    items = collections.OrderedDict()
+
+    key = ''
+    val = ''
+    state = 0
+    for char in value:
+        if state == 0:
+            if char == '=':
+                state = 1
+            else:
+                key += char
+        elif state == 1:
+            if val == '' and char == '"':
+                state = 2
+            elif char == ',':
+                items[key] = val
+                key = ''
+                val = ''
+                state = 0
+            else:
+                val += char
+        else:
+            if char == '"':
+                state = 1
+            else:
+                val += char
+
+    if key:
+        items[key] = val
+
+    return items
+
+
+def _map_values(func, values):
+    return [func(val) if val not in MISSING_VALUES else None for val in values]
+
+
+def _parse_filter(value):
+    if value == '.':
+        return None
+    elif value == 'PASS':
+        return []
+    return value.split(';')
+
+
+def _convert_values(values, vartype):
+    values = values.split(',')
+
+    if vartype == INTEGER:
+        try:
+            return _map_values(int, values)
+        except ValueError:
+            return _map_values(float, values)
+    elif vartype == FLOAT:
+        return _map_values(float, values)
+
+    return values
+
+
+def _get_flag_value(value):
+    return True
+
+
+def _get_string_value(value):
+    value = value.split(',', 1)[0]
+    return value if value not in MISSING_VALUES else None
+
+
+def _get_string_values(value):
+    return [val if val not in MISSING_VALUES else None for val in value.split(',')]
+
+
+def _get_typed_value(value, vartype):
+    return _convert_values(value, vartype)[0]
+
+
+def _parse_sample_value(key, num, vartype, value):
+    if key == 'GT':
+        return value
+    elif key == 'FT':
+        return _parse_filter(value)
+    elif value == '' or value == '.':
+        return None
+    elif num == 1:
+        if vartype == INTEGER:
+            try:
+                return int(value)
+            except ValueError:
+                return float(value)
+        elif vartype == FLOAT:
+            return float(value)
+        return value
+
+    return _convert_values(value, vartype)
+
+
+class VcfRecord(object):
+    '''
+    a single vcf line. columns are split once, everything else
+    (info, per sample data) is parsed on first access. values follow
+    pyvcf conventions: ALT is [None] for '.', FILTER is None for '.'
+    and [] for PASS, QUAL is an int or float and fields with Number=1
+    are scalars while all others are lists.
+    '''
+    __slots__ = ('row', 'header', '_info')
+
+    def __init__(self, line, header):
+        self.row = line.rstrip().split('\t')
+        self.header = header
+        self._info = None
+
+    @property
+    def CHROM(self):
+        return self.row[0]
+
+    @property
+    def POS(self):
+        return int(self.row[1])
+
+    @property
+    def ID(self):
+        value = self.row[2]
+        return None if value == '.' else value
+
+    @property
+    def REF(self):
+        return self.row[3]
+
+    @property
+    def ALT(self):
+        return [None if alt == '.' else alt for alt in self.row[4].split(',')]
+
+    @property
+    def QUAL(self):
+        qual = self.row[5]
+        try:
+            return int(qual)
+        except ValueError:
+            try:
+                return float(qual)
+            except ValueError:
+                return None
+
+    @property
+    def FILTER(self):
+        return _parse_filter(self.row[6])
+
+    @property
+    def INFO(self):
+        if self._info is None:
+            self._info = self.header.parse_info(self.row[7])
+        return self._info
+
+    @property
+    def FORMAT(self):
+        if len(self.row) < 9 or self.row[8] == '.':
+            return None
+        return self.row[8]
+
+    def get_sample(self, index):
+        '''
+        parse the data for one sample
+
+        :param index: sample column index, see VcfReader.get_sample_index
+        :return: dict of format key to value
+        '''
+        return self.header.parse_sample(self.FORMAT, self.row[9 + index])
+
+    def get_sample_fields(self, index, keys):
+        '''
+        parse only the requested fields for one sample. the position
+        of each key in the FORMAT column is resolved once per format string.
+
+        :param index: sample column index, see VcfReader.get_sample_index
+        :param keys: tuple of format keys
+        :return: tuple of values in the same order as keys, None if missing
+        '''
+        return self.header.parse_sample_fields(self.FORMAT, self.row[9 + index], keys)
+
+    def iter_samples(self):
+        '''
+        :return: generator of (sample name, sample data) in header order
+        '''
+        for index, sample in enumerate(self.header.samples):
+            yield sample, self.get_sample(index)
+
+
+class VcfReader(object):
+    '''
+    lightweight vcf reader backed by plain text or tabix (htslib) access.
+    the header is parsed once, records are returned as lazily
+    parsed VcfRecord objects.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        self.metadata = collections.OrderedDict()
+        self.infos = collections.OrderedDict()
+        self.formats = collections.OrderedDict()
+        self.filters = collections.OrderedDict()
+        self.contigs = collections.OrderedDict()
+        self.samples = []
+        self.sample_index = {}
+
+        self._info_cache = {}
+        self._format_cache = {}
+        self._fields_cache = {}
+        self._records = None
+        self._tabix = None
+
+        self._read_header()
+
+    def _open(self):
+        if self.filename.endswith('.gz'):
+            return gzip.open(self.filename, 'rt')
+        return open(self.filename, 'rt')
+
+    def _read_header(self):
+        with self._open() as reader:
+            for line in reader:
+                if line.startswith('##'):
+                    self._read_meta(line.rstrip()[2:])
+                elif line.startswith('#'):
+                    line = line.rstrip().split('\t')
+                    self.samples = line[9:]
+                    break
+                else:
+                    raise Exception('invalid header: missing #CHROM line in {}'.format(self.filename))
+
+        self.sample_index = {sample: i for i, sample in enumerate(self.samples)}
+
+    def _read_meta(self, line):
+        if '=' not in line:
+            self.metadata[line] = 'none'
+            return
+
+        key, value = line.split('=', 1)
+
+        if not value.startswith('<'):
+            if key in SINGULAR_METADATA:
+                self.metadata[key] = value
+            else:
+                self.metadata.setdefault(key, []).append(value)
+            return
+
+        items = _parse_meta_hash(value.strip('<>'))
+
+        if key in ('INFO', 'FORMAT'):
+            number = items.get('Number', '.')
+            number = FIELD_COUNTS[number] if number in FIELD_COUNTS else int(number)
+            field = VcfField(items['ID'], number, items.get('Type', STRING), items.get('Description'))
+            if key == 'INFO':
+                self.infos[field.id] = field
+            else:
+                self.formats[field.id] = field
+        elif key == 'FILTER':
+            self.filters[items['ID']] = items.get('Description')
+        elif key == 'contig':
+            self.contigs[items['ID']] = int(items['length']) if 'length' in items else None
+        else:
+            self.metadata.setdefault(key, []).append(items)
+
+    def get_sample_index(self, sample):
+        '''
+        :param sample: sample name in the #CHROM line
+        :return: index of the sample, for use with VcfRecord.get_sample
+        '''
+        try:
+            return self.sample_index[sample]
+        except KeyError:
+            raise Exception('sample {} not found in {}'.format(sample, self.filename))
+
+    def parse_info(self, info):
+        if info == '.':
+            return {}
+
+        data = {}
+        for entry in info.split(';'):
+            entry = entry.split('=', 1)
+            key = entry[0]
+
+            field = self.infos.get(key)
+            if field:
+                vartype = field.type
+            else:
+                vartype = RESERVED_INFO_TYPES.get(key, STRING if entry[1:] else FLAG)
+
+            if vartype == FLAG or len(entry) == 1:
+                data[key] = True
+                continue
+
+            value = _convert_values(entry[1], vartype)
+            if vartype == STRING:
+                value = [val if val not in MISSING_VALUES else None for val in value]
+
+            if field and field.num == 1:
+                value = value[0]
+
+            data[key] = value
+
+        return data
+
+    def _get_info_converter(self, key, has_value):
+        converter = self._info_cache.get((key, has_value))
+
+        if converter is None:
+            field = self.infos.get(key)
+            if field:
+                vartype = field.type
+            else:
+                vartype = RESERVED_INFO_TYPES.get(key, STRING if has_value else FLAG)
+            is_scalar = bool(field and field.num == 1)
+
+            if vartype == FLAG or not has_value:
+                converter = _get_flag_value
+            elif vartype == STRING and is_scalar:
+                converter = _get_string_value
+            elif vartype == STRING:
+                converter = _get_string_values
+            elif is_scalar:
+                converter = functools.partial(_get_typed_value, vartype=vartype)
+            else:
+                converter = functools.partial(_convert_values, vartype=vartype)
+
+            self._info_cache[(key, has_value)] = converter
+
+        return converter
+
+    def parse_info_fields(self, info, keys):
+        '''
+        parse only the requested info fields, values are
+        converted the same way as parse_info
+
+        :param info: info column
+        :param keys: tuple of info keys
+        :return: tuple of values in the same order as keys, None if missing
+        '''
+        if info == '.':
+            return tuple(None for _ in keys)
+
+        entries = {}
+        for entry in info.split(';'):
+            key, sep, value = entry.partition('=')
+            entries[key] = value if sep else None
+
+        values = []
+        for key in keys:
+            value = entries.get(key, entries)
+            if value is entries:
+                values.append(None)
+            else:
+                values.append(self._get_info_converter(key, value is not None)(value))
+
+        return tuple(values)
+
+    def _get_format_spec(self, fmt):
+        spec = self._format_cache.get(fmt)
+
+        if spec is None:
+            spec = []
+            for key in fmt.split(':'):
+                field = self.formats.get(key)
+                if field:
+                    spec.append((key, field.num, field.type))
+                else:
+                    spec.append((key, None, RESERVED_FORMAT_TYPES.get(key, STRING)))
+            self._format_cache[fmt] = spec
+
+        return spec
+
+    def parse_sample(self, fmt, sample):
+        if fmt is None:
+            return {}
+
+        spec = self._get_format_spec(fmt)
+
+        data = collections.OrderedDict((key, None) for key, _, _ in spec)
+
+        for (key, num, vartype), value in zip(spec, sample.split(':')):
+            data[key] = _parse_sample_value(key, num, vartype, value)
+
+        return data
+
+    def _get_fields_spec(self, fmt, keys):
+        spec = self._fields_cache.get((fmt, keys))
+
+        if spec is None:
+            format_spec = self._get_format_spec(fmt)
+            positions = {key: i for i, (key, _, _) in enumerate(format_spec)}
+
+            spec = []
+            for key in keys:
+                if key in positions:
+                    position = positions[key]
+                    spec.append((position,) + format_spec[position])
+                else:
+                    spec.append((None, key, None, None))
+            self._fields_cache[(fmt, keys)] = spec
+
+        return spec
+
+    def parse_sample_fields(self, fmt, sample, keys):
+        if fmt is None:
+            return tuple(None for _ in keys)
+
+        values = sample.split(':')
+        nvalues = len(values)
+
+        return tuple(
+            _parse_sample_value(key, num, vartype, values[position])
+            if position is not None and position < nvalues else None
+            for position, key, num, vartype in self._get_fields_spec(fmt, keys)
+        )
+
+    def _iter_records(self):
+        with self._open() as reader:
+            for line in reader:
+                if line.startswith('#') or not line.strip():
+                    continue
+                yield VcfRecord(line, self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._records is None:
+            self._records = self._iter_records()
+        return next(self._records)
+
+    def fetch(self, chrom, start=None, end=None):
+        '''
+        iterate over records in a region of a tabix indexed vcf.
+        raises ValueError if the chromosome is not in the index.
+
+        :param chrom: chromosome name
+        :param start: 0 based start
+        :param end: 0 based, exclusive end
+        :return: iterator over VcfRecords
+        '''
+        if self._tabix is None:
+            self._tabix = pysam.TabixFile(self.filename, index=get_tabix_index(self.filename))
+
+        lines = self._tabix.fetch(chrom, start, end)
+
+        return (VcfRecord(line, self) for line in lines)
+
+
+def get_tabix_index(filename):
+    '''
+    :param filename: bgzf compressed vcf
+    :return: path to the .tbi or .csi index, None if there is neither
+    '''
+    for extension in ('.tbi', '.csi'):
+        if os.path.exists(filename + extension):
+            return filename + extension
+
+
+def get_indexed_contigs(filename):
+    '''
+    contigs in the tabix (.tbi or .csi) index of a bgzf vcf,
+    in the order they appear in the index
+
+    :param filename: bgzf compressed vcf
+    :return: list of contig names, None if the vcf is not indexed
+    '''
+    index = get_tabix_index(filename)
+    if index is None:
+        return None
+
+    try:
+        with pysam.TabixFile(filename, index=index) as tabix:
+            return list(tabix.contigs)
+    except (IOError, OSError, ValueError):
+        return None
+
 
 def _get_header(infile):
     '''
@@ -32,19 +571,27 @@ def _get_header(infile):
     return []
 
 
-def concatenate_vcf(infiles, outfile):
+def concatenate_vcf(infiles, outfile, index=False, ncores=1):
     '''
     Concatenate VCF files
 
     :param infiles: dictionary of input VCF files to be concatenated
     :param outfile: output VCF file
+    :param index: write bgzf output with tbi and csi indexes,
+    inputs must be sorted and in order
+    :param ncores: threads for bgzf compression
     '''
     if isinstance(infiles, dict):
         keys = infiles.keys()
         keys = sorted(keys)
         infiles = [infiles[val] for val in keys]
 
-    with helpers.GetFileHandle(outfile, 'w') as ofile:
+    if index:
+        ofile = IndexedVcfWriter(outfile, ncores=ncores)
+    else:
+        ofile = TextVcfWriter(outfile)
+
+    with ofile:
         header = None
 
         for ifile in infiles:
@@ -58,20 +605,580 @@ def concatenate_vcf(infiles, outfile):
                 if not header:
                     header = _get_header(f)
 
-                    for line in header:
-                        ofile.write(line)
+                    ofile.write_header(header)
                 else:
                     if not _get_header(f) == header:
                         warnings.warn('merging vcf files with mismatching headers')
 
                 for l in f:
-                    ofile.write(l)
+                    ofile.write_record(l)
 
 
-def sort_vcf(infile, outfile):
-    cmd = ['cat', infile, '|', 'vcf-sort', '>', outfile]
+def reg2bin(beg, end, min_shift, depth):
+    '''
+    smallest bin that contains the interval, hts_reg2bin in htslib
 
-    pypeliner.commandline.execute(*cmd)
+    :param beg: 0 based start
+    :param end: 0 based exclusive end
+    :param min_shift: log2 of the smallest bin size
+    :param depth: number of levels below the root bin
+    :return: bin number
+    '''
+    end -= 1
+    level = depth
+    shift = min_shift
+    first = ((1 << (3 * depth)) - 1) // 7
+    while level > 0:
+        if beg >> shift == end >> shift:
+            return first + (beg >> shift)
+        level -= 1
+        shift += 3
+        first -= 1 << (3 * level)
+    return 0
+
+
+def bin_first_window(bin, depth):
+    '''
+    first linear index window covered by a bin, hts_bin_bot in htslib
+    '''
+    level = 0
+    parent = bin
+    while parent:
+        level += 1
+        parent = (parent - 1) >> 3
+    first = ((1 << (3 * level)) - 1) // 7
+    return (bin - first) << ((depth - level) * 3)
+
+
+def get_meta_bin(depth):
+    '''
+    pseudo bin with the offsets and record counts of a contig
+    '''
+    return ((1 << (3 * depth + 3)) - 1) // 7 + 1
+
+
+def get_record_interval(line):
+    '''
+    0 based half open interval of a vcf record, as tabix sees it.
+    records with an END info field span up to END.
+
+    :param line: vcf record line
+    :return: tuple of chromosome, start and end
+    '''
+    fields = line.split('\t', 8)
+
+    chrom = fields[0]
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+
+    info = fields[7].rstrip('\n')
+    if 'END=' in info:
+        for value in info.split(';'):
+            if value.startswith('END='):
+                end = int(value[4:])
+                break
+
+    return chrom, beg, max(end, beg + 1)
+
+
+class _IndexedContig(object):
+    '''
+    bins and linear index of one contig, in uncompressed file offsets
+    '''
+
+    def __init__(self):
+        self.tbi_bins = collections.OrderedDict()
+        self.csi_bins = collections.OrderedDict()
+        self.linear = []
+
+        self.start = None
+        self.end = None
+        self.count = 0
+        self.last_pos = 0
+
+    @staticmethod
+    def _add_chunk(bins, bin, start, end):
+        chunks = bins.setdefault(bin, [])
+        # consecutive records in the same bin extend the last chunk
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+    def add(self, beg, end, start, stop):
+        self._add_chunk(
+            self.tbi_bins, reg2bin(beg, end, TBI_MIN_SHIFT, TBI_DEPTH), start, stop
+        )
+        self._add_chunk(
+            self.csi_bins, reg2bin(beg, end, CSI_MIN_SHIFT, CSI_DEPTH), start, stop
+        )
+
+        first_window = beg >> TBI_MIN_SHIFT
+        last_window = (end - 1) >> TBI_MIN_SHIFT
+        if len(self.linear) <= last_window:
+            self.linear.extend([None] * (last_window + 1 - len(self.linear)))
+        for window in range(first_window, last_window + 1):
+            if self.linear[window] is None:
+                self.linear[window] = start
+
+        if self.start is None:
+            self.start = start
+        self.end = stop
+        self.count += 1
+        self.last_pos = beg
+
+    def get_linear_index(self, get_virtual_offset):
+        '''
+        linear index with empty windows filled in from
+        the previous window, as in htslib
+        '''
+        linear = []
+        offset = get_virtual_offset(self.start)
+        for start in self.linear:
+            if start is not None:
+                offset = get_virtual_offset(start)
+            linear.append(offset)
+        return linear
+
+    def get_meta_chunks(self, get_virtual_offset):
+        return [
+            (get_virtual_offset(self.start), get_virtual_offset(self.end)),
+            (self.count, 0)
+        ]
+
+
+class TabixIndexer(object):
+    '''
+    builds tabix (.tbi) and csi indexes for a bgzf vcf from record
+    offsets collected while the file is written. offsets are kept
+    uncompressed and converted to bgzf virtual offsets once the
+    file is closed.
+    '''
+
+    def __init__(self):
+        self.contigs = collections.OrderedDict()
+        self.current = None
+
+    def add(self, chrom, beg, end, start, stop):
+        '''
+        :param chrom: chromosome
+        :param beg: 0 based start of the record
+        :param end: 0 based exclusive end of the record
+        :param start: uncompressed file offset of the record
+        :param stop: uncompressed file offset after the record
+        '''
+        if self.current is None or not self.current[0] == chrom:
+            if chrom in self.contigs:
+                raise Exception(
+                    'unable to index unsorted vcf, {} is not contiguous'.format(chrom)
+                )
+            self.current = (chrom, _IndexedContig())
+            self.contigs[chrom] = self.current[1]
+
+        contig = self.current[1]
+        if beg < contig.last_pos:
+            raise Exception(
+                'unable to index unsorted vcf, {}:{}'.format(chrom, beg + 1)
+            )
+
+        contig.add(beg, end, start, stop)
+
+    def _get_meta(self):
+        names = b''.join(name.encode() + b'\0' for name in self.contigs)
+        return struct.pack('<7i', *(TBX_VCF_META + (len(names),))) + names
+
+    @staticmethod
+    def _pack_chunks(chunks, get_virtual_offset):
+        return b''.join(
+            struct.pack('<QQ', get_virtual_offset(start), get_virtual_offset(end))
+            for start, end in chunks
+        )
+
+    @staticmethod
+    def _write_bgzf(filename, data):
+        with open(filename, 'wb') as writer:
+            for block, _ in helpers.compress_bgzf_blocks(data):
+                writer.write(block)
+            writer.write(helpers.BGZF_EOF)
+
+    def write_tbi(self, filename, get_virtual_offset):
+        data = [b'TBI\1', struct.pack('<i', len(self.contigs)), self._get_meta()]
+
+        meta_bin = get_meta_bin(TBI_DEPTH)
+
+        for contig in self.contigs.values():
+            data.append(struct.pack('<i', len(contig.tbi_bins) + 1))
+
+            for bin in sorted(contig.tbi_bins):
+                chunks = contig.tbi_bins[bin]
+                data.append(struct.pack('<Ii', bin, len(chunks)))
+                data.append(self._pack_chunks(chunks, get_virtual_offset))
+
+            data.append(struct.pack('<Ii', meta_bin, 2))
+            for chunk in contig.get_meta_chunks(get_virtual_offset):
+                data.append(struct.pack('<QQ', *chunk))
+
+            linear = contig.get_linear_index(get_virtual_offset)
+            data.append(struct.pack('<i', len(linear)))
+            data.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+
+        # no records without coordinates
+        data.append(struct.pack('<Q', 0))
+
+        self._write_bgzf(filename, b''.join(data))
+
+    def write_csi(self, filename, get_virtual_offset):
+        meta = self._get_meta()
+        data = [
+            b'CSI\1', struct.pack('<3i', CSI_MIN_SHIFT, CSI_DEPTH, len(meta)),
+            meta, struct.pack('<i', len(self.contigs))
+        ]
+
+        meta_bin = get_meta_bin(CSI_DEPTH)
+
+        for contig in self.contigs.values():
+            data.append(struct.pack('<i', len(contig.csi_bins) + 1))
+
+            linear = contig.get_linear_index(get_virtual_offset)
+
+            for bin in sorted(contig.csi_bins):
+                chunks = contig.csi_bins[bin]
+                window = bin_first_window(bin, CSI_DEPTH)
+                loffset = linear[window] if window < len(linear) else 0
+                data.append(struct.pack('<IQi', bin, loffset, len(chunks)))
+                data.append(self._pack_chunks(chunks, get_virtual_offset))
+
+            data.append(struct.pack('<IQi', meta_bin, 0, 2))
+            for chunk in contig.get_meta_chunks(get_virtual_offset):
+                data.append(struct.pack('<QQ', *chunk))
+
+        data.append(struct.pack('<Q', 0))
+
+        self._write_bgzf(filename, b''.join(data))
+
+
+class TextVcfWriter(object):
+    '''
+    writes vcf lines to a plain or gzipped text file
+    '''
+
+    def __init__(self, filename):
+        self.handle = helpers.GetFileHandle(filename, 'wt').handler
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_header(self, lines):
+        for line in lines:
+            self.handle.write(line)
+
+    def write_record(self, line):
+        self.handle.write(line)
+
+    def close(self):
+        self.handle.close()
+
+
+class IndexedVcfWriter(object):
+    '''
+    writes a sorted vcf as bgzf through a multi threaded block
+    compressor and builds the .tbi and .csi indexes in the same pass
+    '''
+
+    def __init__(self, filename, ncores=1):
+        self.filename = filename
+        self.writer = helpers.ParallelBgzfWriter(filename, ncores=ncores)
+        self.indexer = TabixIndexer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.writer.__exit__(exc_type, exc_val, exc_tb)
+        else:
+            self.close()
+
+    def write_header(self, lines):
+        for line in lines:
+            self.writer.write(line.encode())
+
+    def write_record(self, line):
+        if not line.endswith('\n'):
+            line += '\n'
+
+        chrom, beg, end = get_record_interval(line)
+
+        start = self.writer.tell()
+        self.writer.write(line.encode())
+        self.indexer.add(chrom, beg, end, start, self.writer.tell())
+
+    def close(self):
+        self.writer.close()
+        self.indexer.write_tbi(self.filename + '.tbi', self.writer.get_virtual_offset)
+        self.indexer.write_csi(self.filename + '.csi', self.writer.get_virtual_offset)
+
+
+def get_contig_order(reference=None, header=None):
+    '''
+    rank of each contig, from the reference .fai if available,
+    otherwise from the ##contig lines of the vcf header
+
+    :param reference: reference fasta, indexed with samtools faidx
+    :param header: list of vcf header lines
+    :return: dict of contig name to rank
+    '''
+    contigs = []
+
+    if reference:
+        with open(reference + '.fai') as fai:
+            contigs = [line.split('\t', 1)[0] for line in fai]
+    elif header:
+        for line in header:
+            if line.startswith('##contig=<'):
+                items = _parse_meta_hash(line.rstrip()[len('##contig='):].strip('<>'))
+                contigs.append(items['ID'])
+
+    return {contig: rank for rank, contig in enumerate(contigs)}
+
+
+def get_sort_key(contig_order=None, chrom_col=0, pos_col=1, sep='\t'):
+    '''
+    sort key for vcf or tsv lines. contigs are ordered by rank in
+    contig_order, contigs that are not in it come last ordered by
+    name. with no contig order this is the order vcf-sort writes by default.
+
+    :param contig_order: dict of contig name to rank
+    :param chrom_col: 0 based column of the chromosome
+    :param pos_col: 0 based column of the position
+    :param sep: column separator
+    :return: function that maps a line to its key
+    '''
+    contig_order = contig_order or {}
+    unknown = len(contig_order)
+    maxsplit = max(chrom_col, pos_col) + 1
+
+    def key(line):
+        fields = line.split(sep, maxsplit)
+        chrom = fields[chrom_col]
+        return contig_order.get(chrom, unknown), chrom, int(fields[pos_col])
+
+    return key
+
+
+def _write_sorted_run(records, key, tempdir):
+    records.sort(key=key)
+
+    fd, path = tempfile.mkstemp(dir=tempdir, suffix='.run')
+    with os.fdopen(fd, 'w') as writer:
+        writer.writelines(records)
+
+    return path
+
+
+def external_sort(records, key, tempdir=None, buffer_size=SORT_BUFFER_SIZE):
+    '''
+    sorts text records with a bounded memory budget. records are sorted
+    in runs of up to buffer_size bytes, runs are spilled to tempdir and
+    combined with a k-way heap merge. the sort is stable.
+
+    :param records: iterable over newline terminated lines
+    :param key: sort key function
+    :param tempdir: directory for sorted runs, a new temporary
+    directory is used if None
+    :param buffer_size: bytes of records to keep in memory
+    :return: generator over sorted lines
+    '''
+    cleanup = tempdir is None
+    if cleanup:
+        tempdir = tempfile.mkdtemp(suffix='_sort')
+    else:
+        helpers.makedirs(tempdir)
+
+    runs = []
+    try:
+        buffer = []
+        buffered = 0
+        for record in records:
+            if not record.endswith('\n'):
+                record += '\n'
+            buffer.append(record)
+            buffered += len(record)
+
+            if buffered >= buffer_size:
+                runs.append(_write_sorted_run(buffer, key, tempdir))
+                buffer = []
+                buffered = 0
+
+        if not runs:
+            # everything fit in memory
+            buffer.sort(key=key)
+            for record in buffer:
+                yield record
+            return
+
+        if buffer:
+            runs.append(_write_sorted_run(buffer, key, tempdir))
+            buffer = []
+
+        readers = [open(run) for run in runs]
+        try:
+            for record in heapq.merge(*readers, key=key):
+                yield record
+        finally:
+            for reader in readers:
+                reader.close()
+    finally:
+        for run in runs:
+            os.remove(run)
+        if cleanup:
+            shutil.rmtree(tempdir)
+
+
+def _read_vcf(infile):
+    '''
+    splits a vcf into header lines and a generator over records
+    '''
+    reader = helpers.GetFileHandle(infile).handler
+
+    header = []
+    for line in reader:
+        header.append(line)
+        if not line.startswith('##'):
+            break
+
+    if header and not header[-1].startswith('#'):
+        first = [header.pop()]
+    else:
+        first = []
+
+    def records():
+        try:
+            for line in itertools.chain(first, reader):
+                yield line
+        finally:
+            reader.close()
+
+    return header, records()
+
+
+def sort_vcf(
+        infile, outfile, reference=None, tempdir=None,
+        buffer_size=SORT_BUFFER_SIZE
+):
+    '''
+    sorts a vcf by contig order and position with an external merge sort
+
+    :param infile: input vcf, plain or gzipped
+    :param outfile: output vcf, plain or gzipped
+    :param reference: reference fasta, contigs are ordered as in its .fai.
+    header ##contig order is used if None.
+    :param tempdir: directory for sorted runs
+    :param buffer_size: bytes of records to keep in memory
+    '''
+    header, records = _read_vcf(infile)
+
+    key = get_sort_key(get_contig_order(reference=reference, header=header))
+
+    with TextVcfWriter(outfile) as writer:
+        writer.write_header(header)
+        for record in external_sort(records, key, tempdir=tempdir, buffer_size=buffer_size):
+            writer.write_record(record)
+
+
+def sort_tsv(
+        infile, outfile, reference=None, chrom_col=0, pos_col=1,
+        header=True, tempdir=None, buffer_size=SORT_BUFFER_SIZE
+):
+    '''
+    sorts a tab separated file by contig order and position
+    with an external merge sort
+
+    :param infile: input tsv, plain or gzipped
+    :param outfile: output tsv, plain or gzipped
+    :param reference: reference fasta, contigs are ordered as in its .fai.
+    contigs are ordered by name if None.
+    :param chrom_col: 0 based column of the chromosome
+    :param pos_col: 0 based column of the position
+    :param header: input starts with a header line
+    :param tempdir: directory for sorted runs
+    :param buffer_size: bytes of records to keep in memory
+    '''
+    key = get_sort_key(
+        get_contig_order(reference=reference), chrom_col=chrom_col, pos_col=pos_col
+    )
+
+    with helpers.GetFileHandle(infile) as reader:
+        with helpers.GetFileHandle(outfile, 'wt') as writer:
+            if header:
+                writer.write(reader.readline())
+            for record in external_sort(reader, key, tempdir=tempdir, buffer_size=buffer_size):
+                writer.write(record)
+
+
+def finalise_vcf(infile, outfile, ncores=1, reference=None, tempdir=None):
+    '''
+    sorts a vcf and writes it bgzf compressed with tabix and csi
+    indexes, in a single pass over the output
+
+    :param infile: input vcf, plain or gzipped
+    :param outfile: output bgzf vcf, indexes are written to
+    outfile.tbi and outfile.csi
+    :param ncores: threads for bgzf compression
+    :param reference: reference fasta, contigs are ordered as in its .fai.
+    header ##contig order is used if None.
+    :param tempdir: directory for sorted runs if the
+    vcf doesn't fit in the sort buffer
+    '''
+    header, records = _read_vcf(infile)
+
+    key = get_sort_key(get_contig_order(reference=reference, header=header))
+
+    with IndexedVcfWriter(outfile, ncores=ncores) as writer:
+        writer.write_header(header)
+        for record in external_sort(records, key, tempdir=tempdir):
+            writer.write_record(record)
+
+
+def pop_sorted_calls(buffer, pos=None):
+    '''
+    pop calls from a heap of (pos, vartype, key, seq, data) tuples.
+    only calls before pos are returned, all calls if pos is None.
+    callers push calls with a running seq number so that duplicate
+    keys keep their file order.
+
+    :param buffer: heap of calls
+    :param pos: position of the next record in the vcf
+    :return: generator of (pos, vartype, key, data)
+    '''
+    while buffer and (pos is None or buffer[0][0] < pos):
+        call_pos, vartype, key, _, data = heapq.heappop(buffer)
+        yield call_pos, vartype, key, data
+
+
+def merge_call_streams(streams):
+    '''
+    k-way merge of call streams from multiple callers.
+    each stream must be sorted by (pos, vartype, key), calls
+    with identical keys across streams are grouped together.
+    if a caller reports the same key more than once, the last call wins.
+
+    :param streams: dict of caller name to iterable of (pos, vartype, key, data)
+    :return: generator of (vartype, key, {caller: data})
+    '''
+    def tag(caller, stream):
+        for pos, vartype, key, data in stream:
+            yield pos, vartype, key, caller, data
+
+    tagged = [tag(caller, stream) for caller, stream in streams.items()]
+
+    merged = heapq.merge(*tagged, key=lambda call: call[:3])
+
+    for (_, vartype, key), calls in itertools.groupby(merged, key=lambda call: call[:3]):
+        yield vartype, key, {caller: data for _, _, _, caller, data in calls}
 
 
 def update_germline_header_sample_ids(infile, outfile, sample_id):
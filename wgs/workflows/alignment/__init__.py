@@ -234,41 +234,75 @@ def align_samples(
         kwargs={'picard_mem': picard_mem}
     )
 
-    workflow.transform(
-        name='merge_tumour_lanes',
-        ctx=helpers.get_default_ctx(
-            memory=10,
-            walltime='24:00',
-            disk=400
-        ),
-        func="wgs.workflows.alignment.tasks.merge_bams",
+    workflow.subworkflow(
+        name='process_aligned_lanes',
+        func=process_aligned_lanes,
         args=(
             mgd.TempInputFile('aligned_lanes.bam', 'lane_id'),
-            mgd.TempOutputFile('merged_lanes.bam', extensions=['.bai']),
-            mgd.TempSpace('merge_tumour_lanes_tempdir')
+            mgd.OutputFile(bam_outputs, extensions=['.bai']),
+            mgd.OutputFile(metrics_outputs, extensions=['.yaml']),
+            mgd.OutputFile(metrics_tar),
+            mgd.OutputFile(bam_tdf),
+            refdir,
+            sample_id
         ),
         kwargs={
-            'mem': picard_mem
+            'picard_mem': picard_mem,
+            'metrics_files': [
+                mgd.TempInputFile('fastqc_R1.html', 'lane_id'),
+                mgd.TempInputFile('fastqc_R1.pdf', 'lane_id'),
+                mgd.TempInputFile('fastqc_R2.html', 'lane_id'),
+                mgd.TempInputFile('fastqc_R2.pdf', 'lane_id'),
+            ]
         }
     )
 
+    return workflow
+
+
+def process_aligned_lanes(
+        lane_bams,
+        bam_outputs,
+        metrics_outputs,
+        metrics_tar,
+        bam_tdf,
+        refdir,
+        sample_id,
+        picard_mem=8,
+        metrics_files=None,
+):
+    '''
+    merges the aligned lanes, marks duplicates and collects metrics
+    :param lane_bams: lane_id:sorted bam dictionary
+    :param metrics_files: additional files to add to the metrics tar
+    '''
+    metrics_files = metrics_files if metrics_files else []
+
+    workflow = pypeliner.workflow.Workflow()
+
+    workflow.setobj(
+        obj=mgd.OutputChunks('lane_id'),
+        value=list(lane_bams.keys()),
+    )
+
+    # merges, marks duplicates and writes the bai in one streaming stage
     workflow.transform(
-        name='markdups',
+        name='merge_and_markdups',
         ctx=helpers.get_default_ctx(
-            memory=12,
-            walltime='24:00',
-            ncpus=1,
-            disk=300
+            memory=16,
+            walltime='48:00',
+            ncpus=8,
+            disk=400
         ),
-        func='wgs.workflows.alignment.tasks.markdups',
+        func='wgs.workflows.alignment.markdups.merge_and_markdup',
         args=(
-            mgd.TempInputFile('merged_lanes.bam', extensions=['.bai']),
+            mgd.InputFile('aligned_lanes.bam', 'lane_id', fnames=lane_bams),
             mgd.OutputFile(bam_outputs, extensions=['.bai']),
             mgd.TempOutputFile('markdups_metrics'),
-            pypeliner.managed.TempSpace("temp_markdups"),
         ),
         kwargs={
-            'mem': '{}G'.format(picard_mem),
+            'tempdir': mgd.TempSpace('merge_and_markdups_temp'),
+            'threads': 8,
         }
     )
 
@@ -306,11 +340,7 @@ def align_samples(
                 mgd.TempInputFile('picard_gc.pdf'),
                 mgd.TempInputFile('picard_wgs_metrics.txt'),
                 mgd.TempInputFile('markdups_metrics'),
-                mgd.TempInputFile('fastqc_R1.html', 'lane_id'),
-                mgd.TempInputFile('fastqc_R1.pdf', 'lane_id'),
-                mgd.TempInputFile('fastqc_R2.html', 'lane_id'),
-                mgd.TempInputFile('fastqc_R2.pdf', 'lane_id'),
-            ],
+            ] + metrics_files,
             mgd.TempSpace('wgs_metrics')
         )
     )
@@ -398,12 +428,28 @@ def align_sample_split(
 ):
     ref_genome = config.refdir_data(refdir)['paths']['reference']
 
-    split_size = config.default_params('alignment')['split_size']
+    params = config.default_params('alignment')
 
     out_bai = out_file + '.bai'
 
     workflow = pypeliner.workflow.Workflow()
 
+    workflow.transform(
+        name='get_split_size',
+        ctx=helpers.get_default_ctx(
+            memory=4,
+            walltime='04:00',
+        ),
+        func='wgs.workflows.alignment.tasks.get_split_size',
+        ret=pypeliner.managed.TempOutputObj('split_size'),
+        args=(
+            pypeliner.managed.InputFile(fastq_1),
+            params['cluster_slots'],
+            params['min_split_size'],
+            params['split_size'],
+        ),
+    )
+
     workflow.transform(
         name='split_fastq_1',
         ctx=helpers.get_default_ctx(
@@ -414,7 +460,7 @@ def align_sample_split(
         args=(
             pypeliner.managed.InputFile(fastq_1),
             pypeliner.managed.TempOutputFile('read_1', 'split'),
-            split_size,
+            pypeliner.managed.TempInputObj('split_size'),
         ),
     )
 
@@ -428,15 +474,17 @@ def align_sample_split(
         args=(
             pypeliner.managed.InputFile(fastq_2),
             pypeliner.managed.TempOutputFile('read_2', 'split', axes_origin=[]),
-            split_size,
+            pypeliner.managed.TempInputObj('split_size'),
         ),
     )
 
+    # alignments are piped straight into samtools sort,
+    # 1G per sort thread on top of the bwa index
     workflow.transform(
         name='align_bwa_mem',
         axes=('split',),
         ctx=helpers.get_default_ctx(
-            memory=8,
+            memory=16,
             walltime='16:00',
             ncpus=8,
         ),
@@ -445,31 +493,15 @@ def align_sample_split(
             pypeliner.managed.TempInputFile('read_1', 'split'),
             pypeliner.managed.TempInputFile('read_2', 'split'),
             ref_genome,
-            pypeliner.managed.TempOutputFile('aligned.bam', 'split'),
+            pypeliner.managed.TempOutputFile('sorted.bam', 'split'),
             '8',
             sample_info,
         ),
         kwargs={
             'sample_id': sample_id,
             'lane_id': lane_id,
-        }
-    )
-
-    workflow.transform(
-        name='sort',
-        axes=('split',),
-        ctx=helpers.get_default_ctx(
-            memory=4,
-            walltime='16:00',
-        ),
-        func='wgs.workflows.alignment.tasks.bam_sort',
-        args=(
-            pypeliner.managed.TempInputFile('aligned.bam', 'split'),
-            pypeliner.managed.TempOutputFile('sorted.bam', 'split'),
-            pypeliner.managed.TempSpace('bam_sort_by_split', 'split')
-        ),
-        kwargs={
-            'mem': '{}G'.format(picard_mem)
+            'sort_tempdir': pypeliner.managed.TempSpace('bam_sort_by_split', 'split'),
+            'sort_mem': '1G',
         }
     )
 
@@ -478,15 +510,16 @@ def align_sample_split(
         ctx=helpers.get_default_ctx(
             memory=8,
             walltime='72:00',
+            ncpus=8,
         ),
-        func="wgs.workflows.alignment.tasks.merge_bams",
+        func="wgs.workflows.alignment.tasks.samtools_merge_bams",
         args=(
             pypeliner.managed.TempInputFile('sorted.bam', 'split'),
             pypeliner.managed.OutputFile(out_file),
             pypeliner.managed.TempSpace('bam_merge_by_split')
         ),
         kwargs={
-            'mem': picard_mem
+            'threads': 8
         }
     )
 
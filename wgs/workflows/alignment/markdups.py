@@ -0,0 +1,600 @@
+'''
+merges coordinate sorted bams and marks duplicates with the rules of
+picard MarkDuplicates. a first streaming pass over the merged reads
+decides which reads are duplicates, groups of reads are resolved as
+soon as no later read can join them. mates waiting for a partner on a
+later chromosome are spilled to disk, the same as picard. a second
+pass writes the merged bam with the duplicate flags, compressed with
+multiple threads, and indexes it. metrics are written in the picard
+DuplicationMetrics format.
+'''
+import collections
+import heapq
+import math
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pysam
+from wgs.utils import helpers
+
+MIN_BASE_QUALITY = 15
+MAX_SCORE = 32767 // 2
+
+OPTICAL_DUPLICATE_PIXEL_DISTANCE = 100
+MAX_OPTICAL_DUPLICATE_SET_SIZE = 300000
+
+# largest distance between the unclipped 5' end of a read and its
+# alignment start, groups are resolved once reads start past this
+MAX_CLIP = 10000
+
+UNKNOWN_LIBRARY = 'Unknown Library'
+
+# mates waiting for a partner on another chromosome are
+# written to disk in batches of this many reads
+SPILL_BATCH_SIZE = 100000
+
+METRICS_COLUMNS = [
+    'LIBRARY', 'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED',
+    'SECONDARY_OR_SUPPLEMENTARY_RDS', 'UNMAPPED_READS',
+    'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES',
+    'READ_PAIR_OPTICAL_DUPLICATES', 'PERCENT_DUPLICATION',
+    'ESTIMATED_LIBRARY_SIZE'
+]
+
+
+def merge_headers(infiles):
+    '''
+    header of the first bam with the read groups and programs of
+    all bams, entries with the same id are combined
+    '''
+    header = None
+    for infile in infiles:
+        with pysam.AlignmentFile(infile, 'rb', check_sq=False) as bam:
+            bam_header = bam.header.to_dict()
+
+        if header is None:
+            header = bam_header
+            header.setdefault('HD', {'VN': '1.6'})['SO'] = 'coordinate'
+            continue
+
+        for key in ('RG', 'PG'):
+            ids = set(entry['ID'] for entry in header.get(key, []))
+            for entry in bam_header.get(key, []):
+                if entry['ID'] not in ids:
+                    header.setdefault(key, []).append(entry)
+                    ids.add(entry['ID'])
+
+    return header
+
+
+def _sort_key(read):
+    # unplaced reads (tid -1) sort last, same as samtools merge
+    tid = read.reference_id
+    return (tid if tid >= 0 else float('inf'), read.reference_start, read.is_reverse)
+
+
+def iter_merged_reads(infiles, threads=1):
+    '''
+    reads from all bams in coordinate order, ties in
+    the order of infiles
+    :param infiles: coordinate sorted bams
+    :param threads: decompression threads per bam
+    '''
+    bams = [
+        pysam.AlignmentFile(infile, 'rb', check_sq=False, threads=threads)
+        for infile in infiles
+    ]
+
+    try:
+        for read in heapq.merge(*bams, key=_sort_key):
+            yield read
+    finally:
+        for bam in bams:
+            bam.close()
+
+
+def get_unclipped_five_prime(read):
+    cigar = read.cigartuples
+
+    if read.is_reverse:
+        clip = 0
+        for op, length in reversed(cigar):
+            if op != 4 and op != 5:
+                break
+            clip += length
+        return read.reference_end + clip
+
+    clip = 0
+    for op, length in cigar:
+        if op != 4 and op != 5:
+            break
+        clip += length
+    return read.reference_start - clip
+
+
+def get_score(read):
+    '''
+    sum of the base qualities of at least MIN_BASE_QUALITY
+    '''
+    quals = read.query_qualities
+    if quals is None:
+        return 0
+
+    quals = np.frombuffer(quals, dtype=np.uint8)
+    return min(int(quals[quals >= MIN_BASE_QUALITY].sum()), MAX_SCORE)
+
+
+def get_physical_location(read_name):
+    '''
+    tile, x and y from illumina read names with 5 or 7 colon separated fields
+    '''
+    fields = read_name.split(':')
+
+    if len(fields) not in (5, 7):
+        return None
+
+    try:
+        return int(fields[-3]), int(fields[-2]), int(fields[-1])
+    except ValueError:
+        return None
+
+
+def _close_enough(lhs, rhs, distance):
+    return lhs[0] == rhs[0] and lhs[1] == rhs[1] and \
+        abs(lhs[2] - rhs[2]) <= distance and abs(lhs[3] - rhs[3]) <= distance
+
+
+def count_optical_duplicates(locations, keeper, distance=OPTICAL_DUPLICATE_PIXEL_DISTANCE):
+    '''
+    number of optical duplicates in a duplicate set, compares every read
+    to the keeper first and then to each other, same as picard
+    :param locations: (read group, tile, x, y) per read, None if unknown
+    :param keeper: index of the read that is kept
+    :param distance: max pixel distance between optical duplicates
+    '''
+    if len(locations) > MAX_OPTICAL_DUPLICATE_SET_SIZE:
+        return 0
+
+    flags = [False] * len(locations)
+
+    keeper_loc = locations[keeper]
+    if keeper_loc is not None:
+        for i, loc in enumerate(locations):
+            if i != keeper and loc is not None and _close_enough(keeper_loc, loc, distance):
+                flags[i] = True
+
+    for i, lhs in enumerate(locations):
+        if i == keeper or lhs is None:
+            continue
+        for j in range(i + 1, len(locations)):
+            rhs = locations[j]
+            if j == keeper or rhs is None or (flags[i] and flags[j]):
+                continue
+            if _close_enough(lhs, rhs, distance):
+                flags[i if flags[j] else j] = True
+
+    return sum(flags)
+
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    '''
+    lander waterman estimate of the number of unique
+    molecules in the library, same as picard
+    '''
+    duplicates = read_pairs - unique_read_pairs
+
+    if read_pairs <= 0 or duplicates <= 0:
+        return None
+
+    n = float(read_pairs)
+    c = float(unique_read_pairs)
+
+    def f(x):
+        return c / x - 1 + math.exp(-n / x)
+
+    lower = 1.0
+    upper = 100.0
+
+    if c >= n or f(lower * c) < 0:
+        raise Exception(
+            'Invalid values for pairs and unique pairs: {}, {}'.format(read_pairs, unique_read_pairs)
+        )
+
+    while f(upper * c) > 0:
+        upper *= 10.0
+
+    for _ in range(40):
+        r = (lower + upper) / 2.0
+        u = f(r * c)
+        if u == 0:
+            break
+        elif u > 0:
+            lower = r
+        else:
+            upper = r
+
+    return int(c * (lower + upper) / 2.0)
+
+
+class LibraryMetrics(object):
+    def __init__(self):
+        self.unpaired_reads = 0
+        self.paired_reads = 0
+        self.secondary_or_supplementary = 0
+        self.unmapped = 0
+        self.unpaired_duplicates = 0
+        self.paired_duplicates = 0
+        self.optical_duplicates = 0
+
+    def get_values(self):
+        pairs = self.paired_reads // 2
+        pair_duplicates = self.paired_duplicates // 2
+
+        examined = self.unpaired_reads + pairs * 2
+        percent = (self.unpaired_duplicates + pair_duplicates * 2) / float(examined) if examined else 0
+
+        library_size = estimate_library_size(
+            pairs - self.optical_duplicates, pairs - pair_duplicates
+        )
+
+        return [
+            self.unpaired_reads, pairs, self.secondary_or_supplementary,
+            self.unmapped, self.unpaired_duplicates, pair_duplicates,
+            self.optical_duplicates, percent, library_size
+        ]
+
+
+def _format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        value = '{:.6f}'.format(value).rstrip('0').rstrip('.')
+        return value if value else '0'
+    return str(value)
+
+
+def write_metrics(metrics, output, command=''):
+    '''
+    writes the duplication metrics per library in the picard format
+    :param metrics: library:LibraryMetrics dictionary
+    :param output: metrics file
+    :param command: command line recorded in the header
+    '''
+    rows = [[library] + metrics[library].get_values() for library in sorted(metrics)]
+
+    with open(output, 'wt') as writer:
+        writer.write('## htsjdk.samtools.metrics.StringHeader\n')
+        writer.write('# {}\n'.format(command))
+        writer.write('\n')
+        writer.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+        writer.write('\t'.join(METRICS_COLUMNS) + '\n')
+        for row in rows:
+            writer.write('\t'.join(_format_value(value) for value in row) + '\n')
+
+        # coverage multiple from sequencing more of the first library
+        if rows and rows[0][-1]:
+            library_size = rows[0][-1]
+            pairs = rows[0][2]
+            unique_pairs = pairs - rows[0][6]
+            writer.write('\n')
+            writer.write('## HISTOGRAM\tjava.lang.Double\n')
+            writer.write('BIN\tCoverageMult\n')
+            for x in range(1, 101):
+                mult = library_size * (1 - math.exp(-(x * pairs) / float(library_size))) / unique_pairs
+                writer.write('{:.1f}\t{}\n'.format(x, _format_value(mult)))
+
+        writer.write('\n')
+
+
+class PendingMates(object):
+    '''
+    first seen mates of pairs, keyed by read group and name. only mates
+    whose partner is on the current chromosome are kept in memory, the
+    others are spilled to a file per chromosome and loaded once the
+    reads reach it, same as picard's CoordinateSortedPairInfoMap
+    :param tempdir: directory for the spill files
+    '''
+
+    def __init__(self, tempdir):
+        self.tempdir = tempdir
+        self.tid = None
+        self.mates = {}
+        self.buffers = collections.defaultdict(list)
+        self.buffered = 0
+        self.spilled = set()
+        self.orphans = 0
+
+    def _get_spill_file(self, tid):
+        return os.path.join(self.tempdir, 'pending_mates_{}.pickle'.format(tid))
+
+    def _spill(self):
+        for tid, entries in self.buffers.items():
+            with open(self._get_spill_file(tid), 'ab') as writer:
+                pickle.dump(entries, writer, pickle.HIGHEST_PROTOCOL)
+            self.spilled.add(tid)
+        self.buffers.clear()
+        self.buffered = 0
+
+    def set_chromosome(self, tid):
+        '''
+        moves to the next chromosome, mates left from the previous one
+        never see their partner. loads the mates spilled for tid
+        '''
+        if tid == self.tid:
+            return
+
+        self.orphans += len(self.mates)
+        self.mates = {}
+        self.tid = tid
+
+        for key, entry in self.buffers.pop(tid, []):
+            self.mates[key] = entry
+
+        if tid in self.spilled:
+            self.spilled.remove(tid)
+            spill_file = self._get_spill_file(tid)
+            with open(spill_file, 'rb') as reader:
+                while True:
+                    try:
+                        entries = pickle.load(reader)
+                    except EOFError:
+                        break
+                    for key, entry in entries:
+                        self.mates[key] = entry
+            os.remove(spill_file)
+
+    def pop(self, key):
+        return self.mates.pop(key, None)
+
+    def add(self, key, mate_tid, entry):
+        '''
+        :param key: read group and read name
+        :param mate_tid: chromosome of the partner
+        :param entry: data kept until the partner is seen
+        '''
+        if mate_tid <= self.tid:
+            self.mates[key] = entry
+            return
+
+        self.buffers[mate_tid].append((key, entry))
+        self.buffered += 1
+        if self.buffered >= SPILL_BATCH_SIZE:
+            self._spill()
+
+    def __len__(self):
+        return len(self.mates) + self.buffered
+
+
+class DuplicateMarker(object):
+    '''
+    decides duplicates in a single pass over coordinate sorted reads.
+    reads are grouped by library, unclipped 5' position and strand,
+    pairs by both ends. groups are resolved once the reads have moved
+    MAX_CLIP past the group, the duplicate reads are kept as a bitset
+    of their position in the stream
+    :param header: merged header as a dictionary
+    :param tempdir: directory for mates spilled to disk
+    '''
+
+    def __init__(self, header, tempdir):
+        self.libraries = {
+            readgroup['ID']: readgroup.get('LB', UNKNOWN_LIBRARY)
+            for readgroup in header.get('RG', [])
+        }
+
+        self.metrics = collections.defaultdict(LibraryMetrics)
+
+        self.duplicates = bytearray()
+
+        self.fragments = {}
+        self.pairs = {}
+        self.pending_mates = PendingMates(tempdir)
+        self.ready = []
+
+    def get_library(self, readgroup):
+        return self.libraries.get(readgroup, UNKNOWN_LIBRARY)
+
+    def is_duplicate(self, index):
+        byte = index >> 3
+        return byte < len(self.duplicates) and bool(self.duplicates[byte] & (1 << (index & 7)))
+
+    def mark_duplicate(self, index):
+        byte = index >> 3
+        if byte >= len(self.duplicates):
+            self.duplicates.extend(bytes(max(byte + 1 - len(self.duplicates), 1 << 20)))
+        self.duplicates[byte] |= 1 << (index & 7)
+
+    def add_to_group(self, groups, kind, key, ready_at, entry):
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [entry]
+            heapq.heappush(self.ready, (ready_at[0], ready_at[1] + MAX_CLIP, kind, key))
+        else:
+            group.append(entry)
+
+    def add_read(self, read, index):
+        '''
+        :param read: pysam aligned segment
+        :param index: position of the read in the merged stream
+        '''
+        flag = read.flag
+        readgroup = read.get_tag('RG') if read.has_tag('RG') else None
+        library = self.get_library(readgroup)
+        metrics = self.metrics[library]
+
+        if flag & 0x900:
+            metrics.secondary_or_supplementary += 1
+            return
+
+        if flag & 0x4:
+            metrics.unmapped += 1
+            return
+
+        paired = bool(flag & 0x1) and not flag & 0x8
+        if paired:
+            metrics.paired_reads += 1
+        else:
+            metrics.unpaired_reads += 1
+
+        tid = read.reference_id
+        start = read.reference_start
+        self.resolve_ready(tid, start)
+        self.pending_mates.set_chromosome(tid)
+
+        coord = get_unclipped_five_prime(read)
+        if coord + MAX_CLIP < start:
+            raise Exception(
+                'read {} is clipped by more than {} bases'.format(read.query_name, MAX_CLIP)
+            )
+
+        reverse = bool(flag & 0x10)
+        score = get_score(read)
+
+        self.add_to_group(
+            self.fragments, 0, (library, tid, coord, reverse), (tid, coord),
+            (score, index, paired)
+        )
+
+        if not paired:
+            return
+
+        name_key = (readgroup, read.query_name)
+        mate = self.pending_mates.pop(name_key)
+        if mate is None:
+            self.pending_mates.add(
+                name_key, read.next_reference_id, (tid, coord, reverse, score, index)
+            )
+            return
+
+        mate_tid, mate_coord, mate_reverse, mate_score, mate_index = mate
+
+        if (tid, coord) >= (mate_tid, mate_coord):
+            key = (library, mate_tid, mate_coord, mate_reverse, tid, coord, reverse)
+            read1_index = mate_index
+            ready_at = (tid, coord)
+        else:
+            key = (library, tid, coord, reverse, mate_tid, mate_coord, mate_reverse)
+            read1_index = index
+            ready_at = (mate_tid, mate_coord)
+
+        self.add_to_group(
+            self.pairs, 1, key, ready_at,
+            (mate_score + score, read1_index, mate_index, index, readgroup, read.query_name)
+        )
+
+    def resolve_ready(self, tid, start):
+        ready = self.ready
+        while ready and (ready[0][0] < tid or (ready[0][0] == tid and ready[0][1] < start)):
+            _, _, kind, key = heapq.heappop(ready)
+            if kind == 0:
+                self.resolve_fragments(key, self.fragments.pop(key))
+            else:
+                self.resolve_pairs(key, self.pairs.pop(key))
+
+    def resolve_fragments(self, key, group):
+        if len(group) == 1:
+            return
+
+        metrics = self.metrics[key[0]]
+
+        if any(paired for _, _, paired in group):
+            # fragments at the same position as a pair are always duplicates
+            for _, index, paired in group:
+                if not paired:
+                    self.mark_duplicate(index)
+                    metrics.unpaired_duplicates += 1
+            return
+
+        best = max(group, key=lambda entry: (entry[0], -entry[1]))
+        for entry in group:
+            if entry is not best:
+                self.mark_duplicate(entry[1])
+                metrics.unpaired_duplicates += 1
+
+    def resolve_pairs(self, key, group):
+        if len(group) == 1:
+            return
+
+        metrics = self.metrics[key[0]]
+
+        keeper = max(range(len(group)), key=lambda i: (group[i][0], -group[i][1]))
+        for i, (_, _, index1, index2, _, _) in enumerate(group):
+            if i != keeper:
+                self.mark_duplicate(index1)
+                self.mark_duplicate(index2)
+                metrics.paired_duplicates += 2
+
+        locations = []
+        for _, _, _, _, readgroup, read_name in group:
+            location = get_physical_location(read_name)
+            locations.append((readgroup,) + location if location else None)
+        metrics.optical_duplicates += count_optical_duplicates(locations, keeper)
+
+    def finish(self):
+        self.resolve_ready(float('inf'), 0)
+
+
+def write_marked_bam(infiles, output, header, marker, threads=1, read_threads=1):
+    '''
+    writes the merged reads with duplicate flags through pysam with
+    threaded bgzf compression, then builds output.bai with the samtools
+    bundled in pysam, so no samtools binary is needed
+    '''
+    with pysam.AlignmentFile(output, 'wb', header=header, threads=threads) as writer:
+        for index, read in enumerate(iter_merged_reads(infiles, threads=read_threads)):
+            if marker.is_duplicate(index):
+                read.flag |= 0x400
+            else:
+                read.flag &= ~0x400
+            writer.write(read)
+
+    pysam.index('-@', str(threads), output, output + '.bai')
+
+
+def merge_and_markdup(infiles, output, metrics, tempdir=None, threads=1):
+    '''
+    merges coordinate sorted bams, marks duplicates and indexes
+    the output in two streaming passes over the inputs
+    :param infiles: coordinate sorted bams, or a dictionary of them
+    :param output: merged bam, output.bai is written next to it
+    :param metrics: duplication metrics file in the picard format
+    :param tempdir: directory for mates spilled to disk, a
+    temporary directory next to the output is used if None
+    :param threads: compression threads, also split over the
+    inputs for decompression
+    '''
+    if isinstance(infiles, dict):
+        infiles = [infiles[key] for key in sorted(infiles)]
+
+    cleanup = tempdir is None
+    if cleanup:
+        tempdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    else:
+        helpers.makedirs(tempdir)
+
+    read_threads = max(1, threads // len(infiles))
+
+    header = merge_headers(infiles)
+
+    try:
+        marker = DuplicateMarker(header, tempdir)
+        for index, read in enumerate(iter_merged_reads(infiles, threads=read_threads)):
+            marker.add_read(read, index)
+        marker.finish()
+    finally:
+        if cleanup:
+            shutil.rmtree(tempdir)
+
+    write_marked_bam(
+        infiles, output, header, marker, threads=threads, read_threads=read_threads
+    )
+
+    write_metrics(
+        marker.metrics, metrics,
+        command='merge_and_markdup INPUT={} OUTPUT={} METRICS_FILE={}'.format(
+            infiles, output, metrics
+        )
+    )
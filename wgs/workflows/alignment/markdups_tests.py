@@ -0,0 +1,322 @@
+import collections
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+import pysam
+import pytest
+from wgs.workflows.alignment import markdups
+
+CHROMOSOMES = ['1', '2', '3']
+
+READGROUPS = [
+    {'ID': 'L1', 'SM': 'sample', 'LB': 'libA', 'PL': 'ILLUMINA'},
+    {'ID': 'L2', 'SM': 'sample', 'LB': 'libA', 'PL': 'ILLUMINA'},
+    {'ID': 'L3', 'SM': 'sample', 'LB': 'libB', 'PL': 'ILLUMINA'},
+]
+
+READ_LENGTH = 100
+
+CIGARS = ['100M', '10S90M', '90M10S', '5S95M', '20S80M', '100M']
+
+
+def _get_header(readgroups):
+    return {
+        'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': chrom, 'LN': 10 ** 6} for chrom in CHROMOSOMES],
+        'RG': readgroups,
+    }
+
+
+def _make_read(rng, name, flag, tid, pos, readgroup, cigar, mate_tid, mate_pos):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.query_sequence = 'A' * READ_LENGTH
+    read.query_qualities = pysam.qualitystring_to_array(
+        ''.join(chr(33 + rng.randint(2, 40)) for _ in range(READ_LENGTH))
+    )
+    read.flag = flag
+    read.reference_id = tid
+    read.reference_start = pos
+    read.next_reference_id = mate_tid
+    read.next_reference_start = mate_pos
+    if not flag & 0x4:
+        read.cigarstring = cigar
+        read.mapping_quality = 60
+    read.set_tag('RG', readgroup)
+    return read
+
+
+def _get_read_name(rng, i):
+    # illumina style names for most reads, so optical duplicates are found
+    if rng.random() < 0.7:
+        return 'M:1:FC{}:1:{}:{}:{}'.format(
+            i, rng.choice([1101, 1102]), rng.randint(1000, 1300), rng.randint(1000, 1300)
+        )
+    return 'read{}'.format(i)
+
+
+def _write_test_bams(tempdir, num_templates=3000, seed=0):
+    '''
+    writes one coordinate sorted bam per read group with fragments, pairs,
+    pairs across chromosomes, pairs with an unmapped mate, secondary and
+    unmapped reads. half of the templates reuse a position, so there
+    are plenty of duplicates
+    :returns list of bams
+    '''
+    rng = random.Random(seed)
+
+    positions = [(rng.randint(0, 2), rng.randint(1000, 200000)) for _ in range(300)]
+
+    def get_position():
+        if rng.random() < 0.5:
+            tid, pos = rng.choice(positions)
+            return tid, pos + rng.choice([0, 0, 0, 1, 10])
+        return rng.randint(0, 2), rng.randint(1000, 200000)
+
+    lanes = collections.defaultdict(list)
+    for i in range(num_templates):
+        readgroup = rng.choice(READGROUPS)['ID']
+        name = _get_read_name(rng, i)
+        tid, pos = get_position()
+        cigar1 = rng.choice(CIGARS)
+        cigar2 = rng.choice(CIGARS)
+
+        kind = rng.random()
+        if kind < 0.6:
+            mate_pos = pos + rng.choice([300, 300, 350])
+            lanes[readgroup].extend([
+                _make_read(rng, name, 0x1 | 0x2 | 0x20 | 0x40, tid, pos, readgroup, cigar1, tid, mate_pos),
+                _make_read(rng, name, 0x1 | 0x2 | 0x10 | 0x80, tid, mate_pos, readgroup, cigar2, tid, pos),
+            ])
+        elif kind < 0.7:
+            mate_tid, mate_pos = get_position()
+            lanes[readgroup].extend([
+                _make_read(rng, name, 0x1 | 0x20 | 0x40, tid, pos, readgroup, cigar1, mate_tid, mate_pos),
+                _make_read(rng, name, 0x1 | 0x10 | 0x80, mate_tid, mate_pos, readgroup, cigar2, tid, pos),
+            ])
+        elif kind < 0.8:
+            lanes[readgroup].extend([
+                _make_read(rng, name, 0x1 | 0x8 | 0x40, tid, pos, readgroup, cigar1, tid, pos),
+                _make_read(rng, name, 0x1 | 0x4 | 0x80, tid, pos, readgroup, cigar2, tid, pos),
+            ])
+        elif kind < 0.95:
+            flag = 0x10 if rng.random() < 0.5 else 0
+            lanes[readgroup].append(
+                _make_read(rng, name, flag, tid, pos, readgroup, cigar1, -1, -1)
+            )
+        else:
+            lanes[readgroup].extend([
+                _make_read(rng, name, 0, tid, pos, readgroup, cigar1, -1, -1),
+                _make_read(rng, name, 0x100, tid, pos + 500, readgroup, cigar2, -1, -1),
+            ])
+
+    bams = []
+    for readgroup in READGROUPS:
+        bam = os.path.join(tempdir, '{}.bam'.format(readgroup['ID']))
+        reads = sorted(lanes[readgroup['ID']], key=lambda read: (read.reference_id, read.reference_start))
+        with pysam.AlignmentFile(bam, 'wb', header=_get_header([readgroup])) as writer:
+            for read in reads:
+                writer.write(read)
+        bams.append(bam)
+
+    return bams
+
+
+def _get_read_key(read):
+    return read.query_name, read.flag & 0xC0
+
+
+def _get_duplicates(bam):
+    '''
+    primary reads flagged as duplicates
+    '''
+    with pysam.AlignmentFile(bam, 'rb', check_sq=False) as reader:
+        return set(
+            _get_read_key(read) for read in reader.fetch(until_eof=True)
+            if read.is_duplicate and not read.flag & 0x900
+        )
+
+
+def _get_reference_duplicates(bams):
+    '''
+    duplicates with all reads held in memory,
+    same rules as markdups.DuplicateMarker
+    '''
+    libraries = {readgroup['ID']: readgroup['LB'] for readgroup in READGROUPS}
+
+    fragments = collections.defaultdict(list)
+    pairs = collections.defaultdict(list)
+    pending = {}
+
+    for read in markdups.iter_merged_reads(bams):
+        if read.flag & 0x904:
+            continue
+
+        readgroup = read.get_tag('RG')
+        library = libraries[readgroup]
+        paired = bool(read.flag & 0x1) and not read.flag & 0x8
+        coord = markdups.get_unclipped_five_prime(read)
+        score = markdups.get_score(read)
+        key = _get_read_key(read)
+
+        fragments[(library, read.reference_id, coord, read.is_reverse)].append((score, key, paired))
+
+        if not paired:
+            continue
+
+        mate = pending.pop((readgroup, read.query_name), None)
+        if mate is None:
+            pending[(readgroup, read.query_name)] = (read.reference_id, coord, read.is_reverse, score, key)
+            continue
+
+        mate_tid, mate_coord, mate_reverse, mate_score, mate_key = mate
+        pair_key = tuple(sorted([
+            (mate_tid, mate_coord, mate_reverse), (read.reference_id, coord, read.is_reverse)
+        ]))
+        pairs[(library,) + pair_key].append((mate_score + score, mate_key, key))
+
+    duplicates = set()
+    for group in fragments.values():
+        if any(paired for _, _, paired in group):
+            duplicates |= set(key for _, key, paired in group if not paired)
+        elif len(group) > 1:
+            best = max(group, key=lambda entry: entry[0])
+            duplicates |= set(entry[1] for entry in group if entry is not best)
+
+    for group in pairs.values():
+        best = max(group, key=lambda entry: entry[0])
+        for entry in group:
+            if entry is not best:
+                duplicates |= {entry[1], entry[2]}
+
+    return duplicates
+
+
+def _read_metrics(metrics_file):
+    '''
+    rows of a picard DuplicationMetrics file, keyed by library
+    '''
+    with open(metrics_file) as reader:
+        lines = [line.rstrip('\n') for line in reader]
+
+    start = [i for i, line in enumerate(lines) if line.startswith('## METRICS CLASS')][0]
+    columns = lines[start + 1].split('\t')
+
+    rows = {}
+    for line in lines[start + 2:]:
+        if not line:
+            break
+        row = dict(zip(columns, line.split('\t')))
+        rows[row['LIBRARY']] = row
+
+    return rows
+
+
+def _run_merge_and_markdup(bams, outdir, **kwargs):
+    output = os.path.join(outdir, 'markdups.bam')
+    metrics = os.path.join(outdir, 'markdups_metrics.txt')
+    markdups.merge_and_markdup(bams, output, metrics, threads=2, **kwargs)
+    return output, metrics
+
+
+@pytest.fixture
+def tempdir():
+    tempdir = tempfile.mkdtemp()
+    yield tempdir
+    shutil.rmtree(tempdir)
+
+
+def test_merge_and_markdup_case_1(tempdir):
+    '''
+    duplicates match the in memory reference, output
+    is sorted, indexed and has all reads
+    '''
+    bams = _write_test_bams(tempdir)
+
+    output, metrics = _run_merge_and_markdup(bams, tempdir)
+
+    assert os.path.exists(output + '.bai')
+
+    with pysam.AlignmentFile(output, 'rb') as reader:
+        reads = list(reader.fetch(until_eof=True))
+        assert set(rg['ID'] for rg in reader.header.to_dict()['RG']) == set(rg['ID'] for rg in READGROUPS)
+
+    input_count = 0
+    for bam in bams:
+        with pysam.AlignmentFile(bam, 'rb') as reader:
+            input_count += sum(1 for _ in reader.fetch(until_eof=True))
+    assert len(reads) == input_count
+
+    positions = [markdups._sort_key(read)[:2] for read in reads]
+    assert positions == sorted(positions)
+
+    duplicates = _get_duplicates(output)
+    assert duplicates
+    assert duplicates == _get_reference_duplicates(bams)
+
+    rows = _read_metrics(metrics)
+    assert sorted(rows) == ['libA', 'libB']
+    for library, row in rows.items():
+        assert int(row['READ_PAIR_DUPLICATES']) > 0
+        assert int(row['READ_PAIR_OPTICAL_DUPLICATES']) <= int(row['READ_PAIR_DUPLICATES'])
+
+
+def test_merge_and_markdup_case_2(tempdir, monkeypatch):
+    '''
+    spilling every mate with a partner on another
+    chromosome to disk doesn't change the result
+    '''
+    bams = _write_test_bams(tempdir)
+
+    in_memory_dir = os.path.join(tempdir, 'in_memory')
+    os.makedirs(in_memory_dir)
+    output, metrics = _run_merge_and_markdup(bams, in_memory_dir)
+
+    monkeypatch.setattr(markdups, 'SPILL_BATCH_SIZE', 1)
+
+    spill_dir = os.path.join(tempdir, 'spill')
+    os.makedirs(spill_dir)
+    spill_output, spill_metrics = _run_merge_and_markdup(
+        bams, spill_dir, tempdir=os.path.join(spill_dir, 'temp')
+    )
+
+    assert _get_duplicates(spill_output) == _get_duplicates(output)
+    assert _read_metrics(spill_metrics) == _read_metrics(metrics)
+
+
+@pytest.mark.skipif(shutil.which('picard') is None, reason='picard is not installed')
+def test_merge_and_markdup_case_3(tempdir):
+    '''
+    flagged reads and DuplicationMetrics match picard MarkDuplicates
+    '''
+    bams = _write_test_bams(tempdir)
+
+    output, metrics = _run_merge_and_markdup(bams, tempdir)
+
+    picard_output = os.path.join(tempdir, 'picard.bam')
+    picard_metrics = os.path.join(tempdir, 'picard_metrics.txt')
+    cmd = [
+        'picard', 'MarkDuplicates', 'OUTPUT=' + picard_output,
+        'METRICS_FILE=' + picard_metrics, 'ASSUME_SORTED=true',
+        'VALIDATION_STRINGENCY=LENIENT', 'TMP_DIR=' + tempdir,
+    ]
+    cmd += ['INPUT=' + bam for bam in bams]
+    subprocess.check_call(cmd)
+
+    assert _get_duplicates(output) == _get_duplicates(picard_output)
+
+    rows = _read_metrics(metrics)
+    picard_rows = _read_metrics(picard_metrics)
+    assert sorted(rows) == sorted(picard_rows)
+
+    for library, row in rows.items():
+        picard_row = picard_rows[library]
+        for column in markdups.METRICS_COLUMNS[1:8]:
+            assert int(row[column]) == int(picard_row[column]), (library, column)
+        assert float(row['PERCENT_DUPLICATION']) == pytest.approx(
+            float(picard_row['PERCENT_DUPLICATION']), abs=1e-6
+        )
+        assert row['ESTIMATED_LIBRARY_SIZE'] == picard_row['ESTIMATED_LIBRARY_SIZE']
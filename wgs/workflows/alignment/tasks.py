@@ -1,4 +1,7 @@
+import gzip
+import itertools
 import logging
+import math
 import os
 import shutil
 
@@ -140,6 +143,29 @@ def picard_merge_bams(inputs, output, tempdir, mem="2G"):
     pypeliner.commandline.execute(*cmd)
 
 
+def samtools_merge_bams(inputs, output, tempdir, threads=1):
+    '''
+    merges coordinate sorted bams with a multithreaded samtools merge.
+    read groups and programs with the same id are combined, so chunks
+    of the same lane keep their read group
+    '''
+    if isinstance(inputs, dict):
+        inputs = inputs.values()
+
+    helpers.makedirs(tempdir)
+
+    # pass inputs through a file to stay clear of argument limits
+    bam_list = os.path.join(tempdir, 'inputs.txt')
+    with open(bam_list, 'wt') as writer:
+        for bamfile in inputs:
+            writer.write(os.path.abspath(bamfile) + '\n')
+
+    pypeliner.commandline.execute(
+        'samtools', 'merge', '-f', '-c', '-p',
+        '-@', threads, '-b', bam_list, output
+    )
+
+
 def bam_index(infile, outfile, **kwargs):
     pypeliner.commandline.execute(
         'samtools', 'index',
@@ -159,32 +185,88 @@ def merge_bams(inputs, output, tempdir, mem=2):
 
 def bwa_mem_paired_end(fastq1, fastq2, output,
                        reference, readgroup,
-                       numthreads,
-                       **kwargs):
+                       numthreads, sort_tempdir=None,
+                       sort_mem='1G', **kwargs):
     """
-    run bwa aln on both fastq files,
-    bwa sampe to align, and convert to bam with samtools view
+    run bwa mem on both fastq files and convert to bam with samtools view.
+    if sort_tempdir is set the alignments are piped straight into a
+    multithreaded samtools sort instead, skipping the unsorted bam
     """
 
     if not numthreads:
         numthreads = 1
 
-    if not readgroup:
-        pypeliner.commandline.execute(
-            'bwa', 'mem', '-M',
-            '-t', numthreads,
-            reference, fastq1, fastq2,
-            '|', 'samtools', 'view', '-bSh', '-',
-            '>', output,
-            **kwargs)
+    cmd = ['bwa', 'mem', '-M']
+
+    if readgroup:
+        cmd.extend(['-R', readgroup])
+
+    cmd.extend(['-t', numthreads, reference, fastq1, fastq2, '|'])
+
+    if sort_tempdir:
+        helpers.makedirs(sort_tempdir)
+        cmd.extend([
+            'samtools', 'sort', '-@', numthreads, '-m', sort_mem,
+            '-T', os.path.join(sort_tempdir, 'samtools_sort'),
+            '-o', output, '-'
+        ])
     else:
-        pypeliner.commandline.execute(
-            'bwa', 'mem', '-M', '-R', readgroup,
-            '-t', numthreads,
-            reference, fastq1, fastq2,
-            '|', 'samtools', 'view', '-bSh', '-',
-            '>', output,
-            **kwargs)
+        cmd.extend(['samtools', 'view', '-bSh', '-', '>', output])
+
+    pypeliner.commandline.execute(*cmd, **kwargs)
+
+
+def estimate_fastq_reads(fastq, sample_reads=100000):
+    '''
+    estimates the number of reads in a fastq from the file size and
+    the compressed size of the first sample_reads reads
+    :param fastq: plain or gzipped fastq
+    :param sample_reads: number of reads to sample
+    '''
+    with open(fastq, 'rb') as raw:
+        if helpers.is_gzip_file(fastq):
+            reader = gzip.GzipFile(fileobj=raw)
+        else:
+            reader = raw
+
+        nlines = 0
+        for _ in itertools.islice(reader, 4 * sample_reads):
+            nlines += 1
+
+        nreads = nlines // 4
+
+        if nreads < sample_reads:
+            return nreads
+
+        # includes the decompressor read ahead, slightly
+        # overestimating the bytes per read
+        bytes_per_read = raw.tell() / float(nreads)
+
+    return int(os.path.getsize(fastq) / bytes_per_read)
+
+
+def get_split_size(fastq, cluster_slots, min_split_size, max_split_size):
+    '''
+    reads per fastq chunk so that the chunks of a lane fill the cluster
+    slots, bounded so chunks are not too small to be worth the bwa index
+    loading and not too large for a predictable wall time
+    :param fastq: plain or gzipped fastq
+    :param cluster_slots: number of alignment jobs that can run at once
+    :param min_split_size: minimum reads per chunk
+    :param max_split_size: maximum reads per chunk
+    '''
+    nreads = estimate_fastq_reads(fastq)
+
+    split_size = int(math.ceil(nreads / float(cluster_slots)))
+    split_size = min(max(split_size, int(min_split_size)), int(max_split_size))
+
+    logging.getLogger('wgs.alignment').info(
+        'estimated {} reads in {}, using {} reads per chunk'.format(
+            nreads, fastq, split_size
+        )
+    )
+
+    return split_size
 
 
 def get_readgroup(sample_info, sample_id, lane_id):
@@ -214,7 +296,7 @@ def samtools_sam_to_bam(samfile, bamfile,
 
 def align_bwa_mem(
         read_1, read_2, ref_genome, aligned_bam, threads, sample_info,
-        sample_id=None, lane_id=None
+        sample_id=None, lane_id=None, sort_tempdir=None, sort_mem='1G'
 ):
     if lane_id in sample_info:
         sample_info = sample_info[lane_id]
@@ -223,7 +305,8 @@ def align_bwa_mem(
 
     bwa_mem_paired_end(
         read_1, read_2, aligned_bam, ref_genome,
-        readgroup, threads
+        readgroup, threads, sort_tempdir=sort_tempdir,
+        sort_mem=sort_mem
     )
 
 
@@ -1,13 +1,13 @@
 import copy
 
 import pandas as pd
-import vcf
+from wgs.utils import vcfutils
 
 VCF_FILE = "lumpy.vcf"
 
 
 def get_reader(vcf_file):
-    return vcf.Reader(open(vcf_file, 'rt'))
+    return vcfutils.VcfReader(vcf_file)
 
 
 def parse_vcf(vcf_file):
@@ -18,7 +18,7 @@ def parse_vcf(vcf_file):
             'chrom': record.CHROM,
             'pos': record.POS,
             'ref': record.REF,
-            'alt': record.ALT,
+            'alt': ';'.join(map(str, record.ALT)),
             'qual': record.QUAL,
         }
 
@@ -29,10 +29,8 @@ def parse_vcf(vcf_file):
                 v = ';'.join(map(str, v))
             data[k] = v
 
-        for sample in record.samples:
-            sample_name = sample.sample
-            sample_data = sample.data
-            for k, v in sample_data._asdict().items():
+        for sample_name, sample_data in record.iter_samples():
+            for k, v in sample_data.items():
                 if isinstance(v, list):
                     v = ';'.join([str(val) for val in v])
                 k = '{}_{}'.format(sample_name, k)
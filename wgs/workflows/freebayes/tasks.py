@@ -72,14 +72,17 @@ def run_freebayes_one_job(
     merge_tempdir = os.path.join(tempdir, 'germline_merge')
     helpers.makedirs(merge_tempdir)
     temp_vcf = os.path.join(merge_tempdir,'temp_freebayes.vcf')
-    merge_vcfs(vcf_files, temp_vcf, merge_tempdir)
+    merge_vcfs(vcf_files, temp_vcf, merge_tempdir, reference=reference)
 
     normal_id = bamutils.get_sample_id(bam_file)
     vcfutils.update_germline_header_sample_ids(temp_vcf, vcf, normal_id)
 
 
-def merge_vcfs(inputs, outfile, tempdir):
+def merge_vcfs(inputs, outfile, tempdir, reference=None):
     helpers.makedirs(tempdir)
     mergedfile = os.path.join(tempdir, 'merged.vcf')
     vcfutils.concatenate_vcf(inputs, mergedfile)
-    vcfutils.sort_vcf(mergedfile, outfile)
+    vcfutils.sort_vcf(
+        mergedfile, outfile, reference=reference,
+        tempdir=os.path.join(tempdir, 'sort')
+    )
@@ -30,7 +30,8 @@ def create_germline_consensus_workflow(
         name='germline_consensus',
         ctx=helpers.get_default_ctx(
             memory=15,
-            walltime='8:00', ),
+            walltime='8:00',
+            ncpus=8),
         func='wgs.workflows.germline_calling_consensus.consensus.main',
         args=(
             mgd.InputFile(museq_vcf),
@@ -41,6 +42,10 @@ def create_germline_consensus_workflow(
             mgd.TempOutputFile('counts.csv'),
             params_refdir['chromosomes']
         ),
+        kwargs={
+            'tempdir': mgd.TempSpace('germline_consensus_temp'),
+            'ncores': 8,
+        }
     )
 
     workflow.subworkflow(
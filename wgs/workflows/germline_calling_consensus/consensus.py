@@ -1,33 +1,107 @@
+import heapq
+import itertools
+import os
+import shutil
 from collections import defaultdict
 
-import vcf
+from wgs.utils import helpers
+from wgs.utils import vcfutils
+
+SNV = 0
+INDEL = 1
 
 
 def get_reader(filename):
     """
-    pyvcf vcf reader
+    vcf reader
     Parameters
     ----------
     filename :
 
     Returns
     -------
-    vcf.Reader
+    vcfutils.VcfReader
+    """
+    return vcfutils.VcfReader(filename)
+
+
+def _museq_germline_counts(record, index):
+    depth, ref, alt = record.get_sample_fields(index, ('DP', 'RC', 'AC'))
+    return ref, alt, depth
+
+
+def _freebayes_counts(record, index):
+    depth, ref, alt = record.get_sample_fields(index, ('DP', 'RO', 'AO'))
+    return ref, alt, depth
+
+
+def _rtg_counts(record, index):
+    depth, ad = record.get_sample_fields(index, ('DP', 'AD'))
+    if isinstance(ad, list):
+        assert len(ad) > 1
+        ref = ad[0]
+        alt = ad[1:]
+    else:
+        assert record.ALT == [None]
+        assert isinstance(ad, int)
+        ref = ad
+        alt = ['NA']
+        raise Exception('TODO')
+    return ref, alt, depth
+
+
+def _samtools_counts(record, index):
+    return 'NA', ['NA'], record.INFO['DP']
+
+
+COUNT_EXTRACTORS = {
+    'museq_germline': _museq_germline_counts,
+    'freebayes': _freebayes_counts,
+    'rtg': _rtg_counts,
+    'samtools': _samtools_counts,
+}
+
+
+def get_counts_extractor(caller, sample_index):
+    """
+    build the count extractor for a caller once per vcf
+    Parameters
+    ----------
+    caller :    str
+        the caller used to generate the calls
+    sample_index : int
+        index of the sample in the vcf
+
+    Returns
+    -------
+        function called per record as extract(record),
+        returns ref, alt, depth
     """
-    return vcf.Reader(filename=filename)
+    try:
+        sample_counts = COUNT_EXTRACTORS[caller]
+    except KeyError:
+        raise NotImplementedError()
+
+    def extract(record):
+        ref, alt, depth = sample_counts(record, sample_index)
+        if isinstance(alt, int):
+            alt = [alt]
+        return ref, alt, depth
 
+    return extract
 
-def get_counts(record, caller, sample_id):
+
+def get_counts(record, caller, sample_index):
     """
     given a record,
     Parameters
     ----------
-    record : vcf.Record
+    record : vcfutils.VcfRecord
         a vcf call
     caller :    str
         the caller used to generate the call
-    sample_id : str
-        sample_id
+    sample_index : int
+        index of the sample in the vcf
 
     Returns
     -------
@@ -38,81 +112,44 @@ def get_counts(record, caller, sample_id):
         depth: int
             count for depth
     """
-    sample = [v for v in record.samples if v.sample == sample_id]
-    assert len(sample) == 1, (sample, caller, sample_id, record, sample_id)
-    sample = sample[0]
-
-    if caller == 'museq_germline':
-        depth = sample['DP']
-        ref = sample['RC']
-        alt = sample['AC']
-    elif caller == 'freebayes':
-        depth = sample['DP']
-        ref = sample['RO']
-        alt = sample['AO']
-    elif caller == 'rtg':
-        depth = sample['DP']
-        ad = sample['AD']
-        if isinstance(ad, list):
-            assert len(ad) > 1
-            ref = ad[0]
-            alt = ad[1:]
-        else:
-            assert record.ALT == [None]
-            assert isinstance(ad, int)
-            ref = ad
-            alt = ['NA']
-            raise Exception('TODO')
-    elif caller == 'samtools':
-        depth = record.INFO['DP']
-        ref = 'NA'
-        alt = ['NA']
-    else:
-        raise NotImplementedError()
-    if isinstance(alt, int):
-        alt = [alt]
-
-    return ref, alt, depth
+    return get_counts_extractor(caller, sample_index)(record)
 
 
 def fetch_vcf(filename, chromosome, caller):
     """
-    read records from vcf
+    stream calls from a caller vcf for a chromosome
 
     Parameters
     ----------
     filename : str
         vcf file
-    chromosome : list
-        list of chromosomes to fetch from
+    chromosome : str
+        chromosome to fetch
     caller : str
         caller name
 
     Returns
     -------
-        snv_data: Dict(tuple, list)
-            snv_data, each key is (chrom, pos, ref, alt) and data is: [qual, filter, ref_count, alt_count, id]
-
-        indel_data: Dict(tuple, list)
-            snv_data, each key is (chrom, pos, ref, alt) and data is: [qual, filter, ref_count, alt_count, id]
-
-
+        generator of (pos, vartype, key, data), sorted by (pos, vartype, key).
+        key is (chrom, pos, ref, alt) and data is: [qual, filter, ref_count, alt_count, depth, id]
+        multi base substitutions are split into snvs that may sort after the
+        next record, so calls are held in a small heap until the vcf moves past them.
     """
-
-    snv_data = {}
-    indel_data = {}
-
     vcf_reader = get_reader(filename)
 
-    sample_id = vcf_reader.metadata['normal_sample'][0]
+    sample_index = vcf_reader.get_sample_index(vcf_reader.metadata['normal_sample'][0])
+    get_record_counts = get_counts_extractor(caller, sample_index)
 
     try:
         records = vcf_reader.fetch(chromosome)
     except ValueError:
-        return snv_data, indel_data
+        return
 
     id_counter = 0
 
+    buffer = []
+    seq = itertools.count()
+
     for record in records:
         chrom = record.CHROM
         pos = record.POS
@@ -120,6 +157,9 @@ def fetch_vcf(filename, chromosome, caller):
         alts = record.ALT
         filter = record.FILTER
 
+        for call in vcfutils.pop_sorted_calls(buffer, pos):
+            yield call
+
         if not filter:
             filter = '.'
         else:
@@ -128,20 +168,25 @@ def fetch_vcf(filename, chromosome, caller):
 
         if alts == [None]:
             continue
-        ref_count, alt_counts, depth = get_counts(record, caller, sample_id)
+        ref_count, alt_counts, depth = get_record_counts(record)
         for alt, alt_count in zip(alts, alt_counts):
             alt = str(alt)
             data = [record.QUAL, filter, ref_count, alt_count, depth, '{}_{}'.format(caller, id_counter)]
             if len(ref) == len(alt):
                 for i, (rb, ab) in enumerate(zip(ref, alt)):
                     if not rb == ab:
-                        snv_data[(chrom, pos + i, rb, ab)] = data
+                        heapq.heappush(buffer, (pos + i, SNV, (chrom, pos + i, rb, ab), next(seq), data))
                         id_counter += 1
             else:
-                indel_data[(chrom, pos, ref, alt)] = data
+                heapq.heappush(buffer, (pos, INDEL, (chrom, pos, ref, alt), next(seq), data))
                 id_counter += 1
 
-    return snv_data, indel_data
+    for call in vcfutils.pop_sorted_calls(buffer):
+        yield call
+
+
+def filter_calls(calls, vartype):
+    return (call for call in calls if call[1] == vartype)
 
 
 def snv_consensus(museq, freebayes, rtg, samtools):
@@ -231,6 +276,62 @@ def write_vcf(consensus, vcf_output, counts_output):
             count_file.write(outstr)
 
 
+def consensus_calls(
+        museq_vcf,
+        freebayes_vcf,
+        rtg_vcf,
+        samtools_vcf,
+        chromosome
+):
+    """
+    streaming consensus for a chromosome. the caller vcfs are merged
+    in position order and each variant is resolved as soon as all
+    callers have moved past it, so memory does not grow with the number of calls.
+
+    Returns
+    -------
+    generator of consensus calls, each call is [chrom, pos, ref, alt, id, qual, filter, nr, na ,nd]
+    """
+    streams = {
+        'museq_germline': filter_calls(fetch_vcf(museq_vcf, chromosome, 'museq_germline'), SNV),
+        'freebayes': fetch_vcf(freebayes_vcf, chromosome, 'freebayes'),
+        'rtg': fetch_vcf(rtg_vcf, chromosome, 'rtg'),
+        'samtools': fetch_vcf(samtools_vcf, chromosome, 'samtools'),
+    }
+
+    for vartype, key, calls in vcfutils.merge_call_streams(streams):
+        if len(calls) <= 1:
+            continue
+
+        freebayes = {key: calls['freebayes']} if 'freebayes' in calls else {}
+        rtg = {key: calls['rtg']} if 'rtg' in calls else {}
+        samtools = {key: calls['samtools']} if 'samtools' in calls else {}
+
+        if vartype == SNV:
+            museq = {key: calls['museq_germline']} if 'museq_germline' in calls else {}
+            consensus = snv_consensus(museq, freebayes, rtg, samtools)
+        else:
+            consensus = indel_consensus(freebayes, rtg, samtools)
+
+        for call in consensus:
+            yield call
+
+
+def run_consensus(
+        museq_vcf,
+        freebayes_vcf,
+        rtg_vcf,
+        samtools_vcf,
+        consensus_vcf,
+        counts_output,
+        chromosome
+):
+    consensus = consensus_calls(
+        museq_vcf, freebayes_vcf, rtg_vcf, samtools_vcf, chromosome
+    )
+    write_vcf(consensus, consensus_vcf, counts_output)
+
+
 def main(
         museq_vcf,
         freebayes_vcf,
@@ -238,21 +339,50 @@ def main(
         samtools_vcf,
         consensus_vcf,
         counts_output,
-        chromosomes
+        chromosomes,
+        tempdir=None,
+        ncores=None,
 ):
+    """
+    run consensus calling one chromosome at a time. if tempdir is set,
+    chromosomes run in parallel worker processes and the per chromosome
+    outputs are concatenated in chromosome order.
+    """
     with open(consensus_vcf, 'wt') as writer:
         writer.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
 
     with open(counts_output, 'wt') as writer:
         writer.write("chrom\tpos\tID\tNR\tNA\tND\n")
 
-    for chromosome in chromosomes:
-        museq_calls, _ = fetch_vcf(museq_vcf, chromosome, 'museq_germline')
-        freebayes_snv, freebayes_indel = fetch_vcf(freebayes_vcf, chromosome, 'freebayes')
-        rtg_snv, rtg_indel = fetch_vcf(rtg_vcf, chromosome, 'rtg')
-        samtools_snv, samtools_indel = fetch_vcf(samtools_vcf, chromosome, 'samtools')
+    if not tempdir:
+        for chromosome in chromosomes:
+            run_consensus(
+                museq_vcf, freebayes_vcf, rtg_vcf, samtools_vcf,
+                consensus_vcf, counts_output, chromosome
+            )
+        return
 
-        consensus = snv_consensus(museq_calls, freebayes_snv, rtg_snv, samtools_snv)
-        consensus += indel_consensus(freebayes_indel, rtg_indel, samtools_indel)
+    helpers.makedirs(tempdir)
 
-        write_vcf(consensus, consensus_vcf, counts_output)
+    args = []
+    for chromosome in chromosomes:
+        vcf_part = os.path.join(tempdir, '{}_consensus.vcf'.format(chromosome))
+        counts_part = os.path.join(tempdir, '{}_counts.csv'.format(chromosome))
+
+        # write_vcf appends, start from empty files in case of reruns
+        open(vcf_part, 'wt').close()
+        open(counts_part, 'wt').close()
+
+        args.append((
+            museq_vcf, freebayes_vcf, rtg_vcf, samtools_vcf,
+            vcf_part, counts_part, chromosome
+        ))
+
+    helpers.run_in_process_pool(run_consensus, args, ncores=ncores)
+
+    with open(consensus_vcf, 'at') as vcf_writer, open(counts_output, 'at') as counts_writer:
+        for arg in args:
+            with open(arg[4], 'rt') as reader:
+                shutil.copyfileobj(reader, vcf_writer)
+            with open(arg[5], 'rt') as reader:
+                shutil.copyfileobj(reader, counts_writer)
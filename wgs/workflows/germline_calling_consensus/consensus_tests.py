@@ -1,11 +1,12 @@
 import os
 import random
-from collections import namedtuple
+import shutil
+import tempfile
 
 import consensus
 import pandas as pd
 import pypeliner
-import vcf
+from wgs.utils import vcfutils
 
 
 def _check_record(record, df):
@@ -31,16 +32,47 @@ def _get_test_record():
     return chrom, pos, ref, alt, test_record
 
 
+def _get_test_reader(samples):
+    # vcf header for the example calls
+    header = [
+        '##fileformat=VCFv4.1',
+        '##INFO=<ID=DP,Number=1,Type=Integer,Description="depth">',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="depth">',
+        '##FORMAT=<ID=RO,Number=1,Type=Integer,Description="ref count">',
+        '##FORMAT=<ID=AO,Number=A,Type=Integer,Description="alt count">',
+        '##FORMAT=<ID=RC,Number=1,Type=Integer,Description="ref count">',
+        '##FORMAT=<ID=AC,Number=1,Type=Integer,Description="alt count">',
+        '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="allele depths">',
+        '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples),
+    ]
+
+    # the header is parsed when the reader is created,
+    # the file isn't read again and can be removed
+    tempdir = tempfile.mkdtemp()
+    try:
+        vcf_file = os.path.join(tempdir, 'test.vcf')
+        with open(vcf_file, 'wt') as writer:
+            writer.write('\n'.join(header) + '\n')
+
+        return vcfutils.VcfReader(vcf_file)
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def _get_test_model_call(DP=1, RC=2, AC=2):
     # make example  call
-    Call = namedtuple("Call", "DP RO AO RC AC AD")
-    sample_data = vcf.model._Call(None, "sample_label", Call(DP, 1, 2, RC, AC, [1, 2]))
+    reader = _get_test_reader(["sample_label"])
+
+    call_format = "DP:RO:AO:RC:AC:AD"
+    call_data = "{}:1:2:{}:{}:1,2".format(DP, RC, AC)
 
-    freebayes_museq_rtg_example = vcf.model._Record("1", 10, 1, "A", [None], 1, 1,
-                                                    None, None, None, [sample_data])
+    freebayes_museq_rtg_example = vcfutils.VcfRecord(
+        "\t".join(["1", "10", "1", "A", ".", "1", "1", ".", call_format, call_data]), reader
+    )
 
-    samtools_example = vcf.model._Record("1", 10, 1, "A", [None], 1, 1, {"DP": 1},
-                                         None, None, [sample_data])
+    samtools_example = vcfutils.VcfRecord(
+        "\t".join(["1", "10", "1", "A", ".", "1", "1", "DP=1", call_format, call_data]), reader
+    )
 
     return freebayes_museq_rtg_example, samtools_example
 
@@ -678,7 +710,7 @@ def test_get_counts_case_1():
     '''
     freebayes_museq_rtg_example, _ = _get_test_model_call()
 
-    assert consensus.get_counts(freebayes_museq_rtg_example, "freebayes", "sample_label") == (1, [2], 1)
+    assert consensus.get_counts(freebayes_museq_rtg_example, "freebayes", 0) == (1, [2], 1)
 
 
 def test_get_counts_case_2():
@@ -691,7 +723,7 @@ def test_get_counts_case_2():
     '''
     freebayes_museq_rtg_example, _ = _get_test_model_call()
 
-    assert consensus.get_counts(freebayes_museq_rtg_example, "museq_germline", "sample_label") == (1, [2], 1)
+    assert consensus.get_counts(freebayes_museq_rtg_example, "museq_germline", 0) == (2, [2], 1)
 
 
 def test_get_counts_case_3():
@@ -704,7 +736,7 @@ def test_get_counts_case_3():
     '''
     freebayes_museq_rtg_example, _ = _get_test_model_call()
 
-    assert consensus.get_counts(freebayes_museq_rtg_example, "rtg", "sample_label") == (1, [2], 1)
+    assert consensus.get_counts(freebayes_museq_rtg_example, "rtg", 0) == (1, [2], 1)
 
 
 def test_get_counts_case_4():
@@ -717,7 +749,7 @@ def test_get_counts_case_4():
     '''
     _, samtools_example = _get_test_model_call()
 
-    assert consensus.get_counts(samtools_example, "samtools", "sample_label") == ("NA", ["NA"], 1)
+    assert consensus.get_counts(samtools_example, "samtools", 0) == ("NA", ["NA"], 1)
 
 
 test_normalization_case_7()
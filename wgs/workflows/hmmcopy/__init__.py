@@ -17,14 +17,16 @@ def create_hmmcopy_workflow(
         name='hmmcopy_readcounter',
         ctx=helpers.get_default_ctx(
             memory=5,
-            walltime='2:00', ),
+            walltime='2:00',
+            ncpus=8),
         func='wgs.workflows.hmmcopy.tasks.hmmcopy_readcounter',
         args=(
             mgd.InputFile(bam_file, extensions=['.bai']),
             mgd.TempOutputFile('infile.wig'),
             chromosomes,
             cn_params['readcounter'],
-        )
+        ),
+        kwargs={'ncores': 8}
     )
 
     workflow.transform(
@@ -3,24 +3,173 @@ Created on Oct 10, 2017
 
 @author: dgrewal
 '''
-import os
-import pysam
 import argparse
-import pandas as pd
+import itertools
+import multiprocessing
+import os
+
 import numpy as np
+import pandas as pd
+import pysam
+
+DUPLICATE_FLAG = 0x400
+
+
+def get_bins(reflen, window_size):
+    """bin coordinates for a chromosome. matches the bins written
+    by the original per read loop: the first bin always ends at
+    window_size and the last bin is clipped to the chromosome length.
+    :param reflen: chromosome length
+    :param window_size: bin size
+    :returns tuple of numpy arrays with bin starts and ends
+    """
+    starts = np.arange(reflen // window_size + 1, dtype=np.int64) * window_size
+    ends = np.minimum(starts + window_size, reflen)
+    ends[0] = window_size
+    return starts, ends
+
+
+def get_bin_index(positions, window_size, nbins):
+    """maps read start positions to bins. a read starting exactly
+    at the end of a bin is counted in that bin.
+    :param positions: numpy array of 0 based read start positions
+    :param window_size: bin size
+    :param nbins: number of bins in the chromosome
+    :returns numpy array of bin indices
+    """
+    index = np.maximum(positions - 1, 0) // window_size
+    return np.minimum(index, nbins - 1)
+
+
+def merge_intervals(starts, ends):
+    """sort and merge overlapping intervals so that
+    a point can be located with a single searchsorted call
+    :param starts: interval starts
+    :param ends: interval ends (exclusive)
+    :returns tuple of numpy arrays with merged starts and ends
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    keep = ends > starts
+    starts = starts[keep]
+    ends = ends[keep]
+
+    if not len(starts):
+        return starts, ends
+
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    ends = np.maximum.accumulate(ends[order])
+
+    # new interval wherever the start is past everything seen so far
+    breaks = np.ones(len(starts), dtype=bool)
+    breaks[1:] = starts[1:] > ends[:-1]
+
+    group_ends = np.append(np.flatnonzero(breaks)[1:] - 1, len(starts) - 1)
+
+    return starts[breaks], ends[group_ends]
+
+
+def in_intervals(positions, starts, ends):
+    """vectorized membership test against merged intervals
+    :param positions: numpy array of positions
+    :param starts: merged interval starts
+    :param ends: merged interval ends (exclusive)
+    :returns boolean numpy array, True if position is in an interval
+    """
+    if not len(starts):
+        return np.zeros(len(positions), dtype=bool)
+
+    index = np.searchsorted(starts, positions, side='right') - 1
+    valid = index >= 0
+    index[~valid] = 0
+    return valid & (positions < ends[index])
+
+
+def read_chunks(reads, chunksize):
+    """pulls reads off a pysam iterator in bulk and
+    returns the start, flag and mapping quality of each chunk
+    as numpy arrays.
+    :param reads: pysam iterator over reads
+    :param chunksize: number of reads per chunk
+    """
+    while True:
+        chunk = list(itertools.islice(reads, chunksize))
+        if not chunk:
+            break
+
+        size = len(chunk)
+        positions = np.fromiter(
+            (read.reference_start for read in chunk), dtype=np.int64, count=size
+        )
+        flags = np.fromiter(
+            (read.flag for read in chunk), dtype=np.int64, count=size
+        )
+        mapq = np.fromiter(
+            (read.mapping_quality for read in chunk), dtype=np.int64, count=size
+        )
+
+        yield positions, flags, mapq
+
+
+def count_chromosome(
+        bam, chrom, reflen, window_size, mapq_threshold,
+        excluded=None, chunksize=100000
+):
+    """counts the reads starting in each bin of a chromosome.
+    :param bam: path to the indexed bam file
+    :param chrom: chromosome name
+    :param reflen: chromosome length
+    :param window_size: bin size
+    :param mapq_threshold: reads below this mapping quality are skipped
+    :param excluded: tuple of merged interval starts and ends to skip
+    :param chunksize: number of reads to load per chunk
+    :returns numpy array with counts per bin
+    """
+    nbins = reflen // window_size + 1
+    counts = np.zeros(nbins, dtype=np.int64)
+
+    bamfile = pysam.AlignmentFile(bam, 'rb')
+
+    # code assumes the iterator is sorted.
+    reads = bamfile.fetch(chrom, 0, reflen)
+
+    for positions, flags, mapq in read_chunks(reads, chunksize):
+        keep = (flags & DUPLICATE_FLAG) == 0
+        keep &= mapq >= mapq_threshold
+        if excluded is not None:
+            keep &= ~in_intervals(positions, *excluded)
+
+        bins = get_bin_index(positions[keep], window_size, nbins)
+        counts += np.bincount(bins, minlength=nbins)
+
+    bamfile.close()
+
+    return counts
+
+
+def _count_chromosome_worker(args):
+    return count_chromosome(*args)
+
 
 class ReadCounter(object):
     """
     calculate reads per bin from the input bam file
     """
 
-    def __init__(self, bam, output, window_size, chromosomes, mapq, seg=None, excluded=None):
-        self.bam = bam
+    def __init__(
+            self, bam, output, window_size, chromosomes, mapq,
+            seg=None, excluded=None, ncores=None, chunksize=100000
+    ):
+        self.bam_path = bam
 
         self.output = output
 
         self.window_size = window_size
 
+        self.bam = self.__get_bam_reader()
+
         if chromosomes:
             self.chromosomes = chromosomes
         else:
@@ -28,13 +177,16 @@ class ReadCounter(object):
 
         self.chromosomes = [str(chrom) for chrom in self.chromosomes]
 
-        self.bam = self.__get_bam_reader()
         self.chr_lengths = self.__get_chr_lengths()
 
         self.mapq_threshold = mapq
 
         self.seg = seg
 
+        self.ncores = ncores
+
+        self.chunksize = chunksize
+
         if excluded is not None:
             self.excluded = pd.read_csv(excluded, sep="\t", )
             self.excluded.columns = ["chrom","start","end"]
@@ -42,17 +194,18 @@ class ReadCounter(object):
             self.excluded = None
 
     def __get_chrom_excluded(self, chrom, chrom_length):
-#         chrom_excluded = np.zeros(chrom_length, dtype=np.uint8)
-        #add some padding in case the list is 1 based and chr length is 0 based
-        chrom_excluded = np.zeros(chrom_length+1, dtype=np.uint8)
-
+        """merged excluded intervals for the chromosome,
+        clipped to the chromosome length
+        :param chrom: chromosome name
+        :param chrom_length: chromosome length
+        :returns tuple of numpy arrays with interval starts and ends
+        """
+        regions = self.excluded.loc[self.excluded['chrom'] == chrom, ['start', 'end']].values
 
-        for start, end in self.excluded.loc[self.excluded['chrom'] == chrom, ['start', 'end']].values:
-            start = min(start, chrom_length)
-            end = min(end, chrom_length)
-            chrom_excluded[start:end] = 1
+        starts = np.minimum(regions[:, 0], chrom_length)
+        ends = np.minimum(regions[:, 1], chrom_length)
 
-        return chrom_excluded
+        return merge_intervals(starts, ends)
 
     def __enter__(self):
         return self
@@ -77,7 +230,7 @@ class ReadCounter(object):
         """returns pysam bam object
         :returns pysam bam object
         """
-        return pysam.AlignmentFile(self.bam, 'rb')
+        return pysam.AlignmentFile(self.bam_path, 'rb')
 
     def __get_chr_names(self):
         """extracts chromosome names from the bam file
@@ -86,33 +239,12 @@ class ReadCounter(object):
         """
         return self.bam.references
 
-    def __fetch(self, chrom, start, end):
-        """returns iterator over reads in the specified region
-        :param chrom: chromosome name (str)
-        :param start: bin starting pos (int)
-        :param end: bin end pos (int)
-        :returns iterator over reads
-        """
-        return self.bam.fetch(chrom, start, end)
-
-    def filter(self, pileupobj, chrom_excluded=None):
-        """remove low mapping quality reads and duplicates
-        :param pileupobj: pysam read object
-        :returns boolean: false if the read passes filters.
-        :rtype boolean
+    def __get_ncores(self):
+        """number of worker processes, at most one per chromosome
+        :returns int
         """
-
-        pos = pileupobj.reference_start
-        if chrom_excluded is not None and chrom_excluded[pos]:
-            return True
-
-        if pileupobj.is_duplicate:
-            return True
-
-        if pileupobj.mapping_quality < self.mapq_threshold:
-            return True
-
-        return False
+        ncores = self.ncores or multiprocessing.cpu_count()
+        return max(1, min(int(ncores), len(self.chromosomes)))
 
     def write_header(self, chrom, outfile):
         """writes headers, single header if seg format,
@@ -127,58 +259,57 @@ class ReadCounter(object):
                 % (chrom, self.window_size, self.window_size)
             outfile.write(outstr)
 
-    def write(self, chrom, start, stop, count, outfile):
-        """writes bin and counts to the output file.
+    def write(self, chrom, counts, outfile):
+        """writes bins and counts for a chromosome to the output file.
         supports seg and wig formats
         :param chrom: chromosome name
-        :param start: bin start
-        :param stop: bin stop
-        :param count: no of reads in the bin
+        :param counts: numpy array with no of reads per bin
         :param outfile: output file object.
         """
         if self.seg:
-            outstr = '\t'.join(
-                map(str, ['reads', chrom, start, stop, count])) + '\n'
-            outfile.write(outstr)
+            starts, ends = get_bins(self.chr_lengths[chrom], self.window_size)
+            lines = [
+                'reads\t{}\t{}\t{}\t{}\n'.format(chrom, start, end, count)
+                for start, end, count in zip(starts.tolist(), ends.tolist(), counts.tolist())
+            ]
+            outfile.write(''.join(lines))
         else:
-            outfile.write(str(count) + '\n')
+            outfile.write(''.join('{}\n'.format(count) for count in counts.tolist()))
 
-    def get_data(self, data, chrom, outfile):
-        """iterates over reads, calculates counts and writes to output
-        :param data: pysam iterator over reads
-        :param chrom: str: chromosome name
-        :param outfile: output file object
+    def get_counts(self):
+        """counts reads for all chromosomes, one process per chromosome.
+        yields counts in the order of self.chromosomes
         """
-        reflen = self.chr_lengths[chrom]
-
-        chrom_excluded=None
-        if self.excluded is not None:
-            chrom_excluded = self.__get_chrom_excluded(chrom, reflen)
-
-        count = 0
-        start = 0
-        end = start + self.window_size
-        for pileupobj in data:
-            while pileupobj.pos > end:
-                self.write(chrom, start, end, count, outfile)
-                count = 0
-                start += self.window_size
-                end = min(start + self.window_size, reflen)
-
-            if not self.filter(pileupobj, chrom_excluded):
-                count += 1
-
-        #catch up with end of chromosome
-        while True:
-            self.write(chrom, start, end, count, outfile)
-            count=0
-            start += self.window_size
-            end = start + self.window_size
-            if start > reflen:
-                break
-            if end > reflen:
-                self.write(chrom, start, reflen, count, outfile)
-                break
+        jobs = []
+        for chrom in self.chromosomes:
+            reflen = self.chr_lengths[chrom]
+
+            chrom_excluded = None
+            if self.excluded is not None:
+                chrom_excluded = self.__get_chrom_excluded(chrom, reflen)
+
+            jobs.append(
+                (self.bam_path, chrom, reflen, self.window_size,
+                 self.mapq_threshold, chrom_excluded, self.chunksize)
+            )
+
+        ncores = self.__get_ncores()
+
+        if ncores == 1:
+            for job in jobs:
+                yield _count_chromosome_worker(job)
+            return
+
+        pool = multiprocessing.Pool(processes=ncores, maxtasksperchild=1)
+        try:
+            for counts in pool.imap(_count_chromosome_worker, jobs):
+                yield counts
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
     def main(self):
         """for each chromosome, iterate over all reads. use starting position
@@ -188,17 +319,11 @@ class ReadCounter(object):
             if self.seg:
                 self.write_header(None, outfile)
 
-            for chrom in self.chromosomes:
+            for chrom, counts in zip(self.chromosomes, self.get_counts()):
                 if not self.seg:
                     self.write_header(chrom, outfile)
 
-                reflen = self.chr_lengths[chrom]
-
-                # get read iterator for the full chromosome
-                # code assumes the iterator is sorted.
-                data = self.__fetch(chrom, 0, reflen)
-
-                self.get_data(data, chrom, outfile)
+                self.write(chrom, counts, outfile)
 
 
 def parse_args():
@@ -211,7 +336,7 @@ def parse_args():
                         help='specify path to the output file')
     parser.add_argument('--chromosomes',
                         nargs='*',
-                        default=map(str, range(1, 23)) + ['X', 'Y'],
+                        default=list(map(str, range(1, 23))) + ['X', 'Y'],
                         help='specify target chromosomes'
                         )
     parser.add_argument('-w', '--window_size',
@@ -233,6 +358,11 @@ def parse_args():
                         default=None,
                         help='regions to skip')
 
+    parser.add_argument('--ncores',
+                        type=int,
+                        default=None,
+                        help='number of chromosomes to count in parallel')
+
 
 
     args = parser.parse_args()
@@ -243,5 +373,6 @@ if __name__ == "__main__":
     args = parse_args()
     with ReadCounter(args.bam, args.output, args.window_size,
                      args.chromosomes, args.mapping_quality_threshold,
-                     args.seg, excluded=args.exclude_list) as rcount:
-        rcount.main()
\ No newline at end of file
+                     args.seg, excluded=args.exclude_list,
+                     ncores=args.ncores) as rcount:
+        rcount.main()
@@ -12,10 +12,10 @@ scripts = os.path.join(
 )
 
 
-def hmmcopy_readcounter(input_bam, output_wig, chromosomes, config):
+def hmmcopy_readcounter(input_bam, output_wig, chromosomes, config, ncores=None):
     rc = ReadCounter(
         input_bam, output_wig, config['w'],
-        chromosomes, config['q'],
+        chromosomes, config['q'], ncores=ncores
     )
     rc.main()
 
@@ -109,12 +109,18 @@ def create_mutect_workflow(
         name='finalise_snvs',
         ctx=helpers.get_default_ctx(
             walltime='8:00',
+            ncpus=4,
         ),
         func='wgs.utils.vcf_tasks.finalise_vcf',
         args=(
             mgd.TempInputFile('normalized.vcf'),
             mgd.OutputFile(snv_vcf, extensions=['.tbi', '.csi']),
         ),
+        kwargs={
+            'ncores': 4,
+            'reference': reference,
+            'tempdir': mgd.TempSpace('finalise_snvs_tempdir'),
+        },
     )
 
     workflow.subworkflow(
@@ -98,11 +98,14 @@ def run_mutect_one_job(
     vcf_files = [os.path.join(tempdir, str(i), 'mutect.vcf.gz') for i in range(len(intervals))]
     merge_tempdir = os.path.join(tempdir, 'mutect_merge')
     helpers.makedirs(merge_tempdir)
-    merge_vcfs(vcf_files, vcf, merge_tempdir)
+    merge_vcfs(vcf_files, vcf, merge_tempdir, reference=reference)
 
 
-def merge_vcfs(inputs, outfile, tempdir):
+def merge_vcfs(inputs, outfile, tempdir, reference=None):
     helpers.makedirs(tempdir)
     mergedfile = os.path.join(tempdir, 'merged.vcf')
     vcfutils.concatenate_vcf(inputs, mergedfile)
-    vcfutils.sort_vcf(mergedfile, outfile)
+    vcfutils.sort_vcf(
+        mergedfile, outfile, reference=reference,
+        tempdir=os.path.join(tempdir, 'sort')
+    )
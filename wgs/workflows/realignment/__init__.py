@@ -1,5 +1,6 @@
 import pypeliner
 import pypeliner.managed as mgd
+from wgs.config import config
 from wgs.utils import helpers
 from wgs.workflows import alignment
 
@@ -9,28 +10,13 @@ def realign_bam_files(
         metrics_tar, refdir,
         single_node=False,
         ignore_bamtofastq_exception=False,
-        picard_mem=8
+        picard_mem=8,
+        streaming=False
 ):
     outputs_tdf = output + '.tdf'
 
     workflow = pypeliner.workflow.Workflow()
 
-    workflow.transform(
-        name='bam_to_fastq',
-        ctx=helpers.get_default_ctx(
-            walltime='96:00',
-            disk=500
-        ),
-        func="wgs.workflows.realignment.tasks.split_by_rg",
-        args=(
-            mgd.InputFile(input),
-            mgd.TempOutputFile("inputdata_read1.fastq.gz",  "readgroup"),
-            mgd.TempOutputFile("inputdata_read2.fastq.gz",  "readgroup", axes_origin=[]),
-            mgd.TempSpace("bamtofastq"),
-            ignore_bamtofastq_exception
-        )
-    )
-
     workflow.transform(
         name='get_sample_info',
         func="wgs.workflows.realignment.tasks.get_read_group",
@@ -49,6 +35,80 @@ def realign_bam_files(
         )
     )
 
+    if streaming:
+        ref_genome = config.refdir_data(refdir)['paths']['reference']
+
+        workflow.transform(
+            name='get_readgroups',
+            func="wgs.workflows.realignment.tasks.get_readgroup_ids",
+            ret=mgd.OutputChunks('readgroup'),
+            args=(
+                mgd.InputFile(input),
+            )
+        )
+
+        workflow.transform(
+            name='realign_readgroup',
+            axes=('readgroup',),
+            ctx=helpers.get_default_ctx(
+                memory=24,
+                walltime='96:00',
+                ncpus=8,
+                disk=300
+            ),
+            func="wgs.workflows.realignment.tasks.realign_readgroup",
+            args=(
+                mgd.InputFile(input),
+                mgd.InputInstance('readgroup'),
+                mgd.TempInputObj('sample_info'),
+                mgd.TempInputObj('sample_id'),
+                ref_genome,
+                mgd.TempOutputFile('aligned_lanes.bam', 'readgroup'),
+                mgd.TempSpace('realign_readgroup_temp', 'readgroup'),
+            ),
+            kwargs={
+                'ignore_bamtofastq_exception': ignore_bamtofastq_exception,
+                'threads': 8,
+            }
+        )
+
+        workflow.subworkflow(
+            name='process_aligned_lanes',
+            func=alignment.process_aligned_lanes,
+            args=(
+                mgd.TempInputFile('aligned_lanes.bam', 'readgroup'),
+                mgd.OutputFile(output, extensions=['.bai']),
+                mgd.OutputFile(metrics_output, extensions=['.yaml']),
+                mgd.OutputFile(metrics_tar),
+                mgd.OutputFile(outputs_tdf),
+                refdir,
+                mgd.TempInputObj('sample_id')
+            ),
+            kwargs={
+                'picard_mem': picard_mem
+            }
+        )
+
+        return workflow
+
+    workflow.transform(
+        name='bam_to_fastq',
+        ctx=helpers.get_default_ctx(
+            walltime='96:00',
+            disk=500,
+            ncpus=8
+        ),
+        func="wgs.workflows.realignment.tasks.split_by_rg",
+        args=(
+            mgd.InputFile(input),
+            mgd.TempOutputFile("inputdata_read1.fastq.gz",  "readgroup"),
+            mgd.TempOutputFile("inputdata_read2.fastq.gz",  "readgroup", axes_origin=[]),
+            mgd.TempSpace("bamtofastq"),
+            ignore_bamtofastq_exception
+        ),
+        kwargs={'ncores': 8, 'parallel': True}
+    )
+
     workflow.subworkflow(
         name='align_samples',
         func=alignment.align_samples,
@@ -1,29 +1,32 @@
 #!/usr/bin/env python
+'''
+splits a bam into per read group paired fastqs.
+unmatched mates are buffered as compact (qname, seq, qual, rg, flag)
+tuples rather than pysam alignments. with --collate the bam is first
+grouped by read name, so mates are adjacent and pairing only ever
+holds a single read. with --parallel, ranges of contigs of an indexed
+bam are paired in separate processes and mates that can't be paired
+within a contig are paired in a final sweep. fastq records are batched
+per read group and written through multithreaded bgzf writers.
+'''
 
 import argparse
-import gzip
+import heapq
 import os
+import shutil
 import sys
-# from string import maketrans
+import tempfile
 
 import pysam
 from wgs.utils import helpers
 
+# reads skipped entirely: secondary and supplementary alignments
+SKIP_FLAGS = 0x100 | 0x800
 
-class OpenFile(object):
-    def __init__(self, filename, mode='rt'):
-        self.filename = filename
-        self.mode = mode
+# fastq records buffered per output file before a write
+BATCH_SIZE = 10000
 
-    def __enter__(self):
-        if self.filename.endswith(".gz"):
-            self.handle = gzip.open(self.filename, self.mode)
-        else:
-            self.handle = open(self.filename, self.mode)
-        return self.handle
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.handle.close()
+REVCOMP_TABLE = str.maketrans("AGCTagct", "TCGAtcga")
 
 
 def get_read_groups(file_name):
@@ -47,32 +50,138 @@ def get_read_groups(file_name):
     return config
 
 
-def get_bam_reader(infile):
+def get_bam_reader(infile, threads=1):
     if infile.endswith('.sam'):
         bam = pysam.Samfile(infile, 'r', check_sq=False)
     else:
-        bam = pysam.Samfile(infile, "rb", check_sq=False)
+        bam = pysam.Samfile(infile, "rb", check_sq=False, threads=threads)
 
     return bam
 
 
-def write_to_fastq(aln, read, rg, out_fastq):
-    if aln.is_reverse:
-        outstr = "@" + str(aln.qname) + "/" + str(read) + " " + "RG:Z:" + str(rg) + "\n" + str(
-            revcomp(aln.seq)) + "\n" + "+" + "\n" + str(aln.qual[::-1])
-    else:
-        outstr = "@" + str(aln.qname) + "/" + str(read) + " " + "RG:Z:" + str(rg) + "\n" + str(
-            aln.seq) + "\n" + "+" + "\n" + str(aln.qual)
-
-    out_fastq.write(outstr + '\n')
-
-
 def revcomp(seq):
-    seq1 = seq.translate(str.maketrans("AGCTagct", "TCGAtcga"))
+    seq1 = seq.translate(REVCOMP_TABLE)
     seq2 = seq1[::-1]
     return seq2
 
 
+def format_fastq(read, readnum):
+    '''
+    fastq record for a buffered read, reads on the
+    reverse strand are returned to their sequenced orientation
+    :param read: (qname, seq, qual, rg, flag) tuple
+    :param readnum: 1 or 2
+    '''
+    qname, seq, qual, rg, flag = read
+
+    if flag & 0x10:
+        seq = revcomp(seq)
+        qual = qual[::-1]
+
+    return "@{}/{} RG:Z:{}\n{}\n+\n{}\n".format(qname, readnum, rg, seq, qual)
+
+
+def iter_reads(bam, readgroup=None):
+    '''
+    primary, paired, not hard clipped reads from the bam
+    :param bam: bam reader or iterator over alignments
+    :param readgroup: only reads from this read group if set,
+    filtered before pairing so other read groups are never buffered
+    :returns (qname, seq, qual, rg, flag) tuples
+    '''
+    for al in bam:
+        flag = al.flag
+
+        # must be primary read alignment, not secondary or supplementary
+        # and must be paired
+        if flag & SKIP_FLAGS or not flag & 0x1:
+            continue
+
+        if readgroup is not None and (al.get_tag('RG') if al.has_tag('RG') else "") != readgroup:
+            continue
+
+        # ensures the read is not hard-clipped. important
+        # when the BAM doesn't have shorter hits flagged as
+        # secondary
+        cigar = al.cigarstring
+        if cigar is not None and 'H' in cigar:
+            continue
+
+        # interned so buffered reads share one copy of each read group
+        rg = sys.intern(al.get_tag('RG')) if al.has_tag('RG') else ""
+
+        yield al.query_name, al.query_sequence, al.qual, rg, flag
+
+
+def iter_pairs(reads):
+    '''
+    pairs mates from reads in any order, buffering
+    the first seen mate until the second one arrives
+    :returns (pairs generator, dict of unmatched reads)
+    '''
+    read_data = {}
+
+    def pairs():
+        for read in reads:
+            mate = read_data.pop(read[0], None)
+            if mate is None:
+                read_data[read[0]] = read
+            else:
+                yield mate, read
+
+    return pairs(), read_data
+
+
+def iter_collated_pairs(reads):
+    '''
+    pairs mates from reads grouped by name, holding at most one read
+    :returns (pairs generator, dict of unmatched reads)
+    '''
+    unmatched = {}
+
+    def pairs():
+        pending = None
+        for read in reads:
+            if pending is None:
+                pending = read
+            elif pending[0] == read[0]:
+                yield pending, read
+                pending = None
+            else:
+                unmatched[pending[0]] = pending
+                pending = read
+
+        if pending is not None:
+            unmatched[pending[0]] = pending
+
+    return pairs(), unmatched
+
+
+class FastqWriter(object):
+    '''
+    buffers fastq records and writes them in batches to a binary
+    file object, such as a bgzf writer or the stdin of an aligner
+    '''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+        if len(self.records) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            self.writer.write(''.join(self.records).encode())
+            self.records = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
 def get_outfiles(outdir, readgroups):
     outfiles = {}
 
@@ -85,12 +194,16 @@ def get_outfiles(outdir, readgroups):
     return outfiles
 
 
-def open_outfiles(outfiles):
+def open_outfiles(outfiles, ncores=1):
+    # split the compression threads over all the files, reads are
+    # interleaved across read groups so all writers stay busy
+    threads = max(1, ncores // max(1, 2 * len(outfiles)))
+
     opened_files = {}
     for rgid, fastqs in outfiles.items():
         opened_files[rgid] = (
-            OpenFile(fastqs[0], 'wt').__enter__(),
-            OpenFile(fastqs[1], 'wt').__enter__()
+            FastqWriter(helpers.ParallelBgzfWriter(fastqs[0], ncores=threads)),
+            FastqWriter(helpers.ParallelBgzfWriter(fastqs[1], ncores=threads))
         )
     return opened_files
 
@@ -101,66 +214,267 @@ def close_outfiles(outfiles):
         fastqs[1].close()
 
 
-def bam_to_fastq(infile, outdir, ignore_bamtofastq_exception):
-    readgroups = get_read_groups(infile)
+def collate_bam(infile, output, tempdir, ncores=1):
+    '''
+    groups the reads in infile by name, same as samtools collate
+    :param infile: input bam
+    :param output: name collated bam
+    :param tempdir: directory for the collate temp files
+    :param ncores: number of threads
+    '''
+    helpers.makedirs(tempdir)
+    pysam.collate(
+        '-l', '1', '-@', str(ncores), '-o', output,
+        infile, os.path.join(tempdir, 'collate'),
+        catch_stdout=False
+    )
+
+
+def write_pairs(pairs, outfiles):
+    for mate, read in pairs:
+        # output files are picked by the read group of the second
+        # mate, each record keeps the read group of its own read
+        fastq_r1, fastq_r2 = outfiles[read[3]]
+
+        if read[4] & 0x40:
+            fastq_r1.write(format_fastq(read, 1))
+            fastq_r2.write(format_fastq(mate, 2))
+        else:
+            fastq_r1.write(format_fastq(mate, 1))
+            fastq_r2.write(format_fastq(read, 2))
 
-    outfiles = get_outfiles(outdir,readgroups)
+
+def is_indexed_bam(infile):
+    if infile.endswith('.sam'):
+        return False
+
+    bam = pysam.AlignmentFile(infile, 'rb', check_sq=False)
+    indexed = bam.has_index()
+    bam.close()
+
+    return indexed
+
+
+def get_contig_ranges(infile, nranges):
+    '''
+    splits the contigs, in file order, into consecutive ranges with
+    similar numbers of reads. unplaced unmapped reads are not included
+    :param infile: indexed bam
+    :param nranges: number of ranges
+    :returns list of lists of (contig index, contig name)
+    '''
+    bam = pysam.AlignmentFile(infile, 'rb', check_sq=False)
+    counts = [
+        (bam.get_tid(stat.contig), stat.contig, stat.total)
+        for stat in bam.get_index_statistics() if stat.total
+    ]
+    bam.close()
+
+    target = sum(count for _, _, count in counts) / float(max(1, nranges))
+
+    ranges = []
+    current = []
+    size = 0
+    for tid, contig, count in counts:
+        current.append((tid, contig))
+        size += count
+        if size >= target:
+            ranges.append(current)
+            current = []
+            size = 0
+    if current:
+        ranges.append(current)
+
+    return ranges
+
+
+def spill_reads(reads, spill_file):
+    '''
+    writes reads sorted by name to spill_file
+    :param reads: (qname, seq, qual, rg, flag) tuples
+    '''
+    with open(spill_file, 'w') as writer:
+        for read in sorted(reads, key=lambda read: read[0]):
+            writer.write('\t'.join(map(str, read)) + '\n')
+
+
+def load_spilled_reads(spill_file):
+    with open(spill_file) as reader:
+        for line in reader:
+            qname, seq, qual, rg, flag = line.rstrip('\n').split('\t')
+            yield qname, seq, qual, rg, int(flag)
+
+
+def get_spill_file(spilldir, tid):
+    return os.path.join(spilldir, '{}.tsv'.format(tid))
+
+
+def bam_to_fastq_contigs(infile, contigs, outdir, spilldir):
+    '''
+    pairs the reads on each of contigs. mates on other contigs and
+    reads left unmatched are spilled to one file per contig, sorted
+    by name, to be paired by sweep_spilled_reads
+    :param infile: indexed bam
+    :param contigs: list of (contig index, contig name), '*' for
+    the unplaced unmapped reads
+    :param outdir: output directory for this range
+    :param spilldir: directory for the spill files
+    '''
+    outfiles = get_outfiles(outdir, get_read_groups(infile))
     outfiles = open_outfiles(outfiles)
 
-    read_data = {}
+    bam = pysam.AlignmentFile(infile, 'rb', check_sq=False)
+
+    for tid, contig in contigs:
+        pairs, unmatched = iter_pairs(iter_reads(bam.fetch(contig)))
+        write_pairs(pairs, outfiles)
+        spill_reads(unmatched.values(), get_spill_file(spilldir, tid))
+
+    bam.close()
+
+    close_outfiles(outfiles)
+
+
+def sweep_spilled_reads(spill_files, outdir, readgroups):
+    '''
+    pairs the spilled reads. spill files are merged by name, ties keep
+    the order of spill_files so the second mate is the same as in a
+    serial pass over the bam
+    :param spill_files: spill files in contig order
+    :param outdir: output directory for the swept pairs
+    :param readgroups: read group ids
+    :returns dict of unmatched reads
+    '''
+    outfiles = get_outfiles(outdir, readgroups)
+    outfiles = open_outfiles(outfiles)
+
+    reads = heapq.merge(
+        *[load_spilled_reads(spill_file) for spill_file in spill_files],
+        key=lambda read: read[0]
+    )
+    pairs, unmatched = iter_collated_pairs(reads)
+    write_pairs(pairs, outfiles)
+
+    close_outfiles(outfiles)
+
+    return unmatched
+
+
+def bam_to_fastq_parallel(infile, outdir, tempdir, ncores=1):
+    '''
+    pairs reads on ranges of contigs in parallel, the unplaced unmapped
+    reads are handled by their own worker. pairs that can't be matched
+    within a contig are paired in a final sweep over the spilled reads
+    :returns dict of unmatched reads
+    '''
+    readgroups = get_read_groups(infile)
+
+    spilldir = os.path.join(tempdir, 'spill')
+    helpers.makedirs(spilldir)
+
+    bam = pysam.AlignmentFile(infile, 'rb', check_sq=False)
+    unmapped_tid = bam.nreferences
+    bam.close()
+
+    # more ranges than cores to balance uneven contigs
+    ranges = get_contig_ranges(infile, 4 * ncores)
+    ranges.append([(unmapped_tid, '*')])
+
+    partdirs = [os.path.join(tempdir, 'parts', str(i)) for i in range(len(ranges))]
+
+    helpers.run_in_process_pool(
+        bam_to_fastq_contigs,
+        [(infile, contigs, partdir, spilldir) for contigs, partdir in zip(ranges, partdirs)],
+        ncores
+    )
+
+    spill_files = [
+        get_spill_file(spilldir, tid) for contigs in ranges for tid, _ in contigs
+    ]
+    sweepdir = os.path.join(tempdir, 'parts', 'sweep')
+    unmatched = sweep_spilled_reads(spill_files, sweepdir, readgroups)
+    partdirs.append(sweepdir)
+
+    for rgid, fastqs in get_outfiles(outdir, readgroups).items():
+        for i, fastq in enumerate(fastqs):
+            parts = [get_outfiles(partdir, [rgid])[rgid][i] for partdir in partdirs]
+            helpers.concatenate_files(parts, fastq)
+
+    return unmatched
+
+
+def bam_to_fastq_serial(infile, outdir, collate=False, tempdir=None, ncores=1):
+    '''
+    pairs reads in a single pass over the bam
+    :returns dict of unmatched reads
+    '''
+    readgroups = get_read_groups(infile)
+
+    outfiles = get_outfiles(outdir, readgroups)
+    outfiles = open_outfiles(outfiles, ncores=ncores)
+
+    if collate:
+        collated = os.path.join(tempdir, 'collated.bam')
+        collate_bam(infile, collated, tempdir, ncores=ncores)
+        infile = collated
 
     bam = get_bam_reader(infile)
 
-    for al in bam:
+    if collate:
+        pairs, unmatched = iter_collated_pairs(iter_reads(bam))
+    else:
+        pairs, unmatched = iter_pairs(iter_reads(bam))
 
-        # must be primary read alignment, not secondary or supplementary
-        if al.is_secondary or al.flag & 2048 == 2048:
-            continue
+    write_pairs(pairs, outfiles)
 
-        # skip unpaired reads
-        if not al.is_paired:
-            continue
+    bam.close()
 
-        # ensures the read is not hard-clipped. important
-        # when the BAM doesn't have shorter hits flagged as
-        # secondary
-        if al.cigar is not None and 5 in [x[0] for x in al.cigar]:
-            continue
+    close_outfiles(outfiles)
 
-        # add read name to dictionary if not already there
-        key = al.qname
-        if key not in read_data:
-            read_data.setdefault(key, al)
-        # print matched read pairs
-        else:
-            # RG:Z:ID
-            try:
-                RG1 = read_data[key].opt('RG')
-            except KeyError:
-                RG1 = ""
-            try:
-                RG2 = al.opt('RG')
-            except KeyError:
-                RG2 = ""
-
-            rgid = str(al.opt('RG'))
-            fastq_r1 = outfiles[rgid][0]
-            fastq_r2 = outfiles[rgid][1]
-
-            if al.is_read1:
-                write_to_fastq(al, 1, RG2, fastq_r1)
-                write_to_fastq(read_data[key], 2, RG1, fastq_r2)
-            else:
-                write_to_fastq(read_data[key], 1, RG1, fastq_r1)
-                write_to_fastq(al, 2, RG2, fastq_r2)
-            del read_data[key]
-    if len(read_data) != 0:
+    return unmatched
+
+
+def check_unmatched(unmatched, ignore_bamtofastq_exception):
+    if len(unmatched) != 0:
         if ignore_bamtofastq_exception:
-            sys.stderr.write('Warning: %s unmatched name groups\n' % len(read_data))
+            sys.stderr.write('Warning: %s unmatched name groups\n' % len(unmatched))
         else:
-            raise Exception('Warning: %s unmatched name groups\n' % len(read_data))
+            raise Exception('Warning: %s unmatched name groups\n' % len(unmatched))
+
+
+def bam_to_fastq(
+        infile, outdir, ignore_bamtofastq_exception,
+        collate=False, parallel=False, tempdir=None, ncores=1
+):
+    '''
+    writes the reads in infile to outdir/<readgroup>/R1.fastq.gz
+    and outdir/<readgroup>/R2.fastq.gz
+    :param infile: input bam or sam
+    :param outdir: output directory
+    :param ignore_bamtofastq_exception: warn instead of failing on unmatched reads
+    :param collate: group the reads by name before pairing
+    :param parallel: pair reads on ranges of contigs in parallel,
+    needs an indexed bam, falls back to a serial pass otherwise
+    :param tempdir: temporary directory for the collated bam or spilled reads
+    :param ncores: number of processes for parallel, otherwise
+    threads for collating and compression
+    '''
+    if parallel and not is_indexed_bam(infile):
+        sys.stderr.write('Warning: %s is not indexed, running serially\n' % infile)
+        parallel = False
+
+    workdir = tempfile.mkdtemp(dir=tempdir)
+
+    if parallel:
+        unmatched = bam_to_fastq_parallel(infile, outdir, workdir, ncores=ncores)
+    else:
+        unmatched = bam_to_fastq_serial(
+            infile, outdir, collate=collate, tempdir=workdir, ncores=ncores
+        )
 
-    close_outfiles(outfiles)
+    shutil.rmtree(workdir)
+
+    check_unmatched(unmatched, ignore_bamtofastq_exception)
 
 
 def parse_args():
@@ -183,6 +497,33 @@ def parse_args():
         help='ignore exception'
     )
 
+    parser.add_argument(
+        '--collate',
+        default=False,
+        action='store_true',
+        help='group reads by name before pairing, bounds memory on coordinate sorted bams'
+    )
+
+    parser.add_argument(
+        '--parallel',
+        default=False,
+        action='store_true',
+        help='pair reads on ranges of contigs in parallel, needs an indexed bam'
+    )
+
+    parser.add_argument(
+        '--tempdir',
+        default=None,
+        help='temporary directory for --collate and --parallel'
+    )
+
+    parser.add_argument(
+        '--ncores',
+        default=1,
+        type=int,
+        help='number of processes for --parallel, threads for collate and compression'
+    )
+
     args = parser.parse_args()
 
     args = vars(args)
@@ -191,7 +532,11 @@ def parse_args():
 
 def main():
     args = parse_args()
-    bam_to_fastq(args['input'], args['outdir'], args['ignore_bamtofastq_exception'])
+    bam_to_fastq(
+        args['input'], args['outdir'], args['ignore_bamtofastq_exception'],
+        collate=args['collate'], parallel=args['parallel'],
+        tempdir=args['tempdir'], ncores=args['ncores']
+    )
 
 
 if __name__ == '__main__':
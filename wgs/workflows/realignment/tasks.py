@@ -5,39 +5,53 @@ Created on Aug, 2019
 '''
 
 import os
+import subprocess
 
 import pypeliner
 import pysam
 import time
 from wgs.utils import helpers
+from wgs.workflows.alignment import tasks as alignment_tasks
+from wgs.workflows.realignment import bamtofastq
 
 
 def split_by_rg(
         infile, read1_output, read2_output,
-        tempdir, ignore_bamtofastq_exception
+        tempdir, ignore_bamtofastq_exception,
+        collate=False, parallel=False, ncores=1
 ):
-    helpers.makedirs(tempdir)
+    outdir = os.path.join(tempdir, 'fastqs')
+    workdir = os.path.join(tempdir, 'work')
+    helpers.makedirs(outdir)
+    helpers.makedirs(workdir)
 
-    cmd = ['wgs_bamtofastq', infile, tempdir]
+    cmd = [
+        'wgs_bamtofastq', infile, outdir,
+        '--tempdir', workdir, '--ncores', ncores
+    ]
 
     if ignore_bamtofastq_exception:
         cmd.append('--ignore_bamtofastq_exception')
+    if collate:
+        cmd.append('--collate')
+    if parallel:
+        cmd.append('--parallel')
     pypeliner.commandline.execute(*cmd)
 
     try:
-        readgroups = os.listdir(tempdir)
+        readgroups = os.listdir(outdir)
     except OSError:
         time.sleep(60)
-        readgroups = os.listdir(tempdir)
+        readgroups = os.listdir(outdir)
 
     for readgroup in readgroups:
         os.rename(
-            os.path.join(tempdir, readgroup, 'R1.fastq.gz'),
+            os.path.join(outdir, readgroup, 'R1.fastq.gz'),
             read1_output[readgroup]
         )
 
         os.rename(
-            os.path.join(tempdir, readgroup, 'R2.fastq.gz'),
+            os.path.join(outdir, readgroup, 'R2.fastq.gz'),
             read2_output[readgroup]
         )
 
@@ -61,3 +75,81 @@ def get_sample_id(sample_info):
     assert len(set(samples)) == 1
 
     return samples[0]
+
+
+def get_readgroup_ids(infile):
+    return list(get_read_group(infile).keys())
+
+
+def realign_readgroup(
+        infile, readgroup_id, sample_info, sample_id, reference,
+        output, tempdir, ignore_bamtofastq_exception=False,
+        threads=8, mem='2G'
+):
+    '''
+    realigns one read group without writing fastqs to disk. pairs are
+    streamed from the bam into bwa mem as interleaved fastq and the
+    alignments are piped straight into samtools sort, so temp space
+    only holds the sort spill files
+    :param infile: input bam
+    :param readgroup_id: id of the read group to realign
+    :param sample_info: read group id:read group header dictionary
+    :param sample_id: sample id
+    :param reference: bwa indexed reference genome
+    :param output: coordinate sorted bam
+    :param tempdir: temp space for samtools sort
+    :param ignore_bamtofastq_exception: warn instead of failing on unmatched reads
+    :param threads: threads for bwa mem and samtools sort
+    :param mem: samtools sort memory per thread
+    '''
+    helpers.makedirs(tempdir)
+
+    readgroup = alignment_tasks.get_readgroup(
+        dict(sample_info[readgroup_id]), sample_id, readgroup_id
+    )
+
+    bwa_cmd = [
+        'bwa', 'mem', '-M', '-p', '-R', readgroup,
+        '-t', str(threads), reference, '-'
+    ]
+    sort_cmd = [
+        'samtools', 'sort', '-@', str(threads), '-m', mem,
+        '-T', os.path.join(tempdir, 'samtools_sort'),
+        '-o', output, '-'
+    ]
+
+    bwa = subprocess.Popen(bwa_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    sort = subprocess.Popen(sort_cmd, stdin=bwa.stdout)
+    bwa.stdout.close()
+
+    # both mates go to the same writer, so bwa sees interleaved pairs
+    writer = bamtofastq.FastqWriter(bwa.stdin)
+    outfiles = {readgroup_id: (writer, writer)}
+
+    # reads of other read groups are dropped before pairing, so only
+    # this read group's unpaired mates are held in memory
+    bam = bamtofastq.get_bam_reader(infile, threads=2)
+    pairs, unmatched = bamtofastq.iter_pairs(
+        bamtofastq.iter_reads(bam, readgroup=readgroup_id)
+    )
+
+    try:
+        bamtofastq.write_pairs(pairs, outfiles)
+        writer.close()
+    except BrokenPipeError:
+        # bwa exited early, reported through its return code
+        pass
+    except Exception:
+        bwa.kill()
+        sort.kill()
+        raise
+    finally:
+        bam.close()
+
+    for cmd, proc in ((bwa_cmd, bwa), (sort_cmd, sort)):
+        if proc.wait() != 0:
+            raise Exception(
+                '{} failed with return code {}'.format(' '.join(cmd), proc.returncode)
+            )
+
+    bamtofastq.check_unmatched(unmatched, ignore_bamtofastq_exception)
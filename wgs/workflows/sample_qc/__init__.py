@@ -53,86 +53,28 @@ def circos_plot(titan_calls, remixt_calls, sample_id, breakpoints,
 
 def get_coverage_data(
         input_bam, output, refdir, chromosomes,
-        mapping_qual, bins, single_node=False
+        mapping_qual, bins, coverage_mode='exact'
 ):
     reference = config.refdir_data(refdir)['paths']['reference']
 
     workflow = pypeliner.workflow.Workflow()
 
-    if single_node:
-        workflow.transform(
-            name='generate_coverage_bed',
-            func='wgs.workflows.sample_qc.tasks.generate_coverage_bed',
-            ctx=helpers.get_default_ctx(
-                memory=5
-            ),
-            args=(
-                reference,
-                mgd.TempOutputFile('coverage_bed.bed'),
-                chromosomes,
-                bins,
-            )
-        )
-        workflow.transform(
-            name='samtools_coverage',
-            func='wgs.workflows.sample_qc.tasks.samtools_coverage',
-            ctx=helpers.get_default_ctx(
-                memory=5
-            ),
-            args=(
-                mgd.InputFile(input_bam),
-                mgd.TempInputFile('coverage_bed.bed'),
-                mgd.TempOutputFile('per_interval.txt', 'chromosome'),
-                mapping_qual,
-
-            ),
-        )
-
-    else:
-        workflow.setobj(
-            obj=mgd.OutputChunks('chromosome'),
-            value=chromosomes
-        )
-        workflow.transform(
-            name='generate_coverage_bed',
-            func='wgs.workflows.sample_qc.tasks.generate_coverage_bed',
-            ctx=helpers.get_default_ctx(
-                memory=5
-            ),
-            axes=('chromosome',),
-            args=(
-                reference,
-                mgd.TempOutputFile('coverage_bed.bed', 'chromosome'),
-                mgd.InputInstance('chromosome'),
-                bins,
-            )
-        )
-        workflow.transform(
-            name='samtools_coverage',
-            func='wgs.workflows.sample_qc.tasks.samtools_coverage',
-            ctx=helpers.get_default_ctx(
-                memory=5
-            ),
-            axes=('chromosome',),
-            args=(
-                mgd.InputFile(input_bam),
-                mgd.TempInputFile('coverage_bed.bed', 'chromosome'),
-                mgd.TempOutputFile('per_interval.txt', 'chromosome'),
-                mapping_qual,
-            ),
-        )
-
-        workflow.transform(
-            name='merge_data',
-            func='wgs.utils.csvutils.concatenate_csv',
-            ctx=helpers.get_default_ctx(
-                memory=5
-            ),
-            args=(
-                mgd.TempInputFile('per_interval.txt', 'chromosome', axes_origin=[]),
-                mgd.OutputFile(output),
-            )
-        )
+    workflow.transform(
+        name='bam_coverage',
+        func='wgs.workflows.sample_qc.tasks.bam_coverage',
+        ctx=helpers.get_default_ctx(
+            memory=5,
+            ncpus=8,
+        ),
+        args=(
+            mgd.InputFile(input_bam, extensions=['.bai']),
+            reference,
+            mgd.OutputFile(output),
+            chromosomes,
+            mapping_qual,
+        ),
+        kwargs={'bins_per_chrom': bins, 'mode': coverage_mode, 'ncores': 8}
+    )
 
     return workflow
 
@@ -158,6 +100,7 @@ def create_sample_qc_workflow(
         mapping_qual_threshold,
         single_node=False,
         sex='female',
+        coverage_mode='exact',
 ):
 
     workflow = pypeliner.workflow.Workflow()
@@ -173,7 +116,7 @@ def create_sample_qc_workflow(
             mapping_qual_threshold,
             bins,
         ),
-        kwargs={'single_node': single_node}
+        kwargs={'coverage_mode': coverage_mode}
     )
 
     workflow.subworkflow(
@@ -187,7 +130,7 @@ def create_sample_qc_workflow(
             mapping_qual_threshold,
             bins,
         ),
-        kwargs={'single_node': single_node}
+        kwargs={'coverage_mode': coverage_mode}
     )
 
 
@@ -195,6 +138,7 @@ def create_sample_qc_workflow(
         name='generate_genome_wide_plot',
         ctx=helpers.get_default_ctx(
             memory=10,
+            ncpus=8,
         ),
         func="wgs.workflows.sample_qc.tasks.genome_wide",
         args=(
@@ -204,6 +148,7 @@ def create_sample_qc_workflow(
             mgd.InputFile(normal_coverage),
             chromosomes,
             mgd.OutputFile(genome_wide_plot),
+            mgd.TempSpace('genome_wide_plot_temp'),
         ),
         kwargs={"titan": mgd.InputFile(titan),
             "somatic": mgd.InputFile(somatic_calls),
@@ -211,6 +156,7 @@ def create_sample_qc_workflow(
             "tumour": mgd.InputFile(tumour_coverage),
             "breakpoints": mgd.InputFile(breakpoints_consensus),
             "sex": sex,
+            "ncores": 8,
         }
     )
 
@@ -230,6 +176,7 @@ def create_sample_qc_workflow_normal_only(
         mapping_qual_threshold,
         single_node=False,
         sex='female',
+        coverage_mode='exact',
 ):
 
     workflow = pypeliner.workflow.Workflow()
@@ -245,7 +192,7 @@ def create_sample_qc_workflow_normal_only(
             mapping_qual_threshold,
             bins,
         ),
-        kwargs={'single_node': single_node}
+        kwargs={'coverage_mode': coverage_mode}
     )
 
 
@@ -254,6 +201,7 @@ def create_sample_qc_workflow_normal_only(
         name='generate_genome_wide_plot',
         ctx=helpers.get_default_ctx(
             memory=10,
+            ncpus=8,
         ),
         func="wgs.workflows.sample_qc.tasks.genome_wide",
         args=(
@@ -263,9 +211,11 @@ def create_sample_qc_workflow_normal_only(
             mgd.InputFile(normal_coverage),
             chromosomes,
             mgd.OutputFile(genome_wide_plot),
+            mgd.TempSpace('genome_wide_plot_temp'),
         ),
         kwargs={"normal_only":True,
-                "sex":sex,}
+                "sex":sex,
+                "ncores": 8,}
     )
 
     return workflow
@@ -1,3 +1,5 @@
+import os
+
 import matplotlib
 import pandas as pd
 
@@ -24,6 +26,10 @@ from wgs_qc_utils.reader import parse_snv_cn
 
 from wgs_qc_utils.reader.ideogram import read_ideogram
 
+from wgs.utils import binutils
+from wgs.utils import helpers
+from wgs.utils import pdfutils
+
 
 
 
@@ -60,9 +66,9 @@ def plot_chrom_on_axes(
     if pd.isnull(coverage_ylim_max):
         coverage_ylim_min = 0
 
-    prepped_normal_coverage_cap = prepped_normal_coverage.coverage.quantile(
-            coverage_cap_quantile
-        )
+    prepped_normal_coverage_cap = binutils.quantile(
+        prepped_normal_coverage.coverage, coverage_cap_quantile
+    )
 
     if not normal_only:
         prepped_remixt = read_remixt.prepare_at_chrom(remixt, chrom)
@@ -75,8 +81,8 @@ def plot_chrom_on_axes(
         prepped_breakpoints = read_variant_calls.prepare_at_chrom(
             breakpoints, chrom, n_bins=2000
         )
-        prepped_tumour_coverage_cap = prepped_tumour_coverage.coverage.quantile(
-                coverage_cap_quantile
+        prepped_tumour_coverage_cap = binutils.quantile(
+            prepped_tumour_coverage.coverage, coverage_cap_quantile
         )
         if prepped_tumour_coverage_cap > coverage_ylim_max:
             coverage_ylim_max = 50 * ((int(prepped_tumour_coverage_cap) / 50) + 1)
@@ -212,29 +218,55 @@ def _make_axes(ideogram, chrom, sample, fig, normal_only=False):
     return axes
 
 
-def genome_wide_plot(
-        remixt, remixt_label, titan, roh, germline_calls, somatic_calls,
-        tumour_coverage, normal_coverage, breakpoints, chromosomes, pdf,
-        normal_only=False, sex="female", 
-):
+def normalize_chromosome(chrom):
     """
-    make a genome wide plot
-    :param remixt: remixt copy number data
-    :param remixt_label: label (sample ID) for remixt
-    :param titan: titan copy number data
-    :param roh: roh data
-    :param germline_calls: germline data
-    :param somatic_calls: somatic data
-    :param tumour_coverage: tumour coverage data
-    :param normal_coverage: normal coverage data
-    :param breakpoints: somatic breakpoint data
-    :param chromosomes: input chromosome list
-    :param pdf: output pdf object
-    :param normal_only: data doesn't include tumor (default: False)
-    :param sex: sex of the patient (default: 'female') ['female', 'male']
+    chromosome name as used for the plotted chromosome list,
+    lower case without the chr prefix
     """
+    return str(chrom).lower().replace('chr', '')
 
-    pdf = matplotlib.backends.backend_pdf.PdfPages(pdf)
+
+def split_by_chromosome(data, column='chrom'):
+    """
+    split a table into per chromosome tables in one pass,
+    keyed by the normalized chromosome name
+    :param data: dataframe or None
+    :param column: chromosome column
+    :return: dict with chromosome and dataframe, None if data is None
+    """
+    if data is None:
+        return None
+
+    split_data = {}
+    for chrom, chrom_data in data.groupby(column, sort=False):
+        chrom = normalize_chromosome(chrom)
+        if chrom in split_data:
+            # names that only differ in case or prefix
+            chrom_data = pd.concat([split_data[chrom], chrom_data])
+        split_data[chrom] = chrom_data
+
+    return split_data
+
+
+def get_chromosome_data(data, empty, chrom):
+    """
+    per chromosome table from split_by_chromosome,
+    an empty table with the same columns if there is no data
+    """
+    if data is None:
+        return None
+    return data.get(chrom, empty)
+
+
+def load_data(
+        remixt, titan, roh, germline_calls, somatic_calls,
+        tumour_coverage, normal_coverage, breakpoints, normal_only=False
+):
+    """
+    read all inputs once, chromosome names are stripped of the chr prefix
+    :return: dict with the name and dataframe of each input,
+    inputs that are not used are None
+    """
     roh = read_roh.read(roh)
     roh['chrom'] = roh['chrom'].str.replace('chr', '')
     germline_calls = read_variant_calls.read(germline_calls)
@@ -262,26 +294,110 @@ def genome_wide_plot(
         snv_copynumber = parse_snv_cn.parse(somatic_calls, remixt)
         snv_copynumber['chrom'] = snv_copynumber['chrom'].str.replace('chr', '')
 
-    ideogram = read_ideogram.read()
+    return {
+        'remixt': remixt,
+        'titan': titan,
+        'roh': roh,
+        'germline_calls': germline_calls,
+        'somatic_calls': somatic_calls,
+        'tumour_coverage': tumour_coverage,
+        'normal_coverage': normal_coverage,
+        'breakpoints': breakpoints,
+        'vaf_data': snv_copynumber,
+        'ideogram': read_ideogram.read(),
+    }
+
+
+def plot_chromosome(chrom_data, chrom, sample, pdf, normal_only=False):
+    """
+    plot one chromosome to a single page pdf
+    :param chrom_data: dict with the per chromosome data of each input
+    :param chrom: chromosome to plot
+    :param sample: sample id for the title
+    :param pdf: output pdf
+    :param normal_only: data doesn't include tumor (default: False)
+    """
+    fig = plt.figure(constrained_layout=True, figsize=(15, 10))
+
+    axes = _make_axes(chrom_data['ideogram'], chrom, sample, fig,
+                      normal_only=normal_only)
+
+    axes = plot_chrom_on_axes(chrom_data['remixt'], chrom_data['titan'],
+                              chrom_data['roh'], chrom_data['germline_calls'],
+                              chrom_data['somatic_calls'], chrom_data['tumour_coverage'],
+                              chrom_data['normal_coverage'], chrom_data['breakpoints'],
+                              chrom_data['vaf_data'], chrom_data['ideogram'], chrom,
+                              axes, normal_only=normal_only)
+
+    rasterize_axes(axes)
+
+    plt.tight_layout()
+
+    pdf = matplotlib.backends.backend_pdf.PdfPages(pdf)
+    pdf.savefig(fig)
+    pdf.close()
+
+    plt.close(fig)
+
+
+def genome_wide_plot(
+        remixt, remixt_label, titan, roh, germline_calls, somatic_calls,
+        tumour_coverage, normal_coverage, breakpoints, chromosomes, pdf,
+        tempdir, normal_only=False, sex="female", ncores=1,
+):
+    """
+    make a genome wide plot
+    :param remixt: remixt copy number data
+    :param remixt_label: label (sample ID) for remixt
+    :param titan: titan copy number data
+    :param roh: roh data
+    :param germline_calls: germline data
+    :param somatic_calls: somatic data
+    :param tumour_coverage: tumour coverage data
+    :param normal_coverage: normal coverage data
+    :param breakpoints: somatic breakpoint data
+    :param chromosomes: input chromosome list
+    :param pdf: output pdf
+    :param tempdir: temporary directory for the per chromosome pages
+    :param normal_only: data doesn't include tumor (default: False)
+    :param sex: sex of the patient (default: 'female') ['female', 'male']
+    :param ncores: number of chromosomes plotted in parallel
+    """
+    helpers.makedirs(tempdir)
+
+    data = load_data(
+        remixt, titan, roh, germline_calls, somatic_calls, tumour_coverage,
+        normal_coverage, breakpoints, normal_only=normal_only
+    )
+
+    # inputs are split by chromosome once so that each
+    # chromosome only filters and pickles its own rows.
+    # the ideogram is small and passed whole, read_ideogram
+    # selects the chromosome itself
+    ideogram = data.pop('ideogram')
 
-    chromosomes = [chrom.lower().replace('chr', '') for chrom in chromosomes]
+    split_data = {}
+    empty_data = {}
+    for name, table in data.items():
+        column = 'Chrom' if name == 'titan' else 'chrom'
+        split_data[name] = split_by_chromosome(table, column)
+        empty_data[name] = table.iloc[:0] if table is not None else None
+
+    chromosomes = [normalize_chromosome(chrom) for chrom in chromosomes]
     if sex == 'female':
         if 'Y' in chromosomes: chromosomes.remove('Y')
         if 'y' in chromosomes: chromosomes.remove('y')
 
+    args = []
     for chrom in chromosomes:
-        fig = plt.figure(constrained_layout=True, figsize=(15, 10))
-
-        axes = _make_axes(ideogram, chrom, remixt_label, fig, 
-                          normal_only=normal_only)
+        chrom_data = {
+            name: get_chromosome_data(split_data[name], empty_data[name], chrom)
+            for name in data
+        }
+        chrom_data['ideogram'] = ideogram
+        chrom_pdf = os.path.join(tempdir, '{}.pdf'.format(chrom))
+        args.append((chrom_data, chrom, remixt_label, chrom_pdf, normal_only))
 
-        axes = plot_chrom_on_axes(remixt, titan, roh, germline_calls,
-                                  somatic_calls, tumour_coverage,
-                                  normal_coverage, breakpoints, snv_copynumber,
-                                  ideogram, chrom, axes, normal_only=normal_only)
+    helpers.run_in_process_pool(plot_chromosome, args, ncores)
 
-        rasterize_axes(axes)
-
-        plt.tight_layout()
-        pdf.savefig(fig)
-    pdf.close()
+    pdfutils.merge_pdfs([arg[3] for arg in args], pdf)
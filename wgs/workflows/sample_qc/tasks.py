@@ -6,6 +6,9 @@ from wgs.workflows.sample_qc import genome_wide_plot
 from wgs_qc_utils.plotter import gene_annotation_plotting
 from wgs_qc_utils.reader import read_titan, read_remixt
 import gzip
+from wgs.utils import bamutils
+from wgs.utils import binutils
+from wgs.utils import csvutils
 from wgs.utils import helpers
 import os
 import shutil 
@@ -41,47 +44,86 @@ def bin_data(positions, copy_number, state, n_bins, start, extent):
     bin coverage data
     '''
     bins = np.linspace(start, extent, n_bins)
-    digitized = np.digitize(positions, bins)
+    index = binutils.get_bin_index(positions, bins)
 
-    position = [positions[digitized == i].mean() for i in range(1, len(bins))]
-    lr = [copy_number[positions[digitized == i].index].mean() for i in range(1, len(bins))]
-    state = [state[positions[digitized == i].index].mean() for i in range(1, len(bins))]
+    nbins = len(bins) - 1
 
     return pd.DataFrame(
-        {"Position": position,
-         "LogRatio": lr,
-         "state": state}
+        {"Position": binutils.bin_mean(index, positions, nbins),
+         "LogRatio": binutils.bin_mean(index, copy_number, nbins),
+         "state": binutils.bin_mean(index, state, nbins)}
     )
 
 
-def generate_coverage_bed(ref, bins_out, chromosomes, bins_per_chrom=2000):
+def get_coverage_bins(ref, chromosomes, bins_per_chrom=2000):
+    """
+    fixed size coverage bins for each chromosome in the reference
+    :return: list of chromosome, bin starts and bin ends
+    """
     fasta = pysam.FastaFile(ref)
 
+    if isinstance(chromosomes, str):
+        chromosomes = [chromosomes]
+
     chroms = dict(zip(fasta.references, fasta.lengths))
     chroms = {k: v for k, v in chroms.items() if k in chromosomes}
 
-    chroms_all = []
-    starts_all = []
-    ends_all = []
+    bin_index = np.arange(bins_per_chrom, dtype=np.int64)
 
+    bins = []
     for chrom, length in chroms.items():
         step_size = int(length / bins_per_chrom)
 
-        starts = [str(int(i * step_size) + 1) for i in range(bins_per_chrom)]
-        ends = [str(int((i + 1) * step_size)) for i in range(bins_per_chrom)]
+        bins.append((chrom, bin_index * step_size + 1, (bin_index + 1) * step_size))
+
+    return bins
 
-        assert len(starts) == len(ends)
-        chroms = [chrom] * len(starts)
 
-        starts_all += starts
-        ends_all += ends
-        chroms_all += chroms
+def bam_coverage(
+        bam_file, ref, output, chromosomes,
+        mapping_qual, bins_per_chrom=2000, mode='exact', ncores=1
+):
+    """
+    coverage sum per bin, each chromosome is read
+    from the bam index once in a process pool. in approximate
+    mode coverage is estimated from the bam index instead,
+    see bamutils.get_approximate_binned_coverage for the error bound
+    :param bam_file: indexed bam file
+    :param ref: reference fasta, used for the chromosome lengths
+    :param output: tsv with chrom, start, end and sum_cov columns
+    :param chromosomes: chromosomes to include
+    :param mapping_qual: minimum mapping quality
+    :param bins_per_chrom: number of bins per chromosome
+    :param mode: exact or approximate
+    :param ncores: number of chromosomes read in parallel
+    """
+    bins = get_coverage_bins(ref, chromosomes, bins_per_chrom=int(bins_per_chrom))
+
+    if mode == 'approximate':
+        coverage = bamutils.get_approximate_binned_coverage(
+            bam_file, bins, mapping_qual=int(mapping_qual)
+        )
+    elif mode == 'exact':
+        args = [
+            (bam_file, chrom, starts, ends, int(mapping_qual))
+            for chrom, starts, ends in bins
+        ]
 
-    out = pd.DataFrame({"chrom": chroms_all, "starts": starts_all, "ends": ends_all})
+        coverage = helpers.run_in_process_pool(bamutils.get_binned_coverage, args, ncores)
+    else:
+        raise Exception("unknown coverage mode: {}".format(mode))
+
+    data = [
+        pd.DataFrame({"chrom": chrom, "start": starts, "end": ends, "sum_cov": sum_cov})
+        for (chrom, starts, ends), sum_cov in zip(bins, coverage)
+    ]
 
-    out = out[out.chrom == chromosomes]
+    if data:
+        data = pd.concat(data, ignore_index=True)
+    else:
+        data = pd.DataFrame(columns=["chrom", "start", "end", "sum_cov"])
 
-    out.to_csv(bins_out, sep="\t", index=False, header=False)
+    csvutils.CsvOutput(output, sep="\t", header=True).write_df(data)
 
 
 def prep_sv_for_circos(sv_calls, outfile):
@@ -103,21 +145,6 @@ def prep_sv_for_circos(sv_calls, outfile):
     svs.to_csv(outfile, index=False, header=True, sep="\t")
 
 
-def samtools_coverage(
-        bam_file, bed_file, output,
-        mapping_qual
-):
-    command = [
-        "samtools", "bedcov", bed_file, bam_file,
-        "-Q", mapping_qual, ">", output
-    ]
-
-    pypeliner.commandline.execute(*command)
-
-    df_out = pd.read_csv(output, sep="\t", names=["chrom", "start", "end", "sum_cov"])
-    df_out.to_csv(output, sep="\t", index=False, header=True)
-
-
 def clear_header_label(f):
     data = pd.read_csv(f, sep="\t")
     data.to_csv(f, sep="\t", index=False, header=False)
@@ -125,20 +152,21 @@ def clear_header_label(f):
 
 def genome_wide(
         sample_id, roh, germline_calls,
-        normal_coverage, chromosomes, pdf, 
+        normal_coverage, chromosomes, pdf, tempdir,
         titan=False, somatic=False, remixt=False,
         tumour=False, breakpoints=False, normal_only=False, sex="female",
+        ncores=1,
 ):
 
     if normal_only:
         genome_wide_plot.genome_wide_plot(
             None, sample_id, None, roh, germline_calls, None,
-            None, normal_coverage, None, chromosomes, pdf, 
-            normal_only=normal_only, sex=sex,
+            None, normal_coverage, None, chromosomes, pdf, tempdir,
+            normal_only=normal_only, sex=sex, ncores=ncores,
         )
     else:
         genome_wide_plot.genome_wide_plot(
             remixt, sample_id, titan, roh, germline_calls, somatic,
-            tumour, normal_coverage, breakpoints, chromosomes, pdf, 
-            normal_only=normal_only, sex=sex,
+            tumour, normal_coverage, breakpoints, chromosomes, pdf, tempdir,
+            normal_only=normal_only, sex=sex, ncores=ncores,
         )
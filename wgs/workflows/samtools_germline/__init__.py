@@ -106,12 +106,18 @@ def create_samtools_germline_workflow(
         name='finalise_snvs',
         ctx=helpers.get_default_ctx(
             walltime='8:00',
+            ncpus=4,
         ),
         func='wgs.utils.vcf_tasks.finalise_vcf',
         args=(
             mgd.TempInputFile('normalized.vcf'),
             mgd.OutputFile(germline_vcf, extensions=['.tbi', '.csi']),
         ),
+        kwargs={
+            'ncores': 4,
+            'reference': reference,
+            'tempdir': mgd.TempSpace('finalise_snvs_tempdir'),
+        },
     )
 
     workflow.transform(
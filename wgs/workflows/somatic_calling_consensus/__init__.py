@@ -26,7 +26,8 @@ def create_somatic_consensus_workflow(
         name='snv_consensus',
         ctx=helpers.get_default_ctx(
             memory=15,
-            walltime='8:00', ),
+            walltime='8:00',
+            ncpus=8),
         func='wgs.workflows.somatic_calling_consensus.consensus.main',
         args=(
             mgd.InputFile(museq_snv_vcf),
@@ -37,6 +38,10 @@ def create_somatic_consensus_workflow(
             mgd.TempOutputFile('counts.csv'),
             params_refdir['chromosomes'],
         ),
+        kwargs={
+            'tempdir': mgd.TempSpace('somatic_consensus_temp'),
+            'ncores': 8,
+        }
     )
 
     workflow.subworkflow(
@@ -1,74 +1,105 @@
+import heapq
+import itertools
+import os
+import shutil
 from collections import defaultdict
 
-import vcf
+from wgs.utils import helpers
+from wgs.utils import vcfutils
+
+SNV = 0
+INDEL = 1
 
 
 def get_reader(filename):
-    return vcf.Reader(filename=filename)
-
-
-def get_counts(record, caller, tumor_id, normal_id, ref, alts):
-    normal = [v for v in record.samples if v.sample == normal_id]
-    assert len(normal) == 1
-    normal = normal[0]
-
-    tumor = [v for v in record.samples if v.sample == tumor_id]
-    assert len(tumor) == 1
-    tumor = tumor[0]
-
-    if caller == 'museq_snv':
-        tumor_depth = tumor['DP']
-        tumor_ref = tumor['RC']
-        tumor_alt = [tumor['AC']]
-        normal_depth = normal['DP']
-        normal_ref = normal['RC']
-        normal_alt = [normal['AC']]
-    elif caller == 'strelka_snv':
-        assert len(alts) == 1
-        alt = str(alts[0])
-        tumor_depth = tumor['DP']
-        tumor_ref = tumor[ref + 'U'][0]
-        tumor_alt = [tumor[alt + 'U'][0]]
-        normal_depth = normal['DP']
-        normal_ref = normal[ref + 'U'][0]
-        normal_alt = [normal[alt + 'U'][0]]
-    elif caller == 'strelka_indel':
-        assert len(alts) == 1
-        tumor_depth = tumor['DP']
-        tumor_ref = tumor['TAR'][0]
-        tumor_alt = [tumor['TIR'][0]]
-        normal_depth = normal['DP']
-        normal_ref = normal['TAR'][0]
-        normal_alt = [normal['TIR'][0]]
-    elif caller == 'mutect':
-        tumor_depth = tumor['DP']
-        tumor_ref = tumor['AD'][0]
-        tumor_alt = tumor['AD'][1:]
-        normal_depth = normal['DP']
-        normal_ref = normal['AD'][0]
-        normal_alt = normal['AD'][1:]
-
-    else:
+    return vcfutils.VcfReader(filename)
+
+
+def _museq_snv_counts(record, index, ref, alts):
+    depth, ref_count, alt_count = record.get_sample_fields(index, ('DP', 'RC', 'AC'))
+    return ref_count, [alt_count], depth
+
+
+def _strelka_snv_counts(record, index, ref, alts):
+    assert len(alts) == 1
+    alt = str(alts[0])
+    depth, ref_tiers, alt_tiers = record.get_sample_fields(index, ('DP', ref + 'U', alt + 'U'))
+    return ref_tiers[0], [alt_tiers[0]], depth
+
+
+def _strelka_indel_counts(record, index, ref, alts):
+    assert len(alts) == 1
+    depth, ref_tiers, alt_tiers = record.get_sample_fields(index, ('DP', 'TAR', 'TIR'))
+    return ref_tiers[0], [alt_tiers[0]], depth
+
+
+def _mutect_counts(record, index, ref, alts):
+    depth, allele_depths = record.get_sample_fields(index, ('DP', 'AD'))
+    return allele_depths[0], allele_depths[1:], depth
+
+
+COUNT_EXTRACTORS = {
+    'museq_snv': _museq_snv_counts,
+    'strelka_snv': _strelka_snv_counts,
+    'strelka_indel': _strelka_indel_counts,
+    'mutect': _mutect_counts,
+}
+
+
+def get_counts_extractor(caller, tumor_index, normal_index):
+    """
+    build the count extractor for a caller once per vcf.
+    the returned function is called per record as extract(record, ref, alts)
+    and returns tumor_ref, tumor_alt, tumor_depth, normal_ref, normal_alt, normal_depth
+    """
+    try:
+        sample_counts = COUNT_EXTRACTORS[caller]
+    except KeyError:
         raise NotImplementedError()
 
-    return tumor_ref, tumor_alt, tumor_depth, normal_ref, normal_alt, normal_depth
+    def extract(record, ref, alts):
+        tumor_ref, tumor_alt, tumor_depth = sample_counts(record, tumor_index, ref, alts)
+        normal_ref, normal_alt, normal_depth = sample_counts(record, normal_index, ref, alts)
+        return tumor_ref, tumor_alt, tumor_depth, normal_ref, normal_alt, normal_depth
 
+    return extract
+
+
+def get_reader_counts_extractor(vcf_reader, caller):
+    """
+    count extractor with the tumour and normal sample
+    indices taken from the vcf header
+    """
+    tumor_index = vcf_reader.get_sample_index(vcf_reader.metadata['tumor_sample'][0])
+    normal_index = vcf_reader.get_sample_index(vcf_reader.metadata['normal_sample'][0])
+
+    return get_counts_extractor(caller, tumor_index, normal_index)
 
-def fetch_vcf(filename, chromosome, caller):
-    snv_data = {}
-    indel_data = {}
 
+def get_counts(record, caller, tumor_index, normal_index, ref, alts):
+    return get_counts_extractor(caller, tumor_index, normal_index)(record, ref, alts)
+
+
+def fetch_vcf(filename, chromosome, caller):
+    """
+    stream calls from a caller vcf for a chromosome, in (pos, vartype, key) order.
+    snvs are keyed by (chrom, pos, ref, alt) and indels by (chrom, pos).
+    multi base substitutions are split into snvs that may sort after the
+    next record, so calls are held in a small heap until the vcf moves past them.
+    """
     vcf_reader = get_reader(filename)
 
-    tumor_sample = vcf_reader.metadata['tumor_sample'][0]
-    normal_sample = vcf_reader.metadata['normal_sample'][0]
+    get_record_counts = get_reader_counts_extractor(vcf_reader, caller)
 
     id_counter = 0
 
     try:
         records = vcf_reader.fetch(chromosome)
     except ValueError:
-        return snv_data, indel_data
+        return
+
+    buffer = []
+    seq = itertools.count()
 
     for record in records:
         chrom = record.CHROM
@@ -77,6 +108,9 @@ def fetch_vcf(filename, chromosome, caller):
         alts = record.ALT
         vcf_filter = record.FILTER
 
+        for call in vcfutils.pop_sorted_calls(buffer, pos):
+            yield call
+
         if caller == 'mutect' and vcf_filter:
             continue
         elif vcf_filter is None:
@@ -89,7 +123,7 @@ def fetch_vcf(filename, chromosome, caller):
 
         if alts == [None]:
             continue
-        tr, tas, td, nr, nas, nd = get_counts(record, caller, tumor_sample, normal_sample, ref, alts)
+        tr, tas, td, nr, nas, nd = get_record_counts(record, ref, alts)
 
         assert len(alts) == len(tas) == len(nas)
 
@@ -101,13 +135,18 @@ def fetch_vcf(filename, chromosome, caller):
             if len(ref) == len(alt):
                 for i, (rb, ab) in enumerate(zip(ref, alt)):
                     if not rb == ab:
-                        snv_data[(chrom, pos + i, rb, ab)] = data
+                        heapq.heappush(buffer, (pos + i, SNV, (chrom, pos + i, rb, ab), next(seq), data))
                         id_counter += 1
             else:
-                indel_data[(chrom, pos)] = (data, ref, alt)
+                heapq.heappush(buffer, (pos, INDEL, (chrom, pos), next(seq), (data, ref, alt)))
                 id_counter += 1
 
-    return snv_data, indel_data
+    for call in vcfutils.pop_sorted_calls(buffer):
+        yield call
+
+
+def filter_calls(calls, vartype):
+    return (call for call in calls if call[1] == vartype)
 
 
 def snv_consensus(museq, strelka, mutect):
@@ -188,6 +227,57 @@ def write_vcf(consensus, vcf_output, counts_output):
             count_file.write(outstr)
 
 
+def consensus_calls(
+        museq_snv_vcf,
+        strelka_snv_vcf,
+        mutect_snv_vcf,
+        strelka_indel_vcf,
+        chromosome,
+):
+    """
+    streaming consensus for a chromosome. the caller vcfs are merged
+    in position order and each variant is resolved as soon as all
+    callers have moved past it, so memory does not grow with the number of calls.
+    """
+    streams = {
+        'museq_snv': filter_calls(fetch_vcf(museq_snv_vcf, chromosome, 'museq_snv'), SNV),
+        'strelka_snv': filter_calls(fetch_vcf(strelka_snv_vcf, chromosome, 'strelka_snv'), SNV),
+        'mutect': fetch_vcf(mutect_snv_vcf, chromosome, 'mutect'),
+        'strelka_indel': filter_calls(fetch_vcf(strelka_indel_vcf, chromosome, 'strelka_indel'), INDEL),
+    }
+
+    for vartype, key, calls in vcfutils.merge_call_streams(streams):
+        if vartype == SNV:
+            museq = {key: calls['museq_snv']} if 'museq_snv' in calls else {}
+            strelka = {key: calls['strelka_snv']} if 'strelka_snv' in calls else {}
+            mutect = {key: calls['mutect']} if 'mutect' in calls else {}
+
+            for call in snv_consensus(museq, strelka, mutect):
+                yield call
+        else:
+            strelka = {key: calls['strelka_indel']} if 'strelka_indel' in calls else {}
+            mutect = {key: calls['mutect']} if 'mutect' in calls else {}
+
+            for call in indel_consensus(strelka, mutect):
+                yield call
+
+
+def run_consensus(
+        museq_snv_vcf,
+        strelka_snv_vcf,
+        mutect_snv_vcf,
+        strelka_indel_vcf,
+        consensus_vcf,
+        counts_output,
+        chromosome,
+):
+    consensus = consensus_calls(
+        museq_snv_vcf, strelka_snv_vcf, mutect_snv_vcf,
+        strelka_indel_vcf, chromosome
+    )
+    write_vcf(consensus, consensus_vcf, counts_output)
+
+
 def main(
         museq_snv_vcf,
         strelka_snv_vcf,
@@ -196,20 +286,49 @@ def main(
         consensus_vcf,
         counts_output,
         chromosomes,
+        tempdir=None,
+        ncores=None,
 ):
+    """
+    run consensus calling one chromosome at a time. if tempdir is set,
+    chromosomes run in parallel worker processes and the per chromosome
+    outputs are concatenated in chromosome order.
+    """
     with open(consensus_vcf, 'wt') as writer:
         writer.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
 
     with open(counts_output, 'wt') as writer:
         writer.write("chrom\tpos\tID\tTR\tTA\tTD\tNR\tNA\tND\n")
 
-    for chromosome in chromosomes:
-        museq_calls, _ = fetch_vcf(museq_snv_vcf, chromosome, 'museq_snv')
-        strelka_snv, _ = fetch_vcf(strelka_snv_vcf, chromosome, 'strelka_snv')
-        _, strelka_indel = fetch_vcf(strelka_indel_vcf, chromosome, 'strelka_indel')
-        mutect_snv, mutect_indel = fetch_vcf(mutect_snv_vcf, chromosome, 'mutect')
+    if not tempdir:
+        for chromosome in chromosomes:
+            run_consensus(
+                museq_snv_vcf, strelka_snv_vcf, mutect_snv_vcf, strelka_indel_vcf,
+                consensus_vcf, counts_output, chromosome
+            )
+        return
 
-        consensus = snv_consensus(museq_calls, strelka_snv, mutect_snv)
-        consensus += indel_consensus(strelka_indel, mutect_indel)
+    helpers.makedirs(tempdir)
 
-        write_vcf(consensus, consensus_vcf, counts_output)
+    args = []
+    for chromosome in chromosomes:
+        vcf_part = os.path.join(tempdir, '{}_consensus.vcf'.format(chromosome))
+        counts_part = os.path.join(tempdir, '{}_counts.csv'.format(chromosome))
+
+        # write_vcf appends, start from empty files in case of reruns
+        open(vcf_part, 'wt').close()
+        open(counts_part, 'wt').close()
+
+        args.append((
+            museq_snv_vcf, strelka_snv_vcf, mutect_snv_vcf, strelka_indel_vcf,
+            vcf_part, counts_part, chromosome
+        ))
+
+    helpers.run_in_process_pool(run_consensus, args, ncores=ncores)
+
+    with open(consensus_vcf, 'at') as vcf_writer, open(counts_output, 'at') as counts_writer:
+        for arg in args:
+            with open(arg[4], 'rt') as reader:
+                shutil.copyfileobj(reader, vcf_writer)
+            with open(arg[5], 'rt') as reader:
+                shutil.copyfileobj(reader, counts_writer)
@@ -1,11 +1,12 @@
 import os
 import random
-from collections import namedtuple
+import shutil
+import tempfile
 
 import consensus
 import pandas as pd
 import pypeliner
-import vcf
+from wgs.utils import vcfutils
 
 
 def _get_test_record():
@@ -40,18 +41,51 @@ def _get_indel():
     return chrom, pos, id_count, test_record
 
 
+def _get_test_reader(samples):
+    # vcf header for the example calls
+    header = [
+        '##fileformat=VCFv4.1',
+        '##INFO=<ID=DP,Number=1,Type=Integer,Description="depth">',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="depth">',
+        '##FORMAT=<ID=RO,Number=1,Type=Integer,Description="ref count">',
+        '##FORMAT=<ID=AO,Number=A,Type=Integer,Description="alt count">',
+        '##FORMAT=<ID=RC,Number=1,Type=Integer,Description="ref count">',
+        '##FORMAT=<ID=AC,Number=1,Type=Integer,Description="alt count">',
+        '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="allele depths">',
+        '##FORMAT=<ID=TAR,Number=2,Type=Integer,Description="ref tiers">',
+        '##FORMAT=<ID=TIR,Number=2,Type=Integer,Description="indel tiers">',
+        '##FORMAT=<ID=TU,Number=2,Type=Integer,Description="T tiers">',
+        '##FORMAT=<ID=NoneU,Number=2,Type=Integer,Description="alt tiers">',
+        '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples),
+    ]
+
+    # the header is parsed when the reader is created,
+    # the file isn't read again and can be removed
+    tempdir = tempfile.mkdtemp()
+    try:
+        vcf_file = os.path.join(tempdir, 'test.vcf')
+        with open(vcf_file, 'wt') as writer:
+            writer.write('\n'.join(header) + '\n')
+
+        return vcfutils.VcfReader(vcf_file)
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def _get_test_model_call():
     # make example  call
-    Call = namedtuple("Call", "DP RO AO RC AC AD TAR TIR TU NoneU")
+    reader = _get_test_reader(["normal", "tumor"])
 
-    normal_data = vcf.model._Call(None, "normal", Call(1, 1, 2, 1, 2, [1, 2], [3], [4], [5], [6]))
-    tumor_data = vcf.model._Call(None, "tumor", Call(1, 1, 2, 1, 2, [1, 2], [3], [4], [5], [6]))
+    call_format = "DP:RO:AO:RC:AC:AD:TAR:TIR:TU:NoneU"
+    call_data = "1:1:2:1:2:1,2:3:4:5:6"
 
-    freebayes_museq_rtg_example = vcf.model._Record("1", 10, 1, "T", [None], 1, 1,
-                                                    None, None, None, [normal_data, tumor_data])
+    freebayes_museq_rtg_example = vcfutils.VcfRecord(
+        "\t".join(["1", "10", "1", "T", ".", "1", "1", ".", call_format, call_data, call_data]), reader
+    )
 
-    samtools_example = vcf.model._Record("1", 10, 1, "T", [None], 1, 1, {"DP": 1},
-                                         None, None, [normal_data, tumor_data])
+    samtools_example = vcfutils.VcfRecord(
+        "\t".join(["1", "10", "1", "T", ".", "1", "1", "DP=1", call_format, call_data, call_data]), reader
+    )
 
     return freebayes_museq_rtg_example, samtools_example
 
@@ -431,7 +465,7 @@ def test_get_counts_case_1():
     -------
     '''
     test1, _ = _get_test_model_call()
-    assert consensus.get_counts(test1, "museq_snv", "normal", "tumor", test1.REF, test1.ALT) == (1, [2], 1, 1, [2], 1)
+    assert consensus.get_counts(test1, "museq_snv", 1, 0, test1.REF, test1.ALT) == (1, [2], 1, 1, [2], 1)
 
 
 def test_get_counts_case_2():
@@ -444,7 +478,7 @@ def test_get_counts_case_2():
     '''
     test1, _ = _get_test_model_call()
 
-    assert consensus.get_counts(test1, "strelka_snv", "normal", "tumor", test1.REF, test1.ALT) == (5, [6], 1, 5, [6], 1)
+    assert consensus.get_counts(test1, "strelka_snv", 1, 0, test1.REF, test1.ALT) == (5, [6], 1, 5, [6], 1)
 
 
 def test_get_counts_case_3():
@@ -457,7 +491,7 @@ def test_get_counts_case_3():
     '''
     test1, _ = _get_test_model_call()
 
-    assert consensus.get_counts(test1, "strelka_indel", "normal", "tumor", test1.REF, test1.ALT) == (
+    assert consensus.get_counts(test1, "strelka_indel", 1, 0, test1.REF, test1.ALT) == (
     3, [4], 1, 3, [4], 1)
 
 
@@ -471,4 +505,4 @@ def test_get_counts_case_4():
     '''
     test1, _ = _get_test_model_call()
 
-    assert consensus.get_counts(test1, "mutect", "normal", "tumor", test1.REF, test1.ALT) == (1, [2], 1, 1, [2], 1)
+    assert consensus.get_counts(test1, "mutect", 1, 0, test1.REF, test1.ALT) == (1, [2], 1, 1, [2], 1)
@@ -154,12 +154,18 @@ def create_strelka_workflow(
         name='finalise_normalize_snvs',
         ctx=helpers.get_default_ctx(
             walltime='8:00',
+            ncpus=4,
         ),
         func='wgs.utils.vcf_tasks.finalise_vcf',
         args=(
             mgd.TempInputFile('normalized_snvs.vcf'),
             mgd.TempOutputFile('normalized_snvs_finalize.vcf.gz', extensions=['.tbi', '.csi']),
         ),
+        kwargs={
+            'ncores': 4,
+            'reference': reference,
+            'tempdir': mgd.TempSpace('finalise_normalize_snvs_tempdir'),
+        },
     )
 
     workflow.transform(
@@ -178,12 +184,18 @@ def create_strelka_workflow(
         name='finalise_normalize_indel',
         ctx=helpers.get_default_ctx(
             walltime='8:00',
+            ncpus=4,
         ),
         func='wgs.utils.vcf_tasks.finalise_vcf',
         args=(
             mgd.TempInputFile('normalized_indels.vcf'),
             mgd.TempOutputFile('normalized_indels_finalize.vcf.gz', extensions=['.tbi', '.csi']),
         ),
+        kwargs={
+            'ncores': 4,
+            'reference': reference,
+            'tempdir': mgd.TempSpace('finalise_normalize_indel_tempdir'),
+        },
     )
 
     workflow.transform(
@@ -113,7 +113,8 @@ def create_titan_workflow(
         ctx=helpers.get_default_ctx(
             memory=10,
             walltime='16:00',
-            disk=200
+            disk=200,
+            ncpus=8
         ),
         func='wgs.workflows.titan.tasks.run_readcounter',
         args=(
@@ -122,6 +123,7 @@ def create_titan_workflow(
             chromosomes,
             cn_params['readcounter']
         ),
+        kwargs={'ncores': 8}
     )
 
     workflow.transform(
@@ -129,7 +131,8 @@ def create_titan_workflow(
         ctx=helpers.get_default_ctx(
             memory=10,
             walltime='16:00',
-            disk=200
+            disk=200,
+            ncpus=8
         ),
         func='wgs.workflows.titan.tasks.run_readcounter',
         args=(
@@ -138,6 +141,7 @@ def create_titan_workflow(
             chromosomes,
             cn_params['readcounter']
         ),
+        kwargs={'ncores': 8}
     )
 
     workflow.transform(
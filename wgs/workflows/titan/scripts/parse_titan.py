@@ -1,26 +1,5 @@
-from collections import defaultdict
-
+import numpy as np
 import pandas as pd
-from intervaltree import IntervalTree
-
-
-def build_interval_tree(data):
-    '''
-    load lumpy confidence intervals into tree
-    '''
-    itree = defaultdict(IntervalTree)
-
-    data = zip(data['chrom'], data['start'], data['end'])
-
-    for val in data:
-        chrom, start, end = val
-
-        if start == end:
-            continue
-
-        itree[chrom].addi(start, end)
-
-    return itree
 
 
 def load_segment_data(infile):
@@ -44,29 +23,52 @@ def load_markers_data(infile):
 
 
 def get_marker_counts(markers, segs):
-    segs_tree = build_interval_tree(segs)
-
-    counts_dict = {}
+    '''
+    number of markers in each segment. segments are half open
+    [start, end) intervals that do not overlap, as in the titan output.
+    markers are matched to segments with a binary search per chromosome.
+    :param markers: titan markers with Chr and Position columns
+    :param segs: segments with chrom, start and end columns
+    :returns series with the marker counts, indexed by chrom, start and end
+    '''
+    segs = segs.loc[segs['start'] < segs['end'], ['chrom', 'start', 'end']]
+    segs = segs.drop_duplicates().sort_values(['chrom', 'start'])
 
-    for (chrom, pos) in zip(markers.Chr, markers.Position):
+    positions = {
+        chrom: chrom_positions.values
+        for chrom, chrom_positions in markers.groupby('Chr')['Position']
+    }
 
-        ival = segs_tree[chrom][pos]
+    counts = []
+    for chrom, chrom_segs in segs.groupby('chrom', sort=False):
+        starts = chrom_segs['start'].values
+        ends = chrom_segs['end'].values
 
-        if not list(ival):
-            continue
+        chrom_positions = positions.get(chrom, np.zeros(0, dtype=np.int64))
 
-        start, stop, _ = list(ival)[0]
+        index = np.searchsorted(starts, chrom_positions, side='right') - 1
+        valid = index >= 0
+        valid[valid] = chrom_positions[valid] < ends[index[valid]]
 
-        if (chrom, start, stop) not in counts_dict:
-            counts_dict[(chrom, start, stop)] = 0
+        counts.append(pd.Series(
+            np.bincount(index[valid], minlength=len(starts)),
+            index=pd.MultiIndex.from_arrays(
+                [[chrom] * len(starts), starts, ends], names=['chrom', 'start', 'end']
+            )
+        ))
 
-        counts_dict[(chrom, start, stop)] += 1
+    if not counts:
+        return pd.Series(
+            [], dtype=np.int64,
+            index=pd.MultiIndex.from_arrays([[], [], []], names=['chrom', 'start', 'end'])
+        )
 
-    return counts_dict
+    return pd.concat(counts)
 
 
 def add_counts_to_segs(segs, marker_counts):
-    segs["count_markers"] = segs.apply(lambda x: marker_counts.get((x['chrom'], x['start'], x['end']), 0), axis=1)
+    keys = pd.MultiIndex.from_arrays([segs['chrom'], segs['start'], segs['end']])
+    segs["count_markers"] = marker_counts.reindex(keys, fill_value=0).values
     return segs
 
 
@@ -1,4 +1,4 @@
-import vcf
+from wgs.utils import vcfutils
 
 
 def read_ref_positions(positions):
@@ -16,7 +16,7 @@ def read_ref_positions(positions):
 
 
 def get_reader(filename):
-    return vcf.Reader(filename=filename)
+    return vcfutils.VcfReader(filename)
 
 
 def vcf_to_counts(filename, outfile, ref_positions):
@@ -24,7 +24,7 @@ def vcf_to_counts(filename, outfile, ref_positions):
 
     ref_positions = read_ref_positions(ref_positions)
 
-    tumor_sample = vcf_reader.metadata['tumor_sample'][0]
+    tumor_index = vcf_reader.get_sample_index(vcf_reader.metadata['tumor_sample'][0])
 
     with open(outfile, 'wt') as writer:
 
@@ -36,12 +36,10 @@ def vcf_to_counts(filename, outfile, ref_positions):
             if (chrom, pos) not in ref_positions:
                 continue
 
-            tumor = [v for v in record.samples if v.sample == tumor_sample]
-            assert len(tumor) == 1
-            tumor = tumor[0]
+            tumor_ref, tumor_alt = record.get_sample_fields(tumor_index, ('RC', 'AC'))
 
-            tumor_ref = str(tumor['RC'])
-            tumor_alt = str(tumor['AC'])
+            tumor_ref = str(tumor_ref)
+            tumor_alt = str(tumor_alt)
             pos = str(pos)
 
             outstr = '\t'.join([chrom, pos, ref, tumor_ref, 'X', tumor_alt]) + '\n'
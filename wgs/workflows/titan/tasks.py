@@ -48,10 +48,10 @@ def convert_museq_vcf2counts(infile, outfile, het_positions):
     vcf_to_counts(infile, outfile, het_positions)
 
 
-def run_readcounter(input_bam, output_wig, chromosomes, config):
+def run_readcounter(input_bam, output_wig, chromosomes, config, ncores=None):
     rc = ReadCounter(
         input_bam, output_wig, config['w'],
-        chromosomes, config['q'],
+        chromosomes, config['q'], ncores=ncores
     )
     rc.main()
 
@@ -34,7 +34,8 @@ def create_consensus_workflow(
         name='parse_strelka_indel',
         ctx=helpers.get_default_ctx(
             memory=15,
-            walltime='8:00', ),
+            walltime='8:00',
+            ncpus=8, ),
         func='wgs.workflows.variant_calling_consensus.tasks.parse_vcf',
         args=(
             mgd.InputFile(strelka_indel, extensions=['.csi', '.tbi']),
@@ -46,13 +47,15 @@ def create_consensus_workflow(
             chromosomes,
             mgd.TempSpace("tempdir_strelka_indel")
         ),
+        kwargs={'ncores': 8}
     )
 
     workflow.transform(
         name='parse_museq_snv',
         ctx=helpers.get_default_ctx(
             memory=15,
-            walltime='8:00', ),
+            walltime='8:00',
+            ncpus=8, ),
         func='wgs.workflows.variant_calling_consensus.tasks.parse_vcf',
         args=(
             mgd.InputFile(museq_snv, extensions=['.csi', '.tbi']),
@@ -64,13 +67,15 @@ def create_consensus_workflow(
             chromosomes,
             mgd.TempSpace("tempdir_parse_museq_snv")
         ),
+        kwargs={'ncores': 8}
     )
 
     workflow.transform(
         name='parse_strelka_snv',
         ctx=helpers.get_default_ctx(
             memory=15,
-            walltime='8:00', ),
+            walltime='8:00',
+            ncpus=8, ),
         func='wgs.workflows.variant_calling_consensus.tasks.parse_vcf',
         args=(
             mgd.InputFile(strelka_snv, extensions=['.csi', '.tbi']),
@@ -82,6 +87,7 @@ def create_consensus_workflow(
             chromosomes,
             mgd.TempSpace("tempdir_parse_strelka_snv")
         ),
+        kwargs={'ncores': 8}
     )
 
     workflow.transform(
@@ -1,17 +1,207 @@
-import vcf
+import operator
+
+import numpy as np
+import pandas as pd
+from wgs.utils import csvutils
 from wgs.utils import helpers
+from wgs.utils import vcfutils
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 VCF_FILE = "museq_single_annotated.vcf.gz"
 
 ANNOTATIONS = ['ann', 'ma', 'dbsnp', 'cosmic', 'lof', 'nmd', '1000gen', 'low_mappability']
 
+# info fields written to the annotation tables
+ANNOTATION_INFO_KEYS = ['ANN', 'MA', 'DBSNP', 'Cosmic', '1000Gen', 'LOW_MAPPABILITY']
+
+# records parsed before the tables are written out
+BATCH_SIZE = 100000
+
+OPERATORS = {
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'lt': operator.lt,
+    'le': operator.le,
+    'eq': operator.eq,
+    'ne': operator.ne,
+}
+
+# yaml dtypes of the vcf header types, used for parquet output
+VCF_DTYPES = {
+    vcfutils.INTEGER: 'int',
+    vcfutils.FLOAT: 'float',
+    vcfutils.FLAG: 'bool',
+}
+
+ARROW_TYPES = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool_',
+    'str': 'string',
+}
+
+
+def compile_filter(operation, threshold):
+    '''
+    builds a vectorized predicate for a filter
+    :param operation: one of gt, ge, lt, le, eq, ne, in, notin
+    :param threshold: value to compare against
+    :returns function that maps a numpy object array to a boolean mask,
+    missing (None) values never match
+    '''
+    if operation in ('in', 'notin'):
+        threshold = list(threshold)
+
+        def predicate(values):
+            mask = pd.Series(values, dtype=object).isin(threshold).values
+            return mask if operation == 'in' else ~mask
+
+    elif operation in OPERATORS:
+        func = OPERATORS[operation]
+
+        def predicate(values):
+            return func(values, threshold).astype(bool)
+
+    else:
+        raise Exception("unknown operator type: {}".format(operation))
+
+    def filter_mask(values):
+        present = np.array([val is not None for val in values], dtype=bool)
+
+        mask = np.zeros(len(values), dtype=bool)
+        if present.any():
+            mask[present] = predicate(values[present])
+
+        return mask
+
+    return filter_mask
+
+
+class TableBuffer(object):
+    '''
+    buffers the rows of one output table and writes
+    them out in batches, as csv text or as typed
+    parquet columns. headerless csv tables get a yaml
+    with dtypes inferred from the written rows.
+    '''
+
+    def __init__(self, filepath, columns, dtypes=None, header=True):
+        self.filepath = filepath
+        self.columns = columns
+        self.dtypes = dtypes if dtypes else {}
+        self.header = header
+
+        self.is_parquet = csvutils.get_file_format(filepath) == 'parquet'
+
+        self.rows = []
+        self.inference_rows = []
+
+        self.writer = None
+        self.schema = None
+
+    def __enter__(self):
+        if self.is_parquet:
+            self.schema = pa.schema([
+                (col, getattr(pa, ARROW_TYPES[self.dtypes.get(col, 'str')])())
+                for col in self.columns
+            ])
+            self.writer = pq.ParquetWriter(self.filepath, self.schema)
+        else:
+            self.writer = helpers.GetFileHandle(self.filepath, 'wt').handler
+            if self.header:
+                self.writer.write(','.join(map(str, self.columns)) + '\n')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, record):
+        '''
+        :param record: dict of column to value, missing columns are None
+        '''
+        self.rows.append([record.get(col) for col in self.columns])
+
+    def append_row(self, row):
+        '''
+        :param row: list of values in column order
+        '''
+        self.rows.append(row)
+
+    def get_arrow_array(self, col, values):
+        dtype = self.schema.field(col).type
+
+        if dtype == pa.string():
+            values = [None if val is None else str(val) for val in values]
+
+        try:
+            return pa.array(values, type=dtype)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array(values).cast(dtype, safe=False)
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        if self.is_parquet:
+            columns = list(zip(*self.rows))
+            table = pa.Table.from_arrays(
+                [self.get_arrow_array(col, values) for col, values in zip(self.columns, columns)],
+                schema=self.schema
+            )
+            self.writer.write_table(table)
+        else:
+            rows = [[str(val) for val in row] for row in self.rows]
+            self.writer.write(''.join(','.join(row) + '\n' for row in rows))
+
+            if not self.header and len(self.inference_rows) < csvutils.DTYPE_INFERENCE_LINES:
+                remaining = csvutils.DTYPE_INFERENCE_LINES - len(self.inference_rows)
+                self.inference_rows.extend(rows[:remaining])
+
+        self.rows = []
+
+    def close(self):
+        if self.writer is None:
+            return
+
+        self.flush()
+        self.writer.close()
+        self.writer = None
+
+        if self.is_parquet:
+            dtypes = {col: self.dtypes.get(col, 'str') for col in self.columns}
+            csvutils.write_metadata(
+                self.filepath + '.yaml', True, ',', self.columns, dtypes
+            )
+        elif not self.header:
+            dtypes = csvutils.infer_dtypes(self.inference_rows, self.columns)
+            csvutils.write_metadata(
+                self.filepath + '.yaml', False, ',', self.columns, dtypes
+            )
+
 
 class VcfParser(object):
-    def __init__(self, vcf_file, outfile, snpeff_outfile, ma_outfile, ids_outfile, filters):
+    def __init__(
+            self, vcf_file, outfile, snpeff_outfile, ma_outfile, ids_outfile, filters,
+            batch_size=BATCH_SIZE, chromosome=None, header=True
+    ):
         '''
         constructor for parser
         note, if filter_low_mappability is true,
         will look for a "fxblacklist" in the parser config
+        outputs are written as parquet if the path ends in .parquet
+        if chromosome is set, only the records on that chromosome are
+        parsed from the tabix index. the columns always come from the
+        first record in the file so that all chromosomes match.
+        csv outputs are written without a header and with a yaml
+        if header is False.
         '''
         self.vcf_file = vcf_file
         self.outfile = outfile
@@ -19,27 +209,52 @@ class VcfParser(object):
         self.ma_outfile = ma_outfile
         self.ids_outfile = ids_outfile
 
+        self.batch_size = batch_size
+        self.chromosome = chromosome
+        self.header = header
+
         self.reader = self.get_reader(self.vcf_file)
 
+        self.first_record = next(self.reader, None)
+
         self.snpeff_cols, self.ma_cols, self.ids_cols, self.primary_cols = self.init_headers()
 
+        self.column_spec = self.get_column_spec(self.first_record)
+
         self.cols = None
 
         self.filters = filters
 
+        self.compiled_filters = [
+            (self.get_filter_getter(filter_name), compile_filter(relationship, value))
+            for filter_name, relationship, value in filters
+        ]
+
+        # only the info fields that are written or filtered on are parsed
+        info_keys = self.column_spec[0] + ANNOTATION_INFO_KEYS + [
+            vcf_filter[0] for vcf_filter in filters
+        ]
+        self.info_keys = tuple(sorted(set(info_keys), key=info_keys.index))
+
+        filter_keys = [vcf_filter[0] for vcf_filter in filters] + ['DBSNP', 'Cosmic']
+        self.filter_keys = tuple(sorted(set(filter_keys), key=filter_keys.index))
+
+        self.tables = None
+
     def __enter__(self):
-        self.outfile = helpers.GetFileHandle(self.outfile, 'wt').handler
-        self.snpeff_outfile = helpers.GetFileHandle(self.snpeff_outfile, 'wt').handler
-        self.ma_outfile = helpers.GetFileHandle(self.ma_outfile, 'wt').handler
-        self.ids_outfile = helpers.GetFileHandle(self.ids_outfile, 'wt').handler
-        self.write_headers()
+        self.tables = [
+            TableBuffer(self.outfile, self.primary_cols, self.get_primary_dtypes(), header=self.header),
+            TableBuffer(self.snpeff_outfile, self.snpeff_cols, {'pos': 'int'}, header=self.header),
+            TableBuffer(self.ma_outfile, self.ma_cols, {'pos': 'int'}, header=self.header),
+            TableBuffer(self.ids_outfile, self.ids_cols, {'pos': 'int'}, header=self.header),
+        ]
+        for table in self.tables:
+            table.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.outfile.close()
-        self.snpeff_outfile.close()
-        self.ma_outfile.close()
-        self.ids_outfile.close()
+        for table in self.tables:
+            table.close()
 
     def init_headers(self):
 
@@ -53,22 +268,52 @@ class VcfParser(object):
 
         return snpeff_cols, ma_cols, ids_cols, primary_cols
 
-    def write_headers(self):
-        self.write_header(self.snpeff_cols, self.snpeff_outfile)
-        self.write_header(self.ma_cols, self.ma_outfile)
-        self.write_header(self.ids_cols, self.ids_outfile)
-        self.write_header(self.primary_cols, self.outfile)
-
     def get_reader(self, vcf_file):
-        return vcf.Reader(filename=vcf_file)
+        return vcfutils.VcfReader(vcf_file)
 
     def get_primary_cols_from_header(self, reader):
-        try:
-            row1 = next(reader)
-        except StopIteration:
+        if self.first_record is None:
             return ["chrom", "pos", "ref", "alt", "qual", "filter"]
 
-        return list(self.parse_main_cols(row1).keys())
+        return list(self.parse_main_cols(self.first_record).keys())
+
+    def get_column_spec(self, record):
+        '''
+        where each primary column comes from, resolved from the
+        first record in the same order as parse_main_cols
+        :returns tuple of info keys and (sample index, format keys)
+        '''
+        if record is None:
+            return [], []
+
+        info_keys = [
+            k for k in record.INFO if k.lower() not in ANNOTATIONS
+        ]
+
+        sample_keys = []
+        for index, (_, sample_data) in enumerate(record.iter_samples()):
+            sample_keys.append((index, tuple(sample_data.keys())))
+
+        return info_keys, sample_keys
+
+    def get_primary_dtypes(self):
+        dtypes = {'pos': 'int', 'qual': 'float'}
+
+        info_keys, sample_keys = self.column_spec
+
+        for key in info_keys:
+            field = self.reader.infos.get(key)
+            if field and (field.num == 1 or field.type == vcfutils.FLAG):
+                dtypes[key] = VCF_DTYPES.get(field.type, 'str')
+
+        for index, keys in sample_keys:
+            sample = self.reader.samples[index]
+            for key in keys:
+                field = self.reader.formats.get(key)
+                if key != 'GT' and field and field.num == 1:
+                    dtypes[key + '_' + sample] = VCF_DTYPES.get(field.type, 'str')
+
+        return dtypes
 
     def get_cols_from_header(self, reader, key):
         try:
@@ -90,50 +335,6 @@ class VcfParser(object):
 
         return desc
 
-    def parse_snpeff(self, snpeff_cols, snpeff_entries, chrom, pos):
-        records = []
-        for record in snpeff_entries:
-            record = record.strip().split('|')
-
-            record = dict(zip(snpeff_cols, record))
-
-            record['chrom'] = chrom
-            record['pos'] = pos
-
-            records.append(record)
-
-        return records
-
-    def parse_mutation_assessor(self, cols, record, chrom, pos):
-        if not record:
-            return
-        record = record.strip().split('|')
-
-        record = dict(zip(cols, record))
-
-        record['chrom'] = chrom
-        record['pos'] = pos
-
-        return record
-
-    def parse_list_annotations(self, records, chrom, pos, label):
-        if records == [None]:
-            return []
-
-        parsed_records = []
-        for entry in records:
-            parsed_records.append(
-                {'chrom': chrom, 'pos': pos, 'value': entry, 'type': label}
-            )
-
-        return parsed_records
-
-    def parse_flag_annotation(self, record, chrom, pos, label):
-        if not record:
-            return []
-
-        return [{'chrom': chrom, 'pos': pos, 'value': record, 'type': label}]
-
     def parse_main_cols(self, record):
         data = {
             'chrom': record.CHROM,
@@ -151,15 +352,12 @@ class VcfParser(object):
             if k.lower() in ANNOTATIONS:
                 continue
             if isinstance(v, list):
-                v = ';'.join(v)
+                v = ';'.join(map(str, v))
             data[k] = v
 
-        for sample in record.samples:
-
-            sample_type = sample.sample
-            sample_data = sample.data
+        for sample_type, sample_data in record.iter_samples():
 
-            for k, v in sample_data._asdict().items():
+            for k, v in sample_data.items():
                 k += "_" + sample_type
                 if isinstance(v, list):
                     v = ';'.join([str(val) for val in v])
@@ -167,117 +365,185 @@ class VcfParser(object):
 
         return data
 
-    def eval_expr(self, val, operation, threshold):
-        if operation == "gt":
-            if val > threshold:
-                return True
-        elif operation == 'ge':
-            if val >= threshold:
-                return True
-        elif operation == 'lt':
-            if val < threshold:
-                return True
-        elif operation == 'le':
-            if val <= threshold:
-                return True
-        elif operation == 'eq':
-            if val == threshold:
-                return True
-        elif operation == 'ne':
-            if not val == threshold:
-                return True
-        elif operation == 'in':
-            if val in threshold:
-                return True
-        elif operation == 'notin':
-            if not val in threshold:
-                return True
-        else:
-            raise Exception("unknown operator type: {}".format(operation))
+    def get_primary_row(self, record, info):
+        '''
+        values of the primary columns of a record
+        '''
+        row = [
+            record.CHROM, record.POS, record.REF,
+            ';'.join(map(str, record.ALT)), record.QUAL
+        ]
+
+        info_keys, sample_keys = self.column_spec
 
-        return False
+        for key in info_keys:
+            value = info.get(key)
+            if isinstance(value, list):
+                value = ';'.join(map(str, value))
+            row.append(value)
 
-    def filter_records(self, record, annotations):
+        for index, keys in sample_keys:
+            for value in record.get_sample_fields(index, keys):
+                if isinstance(value, list):
+                    value = ';'.join([str(val) for val in value])
+                row.append(value)
 
-        for vcf_filter in self.filters:
-            filter_name, relationship, value = vcf_filter
+        return row
 
-            if filter_name in record:
-                if self.eval_expr(record[filter_name], relationship, value):
-                    return True
+    def add_annotations(self, record, info):
+        '''
+        adds the snpeff, mutation assessor and id
+        annotations of a record to the table buffers
+        '''
+        _, snpeff_table, ma_table, ids_table = self.tables
 
-            for annotation in annotations:
-                if filter_name == annotation['type']:
-                    if self.eval_expr(record[filter_name], relationship, value):
-                        return True
+        chrom = record.CHROM
+        pos = record.POS
 
-    def parse_record(self, record):
-        data = self.parse_main_cols(record)
-        info = record.INFO
+        for entry in info.get('ANN') or []:
+            if entry is None:
+                continue
+            entry = dict(zip(self.snpeff_cols, entry.strip().split('|')))
+            entry['chrom'] = chrom
+            entry['pos'] = pos
+            snpeff_table.append(entry)
+
+        ma = info.get('MA')
+        if ma:
+            ma = dict(zip(self.ma_cols, ma.strip().split('|')))
+            ma['chrom'] = chrom
+            ma['pos'] = pos
+            ma_table.append(ma)
+
+        for key, label in (('DBSNP', 'dbsnp'), ('Cosmic', 'cosmic')):
+            values = info.get(key)
+            if not values or values == [None]:
+                continue
+            for value in values:
+                ids_table.append_row([chrom, pos, value, label])
+
+        for key in ('1000Gen', 'LOW_MAPPABILITY'):
+            value = info.get(key)
+            if value:
+                ids_table.append_row([chrom, pos, value, key])
+
+    def get_filter_getter(self, filter_name):
+        '''
+        function returning the value a filter is evaluated against.
+        filters match the main columns, info fields and per sample
+        fields of the record first, then id annotations by type.
+        '''
+        main_cols = {
+            'chrom': lambda record: record.CHROM,
+            'pos': lambda record: record.POS,
+            'ref': lambda record: record.REF,
+            'alt': lambda record: ';'.join(map(str, record.ALT)),
+            'qual': lambda record: record.QUAL,
+        }
 
-        snpeff_annotations = self.parse_snpeff(self.snpeff_cols, info['ANN'], record.CHROM, record.POS)
-        ma_annotations = self.parse_mutation_assessor(self.ma_cols, info['MA'], record.CHROM, record.POS)
+        def join(value):
+            if isinstance(value, list):
+                return ';'.join(map(str, value))
+            return value
 
-        id_annotations = self.parse_list_annotations(info['DBSNP'], record.CHROM, record.POS, 'dbsnp')
-        id_annotations += self.parse_list_annotations(info['Cosmic'], record.CHROM, record.POS, 'cosmic')
-        ## TODO: I expected to see a 1000gen: False in the record. but the key is missing.
-        id_annotations += self.parse_flag_annotation(info.get('1000Gen'), record.CHROM, record.POS, '1000Gen')
-        id_annotations += self.parse_flag_annotation(info.get('LOW_MAPPABILITY'), record.CHROM, record.POS,
-                                                     'LOW_MAPPABILITY')
-        return data, snpeff_annotations, id_annotations, ma_annotations
+        if filter_name in main_cols:
+            get_value = main_cols[filter_name]
+            return lambda record, info: get_value(record)
 
-    def parse_vcf(self):
-        for record in self.reader:
+        for index, sample in enumerate(self.reader.samples):
+            suffix = '_' + sample
+            if filter_name.endswith(suffix):
+                keys = (filter_name[:-len(suffix)],)
+                return lambda record, info: join(record.get_sample_fields(index, keys)[0])
 
-            data, snpeff_annotations, id_annotations, ma_annotations = self.parse_record(record)
+        if filter_name in ('dbsnp', 'cosmic'):
+            key = 'DBSNP' if filter_name == 'dbsnp' else 'Cosmic'
 
-            if self.filter_records(data, id_annotations):
-                continue
+            def get_ids(record, info):
+                value = info.get(key)
+                return None if not value or value == [None] else join(value)
 
-            yield data, (snpeff_annotations, ma_annotations, id_annotations)
+            return get_ids
 
-    def write_record(self, record, header, outfile):
+        if filter_name in ('1000Gen', 'LOW_MAPPABILITY') or \
+                filter_name.lower() not in ANNOTATIONS:
+            return lambda record, info: join(info.get(filter_name))
+
+        return lambda record, info: None
+
+    def get_filter_mask(self, batch):
         '''
-        writes a record to outfile
-        :param record: record to write
-        :param header: header containg colnames
-        :param outfile: path to outfile
+        True for the records removed by any filter. only the
+        info fields used by the filters are parsed.
         '''
-        outstr = [record.get(col) for col in header]
-        outstr = ','.join(map(str, outstr)) + '\n'
-        outfile.write(outstr)
+        mask = np.zeros(len(batch), dtype=bool)
+
+        if not batch or not self.compiled_filters:
+            return mask
+
+        infos = [
+            dict(zip(self.filter_keys, self.reader.parse_info_fields(record.row[7], self.filter_keys)))
+            for record in batch
+        ]
 
-    def write_header(self, header, outfile):
-        outstr = ','.join(map(str, header)) + '\n'
-        outfile.write(outstr)
+        for getter, filter_mask in self.compiled_filters:
+            values = np.empty(len(batch), dtype=object)
+            values[:] = [getter(record, info) for record, info in zip(batch, infos)]
+            mask |= filter_mask(values)
+
+        return mask
+
+    def iter_records(self):
+        if self.chromosome is not None:
+            for record in self.reader.fetch(self.chromosome):
+                yield record
+            return
+
+        if self.first_record is None:
+            return
+
+        yield self.first_record
+
+        for record in self.reader:
+            yield record
+
+    def process_batch(self, batch):
+        primary_table = self.tables[0]
+
+        removed = self.get_filter_mask(batch)
+
+        for record, is_removed in zip(batch, removed.tolist()):
+            if is_removed:
+                continue
+
+            info = dict(zip(
+                self.info_keys,
+                self.reader.parse_info_fields(record.row[7], self.info_keys)
+            ))
+
+            primary_table.append_row(self.get_primary_row(record, info))
+            self.add_annotations(record, info)
+
+        for table in self.tables:
+            table.flush()
 
     def write(self):
         '''
-        writes the parser to a csv
-        :param blacklist:
+        parses the vcf in batches of records. filters are applied
+        to each batch before the remaining records are fully parsed,
+        each table is written once per batch
         '''
-        data = self.parse_vcf()
-        primary_header = self.primary_cols
-        for record in data:
-            primary, annotations = record
-            if not primary_header:
-                primary_header = list(primary.keys())
-                self.write_header(primary_header, self.outfile)
-            self.write_record(primary, primary_header, self.outfile)
-
-            snpeff_anns = annotations[0]
-            for snpeff_record in snpeff_anns:
-                self.write_record(snpeff_record, self.snpeff_cols, self.snpeff_outfile)
+        batch = []
+        for record in self.iter_records():
+            batch.append(record)
 
-            ma_ann = annotations[1]
-            if ma_ann:
-                self.write_record(ma_ann, self.ma_cols, self.ma_outfile)
+            if len(batch) >= self.batch_size:
+                self.process_batch(batch)
+                batch = []
 
-            id_anns = annotations[2]
-            for id_ann in id_anns:
-                self.write_record(id_ann, self.ids_cols, self.ids_outfile)
+        self.process_batch(batch)
 
 
 if __name__ == "__main__":
-    with VcfParser(VCF_FILE, 'parsed', 'snpeff', 'ma', 'ids') as vcf_parser:
+    with VcfParser(VCF_FILE, 'parsed', 'snpeff', 'ma', 'ids', []) as vcf_parser:
         vcf_parser.write()
@@ -1,13 +1,25 @@
 from wgs.utils import csvutils
 from wgs.utils import helpers
+from wgs.utils import vcfutils
 import os
 
 from .scripts import vcfparser
 
 
+def parse_chromosome(infile, chromosome, outputs, filters):
+    '''
+    parses the records on one chromosome of an indexed
+    vcf to headerless tables with yaml metadata
+    '''
+    with vcfparser.VcfParser(
+            infile, *outputs, filters=filters, chromosome=chromosome, header=False
+    ) as vcf_parser:
+        vcf_parser.write()
+
+
 def parse_vcf(
         infile, primary_table, snpeff_table,
-        ma_table, id_table, parse_config, chromosomes, tempdir
+        ma_table, id_table, parse_config, chromosomes, tempdir, ncores=1
 ):
     '''
     parses a vcf containing variant calls
@@ -18,19 +30,15 @@ def parse_vcf(
     :param snpeff_table: csv output filepath containing snpeff annotations
     :param ma_table: csv output filepath containing ma annotations
     :param id_table: csv output filepath containg id annotations
+    outputs ending in .parquet are written as parquet
     :param parse_config: config?? currently unused
     :param parse_low_mappability: boolean; whether or not to filter low-mappability calls
     ##assuming there will by a path to a blacklisted calls table in config
+    :param ncores: number of chromosomes parsed in parallel if the vcf is indexed
     '''
 
     helpers.makedirs(tempdir)
 
-    primary_temp = os.path.join(tempdir, 'primary.csv')
-    snpeff_temp = os.path.join(tempdir, 'snpeff.csv')
-    ma_temp = os.path.join(tempdir, 'ma.csv')
-    ids_temp = os.path.join(tempdir, 'ids.csv')
-
-
     filter_out = []
     if 'filter_low_mappability' in parse_config and parse_config['filter_low_mappability']:
         filter_out.append(('LOW_MAPPABILITY', 'eq', True))
@@ -41,15 +49,53 @@ def parse_vcf(
     if 'pr_threshold' in parse_config and parse_config['pr_threshold']:
         filter_out.append(('PR', 'lt', parse_config['pr_threshold']))
 
-    with vcfparser.VcfParser(
-            infile, primary_temp, snpeff_temp,
-            ma_temp, ids_temp, filter_out) as vcf_parser:
+    outputs = [primary_table, snpeff_table, ma_table, id_table]
+
+    contigs = vcfutils.get_indexed_contigs(infile)
+
+    if contigs:
+        parts_dir = os.path.join(tempdir, 'parts')
+        helpers.makedirs(parts_dir)
+
+        args = []
+        for i, contig in enumerate(contigs):
+            parts = [
+                os.path.join(parts_dir, '{}_{}{}'.format(
+                    i, name, '.parquet' if csvutils.get_file_format(output) == 'parquet' else '.csv'
+                ))
+                for name, output in zip(['primary', 'snpeff', 'ma', 'ids'], outputs)
+            ]
+            args.append((infile, contig, parts, filter_out))
+
+        helpers.run_in_process_pool(parse_chromosome, args, ncores)
+
+        for i, output in enumerate(outputs):
+            csvutils.concatenate_csv_files_quick_lowmem(
+                [arg[2][i] for arg in args], output, write_header=True, ncores=ncores
+            )
+
+        return
+
+    primary_temp = os.path.join(tempdir, 'primary.csv')
+    snpeff_temp = os.path.join(tempdir, 'snpeff.csv')
+    ma_temp = os.path.join(tempdir, 'ma.csv')
+    ids_temp = os.path.join(tempdir, 'ids.csv')
+
+    temps = [primary_temp, snpeff_temp, ma_temp, ids_temp]
+
+    # parquet tables are typed from the vcf header and written
+    # directly, csv tables get their dtypes from finalize_csv
+    parser_outputs = [
+        output if csvutils.get_file_format(output) == 'parquet' else temp
+        for output, temp in zip(outputs, temps)
+    ]
+
+    with vcfparser.VcfParser(infile, *parser_outputs, filters=filter_out) as vcf_parser:
         vcf_parser.write()
 
-    csvutils.finalize_csv(primary_temp, primary_table)
-    csvutils.finalize_csv(snpeff_temp, snpeff_table)
-    csvutils.finalize_csv(ma_temp, ma_table)
-    csvutils.finalize_csv(ids_temp, id_table)
+    for parser_output, output in zip(parser_outputs, outputs):
+        if parser_output != output:
+            csvutils.finalize_csv(parser_output, output)
 
 
 def merge_overlap(infiles, outfile, on=('chrom', 'pos', 'ref', 'alt')):
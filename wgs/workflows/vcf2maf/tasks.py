@@ -111,24 +111,18 @@ def split_vcf(in_file, out_file_callback, lines_per_file):
             writer.close()
 
 
-def merge_mafs(maf_files, output):
+def merge_mafs(maf_files, output, ncores=1):
     if isinstance(maf_files, dict):
         maf_files = list(maf_files.values())
 
-    with helpers.GetFileHandle(output, 'wt') as maf_writer:
+    with helpers.GetFileHandle(maf_files[0]) as header_read:
+        version = header_read.readline()
+        assert version.startswith('#version 2.4')
 
-        with helpers.GetFileHandle(maf_files[0]) as header_read:
-            header = header_read.readline()
-            assert header.startswith('#version 2.4')
-            maf_writer.write(header)
+        header = header_read.readline()
+        assert header.startswith('Hugo_Symbol')
 
-            header = header_read.readline()
-            assert header.startswith('Hugo_Symbol')
-            maf_writer.write(header)
-
-        for filepath in maf_files:
-            with helpers.GetFileHandle(filepath, 'rt') as maf_reader:
-                for line in maf_reader:
-                    if line.startswith('Hugo_Symbol') or line.startswith('#'):
-                        continue
-                    maf_writer.write(line)
+    helpers.concatenate_files(
+        maf_files, output, header=version + header,
+        skip_header_prefixes=('#', 'Hugo_Symbol'), ncores=ncores
+    )
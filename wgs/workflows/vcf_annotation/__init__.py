@@ -5,6 +5,7 @@ Created on Feb 21, 2018
 '''
 import pypeliner
 import pypeliner.managed as mgd
+from wgs.config import config
 from wgs.utils import helpers
 
 
@@ -18,6 +19,8 @@ def create_annotation_workflow(
         cosmic,
         mappability,
 ):
+    params = config.default_params('variant_calling')['vcf_annotation']
+
     databases = {
         'snpeff_params': {'snpeff_config': snpeff, },
         'mutation_assessor_params': {'db': mutationassessor},
@@ -43,80 +46,19 @@ def create_annotation_workflow(
     )
 
     workflow.transform(
-        name='run_mutation_assessor',
-        ctx=helpers.get_default_ctx(
-            memory=10,
-            walltime='8:00', ),
-        func='wgs.workflows.vcf_annotation.tasks.run_mutation_assessor',
-        args=(
-            mgd.TempInputFile('annotSnpEff.vcf'),
-            mgd.TempOutputFile('annotMA.vcf'),
-            databases,
-        ),
-    )
-
-    workflow.transform(
-        name='run_DBSNP',
-        ctx=helpers.get_default_ctx(
-            memory=15,
-            walltime='8:00', ),
-        func='wgs.workflows.vcf_annotation.tasks.run_DBSNP',
-        args=(
-            mgd.TempInputFile('annotMA.vcf'),
-            mgd.TempOutputFile('flagDBsnp.vcf'),
-            databases,
-        ),
-    )
-
-    workflow.transform(
-        name='run_1000gen',
+        name='annotate_databases',
         ctx=helpers.get_default_ctx(
             memory=15,
-            walltime='8:00', ),
-        func='wgs.workflows.vcf_annotation.tasks.run_1000gen',
+            walltime='8:00',
+            ncpus=params['ncores'], ),
+        func='wgs.workflows.vcf_annotation.tasks.annotate_databases',
         args=(
-            mgd.TempInputFile('flagDBsnp.vcf'),
-            mgd.TempOutputFile('flag1000gen.vcf'),
-            databases,
-        ),
-    )
-
-    workflow.transform(
-        name='run_cosmic',
-        ctx=helpers.get_default_ctx(
-            memory=15,
-            walltime='8:00', ),
-        func='wgs.workflows.vcf_annotation.tasks.run_cosmic',
-        args=(
-            mgd.TempInputFile('flag1000gen.vcf'),
-            mgd.TempOutputFile('cosmic.vcf'),
-            databases,
-        ),
-    )
-
-    workflow.transform(
-        name='low_mappability_flag',
-        func='wgs.workflows.vcf_annotation.tasks.flag_low_mappability',
-        ctx=helpers.get_default_ctx(
-            memory=15,
-            walltime='8:00', ),
-        args=(
-            mgd.TempInputFile('cosmic.vcf'),
-            mgd.TempOutputFile('low_mapp.vcf'),
-            databases['mappability_ref']
-        ),
-    ),
-
-    workflow.transform(
-        name='finalize',
-        ctx=helpers.get_default_ctx(
-            memory=15,
-            walltime='8:00', ),
-        func='wgs.utils.vcf_tasks.finalise_vcf',
-        args=(
-            mgd.TempInputFile('low_mapp.vcf'),
+            mgd.TempInputFile('annotSnpEff.vcf'),
             mgd.OutputFile(annotated_vcf, extensions=['.csi', '.tbi']),
+            databases,
+            mgd.TempSpace('annotate_databases_temp'),
         ),
+        kwargs={'ncores': params['ncores']}
     )
 
     return workflow
@@ -4,4 +4,5 @@ Created on Jul 24, 2017
 @author: dgrewal
 '''
 from . import add_db_anno
-from . import flag_mappability
\ No newline at end of file
+from . import flag_mappability
+from . import annotate_vcf
@@ -5,11 +5,15 @@ last_updated: 12 Feb 16 by dgrewal
 
 '''
 import argparse
+import itertools
 import os
+import shutil
+import tempfile
 import warnings
-from collections import defaultdict
 
 import pysam
+from wgs.utils import annotationdb
+from wgs.utils import helpers
 
 version = '1.3.1'
 
@@ -25,93 +29,103 @@ def resolve_db_position(input_type, pos):
     return pos
 
 
-def load_chromosome(db, chromosome, input_type, flag_with_id):
-    db_dict = defaultdict(list)
-
-    f = pysam.Tabixfile(db)
-    try:
-        fetchdata = f.fetch(chromosome)
-    except:
-        warnings.warn("warning")
-        return db_dict
-    for line in fetchdata:
-
-        chrom, pos = line.split('\t')[0:2]
-
-        # resolve position when record is a deletion
-        if len(line.split()[3]) > len(line.split()[4]):
-            pos = resolve_db_position(input_type, int(pos))
+class DatabaseCursor(object):
+    '''
+    walks a tabix indexed database vcf alongside a
+    position sorted stream of queries on one chromosome.
+    only the records around the current position are kept
+    in memory. the stream restarts from the index if a
+    query position goes backwards.
+    '''
 
-        chrom.replace('chr', '')
-        key = ','.join([chrom, str(pos)])
+    def __init__(self, database, chromosome, input_type, flag_with_id):
+        self.tabix = pysam.TabixFile(database)
+        self.contig = self.get_contig(chromosome)
+        self.input_type = input_type
+        self.flag_with_id = flag_with_id
 
-        if flag_with_id:
-            value = line.split('\t')[2]
-        else:
-            value = 'T'
+        self.reset(0)
 
-        if value not in db_dict[key]:
-            db_dict[key].append(value)
+    def __enter__(self):
+        return self
 
-    f.close()
-    return db_dict
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
+    def close(self):
+        self.tabix.close()
 
-def load_genome(db):
-    ''' load chromosome '''
+    def get_contig(self, chromosome):
+        '''
+        database contig for the chromosome, with or without chr prefix
+        '''
+        for contig in (chromosome, 'chr' + chromosome):
+            if contig in self.tabix.contigs:
+                return contig
 
-    if db.endswith('.gz') or db.endswith('.gzip'):
-        import gzip
-        f = gzip.open(db, 'rb')
-    else:
-        f = open(db, 'r')
+        warnings.warn("{} not found in database".format(chromosome))
 
-    db_dict = defaultdict(list)
-    is_db_vcf = False
+    def reset(self, start):
+        if self.contig is None:
+            self.records = iter(())
+        else:
+            self.records = self.tabix.fetch(self.contig, start)
 
-    for line in f:
-        if line.startswith('#') or line == '':
-            if 'fileformat=VCF' in line:
-                is_db_vcf = True
-            continue
+        # database position -> ids, for records at or after the last query
+        self.pending = {}
+        self.last_db_pos = -1
+        self.last_query = -1
 
-        assert is_db_vcf == True, 'database must be in vcf format'
+    def parse_record(self, line):
+        line = line.split('\t', 5)
 
-        chrom, pos = line.split('\t')[0:2]
+        pos = int(line[1])
 
         # resolve position when record is a deletion
-        if len(line.split()[3]) > len(line.split()[4]):
-            pos = resolve_db_position(args.input_type, int(pos))
-
-        chrom.replace('chr', '')
-        key = ','.join([chrom, str(pos)])
-
-        if args.flag_with_id:
-            value = line.split('\t')[2]
-        else:
-            value = 'T'
-
-        if value not in db_dict[key]:
-            db_dict[key].append(value)
+        if len(line[3]) > len(line[4]):
+            pos = resolve_db_position(self.input_type, pos)
+
+        value = line[2] if self.flag_with_id else 'T'
+
+        return int(line[1]), pos, value
+
+    def get(self, pos):
+        '''
+        database values at pos
+        :param pos: 1 based position
+        :returns list of ids ('T' if not flagging with ids), or None
+        '''
+        if pos < self.last_query:
+            # resolved positions are at most one past the record position
+            self.reset(max(pos - 2, 0))
+
+        # read until past pos, resolved positions are never
+        # before the record position
+        while self.last_db_pos <= pos:
+            line = next(self.records, None)
+            if line is None:
+                self.last_db_pos = float('inf')
+                break
 
-    f.close()
+            self.last_db_pos, db_pos, value = self.parse_record(line)
 
-    return db_dict
+            if db_pos < pos:
+                continue
 
+            values = self.pending.setdefault(db_pos, [])
+            if value not in values:
+                values.append(value)
 
-def load_db_positions(db_file, chrom):
-    ''' load db positions into a dict '''
+        for db_pos in [v for v in self.pending if v < pos]:
+            del self.pending[db_pos]
 
-    if chrom is None:
-        db_dict = load_genome(db_file)
-    else:
-        db_dict = load_chromosome(db_file, chrom)
+        self.last_query = pos
 
-    return db_dict
+        return self.pending.get(pos)
 
 
-def write_header(infile, label, database, out, flag_with_id):
-    ''' write the header for the output vcf '''
+def get_db_header(label, database, flag_with_id):
+    ''' header lines describing the database annotation '''
 
     db_hdr = '##{}_DB={}\n'.format(label, os.path.abspath(database))
 
@@ -120,6 +134,14 @@ def write_header(infile, label, database, out, flag_with_id):
     else:
         db_hdr += '##INFO=<ID={0},Number=0,Type=Flag,Description="{0} flag">\n'.format(label)
 
+    return db_hdr
+
+
+def get_header(infile, label, database, flag_with_id):
+    ''' header for the output vcf '''
+
+    db_hdr = get_db_header(label, database, flag_with_id)
+
     with open(infile, 'r') as f:
 
         # write the hdr and add new db descriptor
@@ -131,57 +153,152 @@ def write_header(infile, label, database, out, flag_with_id):
 
     if hdr:
         hdr = hdr[:-1] + [db_hdr] + [hdr[-1]]
-    out.write(''.join(hdr))
-
+    return ''.join(hdr)
 
-# changed because "flagpos" seems confusing
-# as some of the annotations are themselves
-# 'flags'
-def add_db_annotation(
-        database, input_vcf, chromosome, output, label, flag_with_id, input_type
-):
-    ''' flag the vcf entries with
-    information from the database annotator '''
-
-    db_dict = None
 
-    with open(output, 'w') as out:
-
-        write_header(input_vcf, label, database, out, flag_with_id)
+def split_by_chromosome(input_vcf, tempdir, chromosome=None):
+    '''
+    splits the records in the input vcf into one
+    file per chromosome.
+    :returns list of (chromosome, filename), in order of first appearance
+    '''
+    outputs = []
+    writers = {}
 
+    try:
         with open(input_vcf, 'r') as f:
             for line in f:
-
                 if line.startswith('#'):
                     continue
 
-                line = line.rstrip().split('\t')
-                chrom, pos = line[0:2]
-                chrom = chrom.replace('chr', '')
+                chrom = line.split('\t', 1)[0].replace('chr', '')
 
                 if chromosome and chrom != chromosome:
                     continue
 
-                if not db_dict or not db_dict[0] == chrom:
-                    db_dict = (chrom, load_chromosome(database, chromosome, input_type, flag_with_id))
+                if chrom not in writers:
+                    filename = os.path.join(tempdir, '{}.vcf'.format(len(outputs)))
+                    writers[chrom] = open(filename, 'w')
+                    outputs.append((chrom, filename))
 
-                info = line[7]
+                writers[chrom].write(line)
+    finally:
+        for writer in writers.values():
+            writer.close()
 
-                key = ','.join([chrom, pos])
-                value = db_dict[1].get(key)
+    return outputs
 
-                if flag_with_id:
-                    flag = ','.join(value) if value else '.'
-                    info = '{};{}={}'.format(info, label, flag)
-                else:
-                    # according to vcf style, don't need anything
-                    # on !value
-                    if value:
-                        info = '{};{}'.format(info, label)
 
-                line[7] = info
-                line = '\t'.join(line) + '\n'
-                out.write(line)
+def get_info(info, value, label, flag_with_id):
+    '''
+    adds the database annotation to the info column
+    '''
+    if flag_with_id:
+        flag = ','.join(value) if value else '.'
+        info = '{};{}={}'.format(info, label, flag)
+    else:
+        # according to vcf style, don't need anything
+        # on !value
+        if value:
+            info = '{};{}'.format(info, label)
+
+    return info
+
+
+def add_info(line, value, label, flag_with_id):
+    '''
+    adds the database annotation to the info column of a split vcf line
+    '''
+    line[7] = get_info(line[7], value, label, flag_with_id)
+    return '\t'.join(line) + '\n'
+
+
+def annotate_chromosome(
+        database, input_vcf, chromosome, output, label, flag_with_id, input_type
+):
+    '''
+    merge join of the records for one chromosome
+    against the database. input is expected to be
+    position sorted, out of order records are still
+    annotated but need a new index lookup.
+    '''
+    with DatabaseCursor(database, chromosome, input_type, flag_with_id) as cursor, \
+            open(input_vcf, 'r') as f, open(output, 'w') as out:
+        for line in f:
+            line = line.rstrip().split('\t')
+
+            value = cursor.get(int(line[1]))
+
+            out.write(add_info(line, value, label, flag_with_id))
+
+
+def annotate_chromosome_from_index(
+        index_path, input_vcf, chromosome, output, label, flag_with_id, input_type,
+        chunksize=100000
+):
+    '''
+    annotates the records for one chromosome with
+    vectorized lookups against a prebuilt database index
+    '''
+    index = annotationdb.AnnotationIndex(index_path)
+
+    with open(input_vcf, 'r') as f, open(output, 'w') as out:
+        while True:
+            lines = [line.rstrip().split('\t') for line in itertools.islice(f, chunksize)]
+            if not lines:
+                break
+
+            positions = [int(line[1]) for line in lines]
+            values = index.query_ids(chromosome, positions, input_type)
+
+            if not flag_with_id:
+                values = [['T'] if value else [] for value in values]
+
+            out.write(''.join(
+                add_info(line, value, label, flag_with_id)
+                for line, value in zip(lines, values)
+            ))
+
+
+# changed because "flagpos" seems confusing
+# as some of the annotations are themselves
+# 'flags'
+def add_db_annotation(
+        database, input_vcf, chromosome, output, label, flag_with_id, input_type,
+        tempdir=None, ncores=1
+):
+    ''' flag the vcf entries with
+    information from the database annotator '''
+
+    cleanup = tempdir is None
+    if cleanup:
+        tempdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    helpers.makedirs(tempdir)
+
+    try:
+        chrom_inputs = split_by_chromosome(input_vcf, tempdir, chromosome)
+
+        index = annotationdb.load_index(database, 'vcf')
+
+        args = []
+        outputs = []
+        for chrom, chrom_input in chrom_inputs:
+            chrom_output = chrom_input + '.annotated'
+            args.append(
+                (index.path if index else database, chrom_input, chrom, chrom_output,
+                 label, flag_with_id, input_type)
+            )
+            outputs.append(chrom_output)
+
+        worker = annotate_chromosome_from_index if index else annotate_chromosome
+
+        helpers.run_in_process_pool(worker, args, ncores)
+
+        header = get_header(input_vcf, label, database, flag_with_id)
+        helpers.concatenate_files(outputs, output, header=header, ncores=ncores)
+    finally:
+        if cleanup:
+            shutil.rmtree(tempdir)
 
 
 def parse_args():
@@ -227,6 +344,15 @@ def parse_args():
                         default=None,
                         help='''chromosome''')
 
+    parser.add_argument("--tempdir",
+                        default=None,
+                        help='''directory for the per chromosome files''')
+
+    parser.add_argument("--ncores",
+                        type=int,
+                        default=1,
+                        help='''number of chromosomes to annotate in parallel''')
+
     args = parser.parse_args()
 
     args = vars(args)
@@ -238,5 +364,6 @@ if __name__ == '__main__':
     args = parse_args()
     add_db_annotation(
         args['db'], args['infile'], args['chrom'], args['out'],
-        args['label'], args['flag_with_id'], args['input_type']
+        args['label'], args['flag_with_id'], args['input_type'],
+        tempdir=args['tempdir'], ncores=args['ncores']
     )
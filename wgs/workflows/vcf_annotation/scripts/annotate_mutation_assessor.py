@@ -5,20 +5,23 @@ Created on 30 Apr 2015
 @last_update: 30 Apr 2015
 '''
 
+import itertools
 import os
 import warnings
 import glob
 
+from wgs.utils import annotationdb
+
 version = '1.0.1'
 
 
-def get_table_hdr():
+def get_table_hdr(db):
     '''
     return the header from a
     mutation assessor file as a list
     '''
 
-    ma_file = glob.glob(os.path.join(args.db, 'MA.chr*.txt'))[0]
+    ma_file = glob.glob(os.path.join(db, 'MA.chr*.txt'))[0]
     with open(ma_file) as f:
         line = f.readline()
 
@@ -26,7 +29,7 @@ def get_table_hdr():
     #taking out first
     return colnames[1:]
 
-def load_table(chrom):
+def load_table(chrom, db):
     ''' load mutationassessor data for chromosome chrom '''
 
     print('loading table for chromosome {}'.format(chrom))
@@ -36,7 +39,7 @@ def load_table(chrom):
     if chrom != 'X' and chrom != 'Y':
         chrom = chrom.zfill(2)
 
-    ma_file = os.path.join(args.db, 'MA.chr{}.txt'.format(chrom))
+    ma_file = os.path.join(db, 'MA.chr{}.txt'.format(chrom))
     with open(ma_file) as f:
         for line in f:
             if line.startswith('#'):
@@ -49,19 +52,19 @@ def load_table(chrom):
     return ma_table
 
 
-def get_ma_description():
+def get_ma_description(columns):
     ''' add new mutation assessor header line '''
 
     ma_vcf_hdr = ('##INFO=<ID=MA,Number=1,Type=String,Description='
                   '\"Predicted functional impact of amino-acid substitutions'
-                  'in proteins. Format: \'{}\' \">\n'.format('|'.join(get_table_hdr() ) ) ) 
+                  'in proteins. Format: \'{}\' \">\n'.format('|'.join(columns)))
     return ma_vcf_hdr
 
 
-def write_hdr(infile, o):
+def write_hdr(infile, o, columns):
     ''' write the header to the output file '''
 
-    ma_line = get_ma_description()
+    ma_line = get_ma_description(columns)
     hdr = []
     with open(infile, 'r') as i:
         for line in i:
@@ -98,7 +101,7 @@ def annot_insert(l, a):
     return '\t'.join(l)
 
 
-def write_annot_data(infile, out):
+def write_annot_data(infile, out, db):
     ''' write the annotated data to out '''
 
     ma_table = None
@@ -125,7 +128,7 @@ def write_annot_data(infile, out):
                     print(chr_seen)
 
                 try:
-                    ma_table = load_table(chr_current)
+                    ma_table = load_table(chr_current, db)
                 except IOError:
                     print ('no matching table found for {}'.format(chr_current))
                     chr_no_table.append(chr_current)
@@ -145,12 +148,60 @@ def write_annot_data(infile, out):
             out.write(line)
 
 
-def _main():
+def write_annot_data_from_index(infile, out, index, chunksize=100000):
+    '''
+    write the annotated data to out, using vectorized
+    lookups against a prebuilt mutation assessor index
+    '''
+
+    with open(infile, 'r') as vcf:
+        lines = (line.rstrip().split('\t') for line in vcf if not line.startswith('#'))
+
+        while True:
+            chunk = list(itertools.islice(lines, chunksize))
+            if not chunk:
+                break
+
+            annotated = [None] * len(chunk)
+
+            for chrom, chrom_lines in itertools.groupby(
+                    enumerate(chunk), key=lambda val: val[1][0]):
+                chrom_lines = list(chrom_lines)
+
+                if index.get_chromosome(chrom) is None:
+                    for i, line in chrom_lines:
+                        annotated[i] = '\t'.join(line) + '\n'
+                    continue
+
+                rows = index.query_alleles(
+                    chrom,
+                    [int(line[1]) for _, line in chrom_lines],
+                    [line[3] for _, line in chrom_lines],
+                    [line[4] for _, line in chrom_lines],
+                )
+
+                for (i, line), row in zip(chrom_lines, rows.tolist()):
+                    if row < 0:
+                        annot = ';MA=.'
+                    else:
+                        annot = ';MA={}'.format(index.get_payload(row))
+                    annotated[i] = annot_insert(line, annot) + '\n'
+
+            out.write(''.join(annotated))
+
+
+def main(vcf, output, db):
     ''' main function '''
 
-    with open(args.output, 'w') as out:
-        write_hdr(args.vcf, out)
-        write_annot_data(args.vcf, out)
+    index = annotationdb.load_index(db, 'mutation_assessor')
+
+    with open(output, 'w') as out:
+        if index:
+            write_hdr(vcf, out, index.columns)
+            write_annot_data_from_index(vcf, out, index)
+        else:
+            write_hdr(vcf, out, get_table_hdr(db))
+            write_annot_data(vcf, out, db)
 
 
 if __name__ == '__main__':
@@ -170,4 +221,4 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    _main()
+    main(args.vcf, args.output, args.db)
@@ -0,0 +1,295 @@
+'''
+single pass annotation of a snpeff annotated vcf with mutation assessor,
+dbsnp, 1000 genomes, cosmic and low mappability regions.
+records are split by chromosome, each chromosome is annotated by all
+databases in one pass and the results are written as an indexed bgzf vcf.
+annotators load their databases in load(), so headers can be built
+without reading any data.
+'''
+import itertools
+import os
+import shutil
+
+import numpy as np
+from wgs.utils import annotationdb
+from wgs.utils import helpers
+from wgs.utils import vcfutils
+from wgs.workflows.vcf_annotation.scripts import add_db_anno
+from wgs.workflows.vcf_annotation.scripts import annotate_mutation_assessor
+from wgs.workflows.vcf_annotation.scripts import flag_mappability
+
+
+class MutationAssessorAnnotator(object):
+    def __init__(self, db):
+        self.db = db
+        self.index = None
+
+        self.table = None
+        self.table_chrom = None
+
+    def load(self):
+        self.index = annotationdb.load_index(self.db, 'mutation_assessor')
+
+    def get_header(self):
+        # the index keeps the columns of the tables it was built from
+        columns = annotate_mutation_assessor.get_table_hdr(self.db)
+        return [annotate_mutation_assessor.get_ma_description(columns)]
+
+    def load_table(self, chrom):
+        if self.table_chrom == chrom:
+            return self.table
+
+        try:
+            self.table = annotate_mutation_assessor.load_table(chrom, self.db)
+        except IOError:
+            print('no matching table found for {}'.format(chrom))
+            self.table = None
+
+        self.table_chrom = chrom
+        return self.table
+
+    def annotate(self, chrom, lines):
+        if self.index:
+            if self.index.get_chromosome(chrom) is None:
+                return
+
+            rows = self.index.query_alleles(
+                chrom,
+                [int(line[1]) for line in lines],
+                [line[3] for line in lines],
+                [line[4] for line in lines],
+            )
+            annotations = [
+                self.index.get_payload(row) if row >= 0 else None for row in rows.tolist()
+            ]
+        else:
+            table = self.load_table(chrom)
+            if table is None:
+                return
+
+            annotations = []
+            for line in lines:
+                annot = table.get('_'.join([line[0], line[1], line[3], line[4]]))
+                annotations.append('|'.join(annot[1:]) if annot else None)
+
+        for line, annot in zip(lines, annotations):
+            line[7] += ';MA={}'.format(annot if annot else '.')
+
+    def close(self):
+        pass
+
+
+class DatabaseAnnotator(object):
+    def __init__(self, db, label, flag_with_id, input_type='snv'):
+        self.db = db
+        self.label = label
+        self.flag_with_id = flag_with_id
+        self.input_type = input_type
+
+        self.index = None
+        self.cursor = None
+        self.cursor_chrom = None
+
+    def load(self):
+        self.index = annotationdb.load_index(self.db, 'vcf')
+
+    def get_header(self):
+        return [add_db_anno.get_db_header(self.label, self.db, self.flag_with_id)]
+
+    def get_cursor(self, chrom):
+        if self.cursor is None or self.cursor_chrom != chrom:
+            self.close()
+            self.cursor = add_db_anno.DatabaseCursor(
+                self.db, chrom, self.input_type, self.flag_with_id
+            )
+            self.cursor_chrom = chrom
+
+        return self.cursor
+
+    def annotate(self, chrom, lines):
+        chrom = chrom.replace('chr', '')
+
+        if self.index:
+            values = self.index.query_ids(
+                chrom, [int(line[1]) for line in lines], self.input_type
+            )
+        else:
+            cursor = self.get_cursor(chrom)
+            values = [cursor.get(int(line[1])) for line in lines]
+
+        for line, value in zip(lines, values):
+            line[7] = add_db_anno.get_info(line[7], value, self.label, self.flag_with_id)
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+
+class MappabilityAnnotator(object):
+    def __init__(self, blacklist):
+        self.blacklist_file = blacklist
+        self.blacklist = None
+
+    def load(self):
+        self.blacklist = flag_mappability.load_blacklist(self.blacklist_file)
+
+    def get_header(self):
+        return [
+            '##LOW_MAPPABILITY_DB={}\n'.format(self.blacklist_file),
+            '##INFO=<ID=LOW_MAPPABILITY,Number=0,Type=Flag,Description="low mappability position">\n'
+        ]
+
+    def annotate(self, chrom, lines):
+        low_mapp = self.blacklist.mask(
+            np.array([line[0] for line in lines], dtype=str),
+            np.array([int(line[1]) for line in lines], dtype=np.int64)
+        )
+
+        for line, annotation in zip(lines, low_mapp.tolist()):
+            if annotation:
+                line[7] += ';LOW_MAPPABILITY'
+
+    def close(self):
+        pass
+
+
+def get_annotators(databases):
+    '''
+    annotators for the configured databases, in the order they are
+    applied. databases are not loaded until load() is called
+    :param databases: dict with the same layout as the annotation workflow config
+    '''
+    annotators = []
+
+    def get_db(key):
+        return (databases.get(key) or {}).get('db')
+
+    if get_db('mutation_assessor_params'):
+        annotators.append(MutationAssessorAnnotator(get_db('mutation_assessor_params')))
+
+    for key, label, flag_with_id in [
+        ('dbsnp_params', 'DBSNP', True),
+        ('thousandgen_params', '1000Gen', False),
+        ('cosmic_params', 'Cosmic', True),
+    ]:
+        if get_db(key):
+            annotators.append(DatabaseAnnotator(get_db(key), label, flag_with_id))
+
+    if databases.get('mappability_ref'):
+        annotators.append(MappabilityAnnotator(databases['mappability_ref']))
+
+    return annotators
+
+
+def get_header(infile, annotators):
+    '''
+    input header with the annotator descriptions
+    added before the #CHROM line
+    '''
+    with helpers.GetFileHandle(infile) as reader:
+        header = []
+        for line in reader:
+            if not line.startswith('#'):
+                break
+            header.append(line)
+
+    if not header:
+        return header
+
+    annotation_header = []
+    for annotator in annotators:
+        annotation_header.extend(annotator.get_header())
+
+    return header[:-1] + annotation_header + [header[-1]]
+
+
+def annotate_chromosome(input_vcf, chromosome, output, databases, chunksize=100000):
+    '''
+    applies all annotations to the records of one chromosome
+    :returns tuple with the chromosome of the first record and
+    whether the records are sorted by position
+    '''
+    annotators = get_annotators(databases)
+    for annotator in annotators:
+        annotator.load()
+
+    first_chrom = None
+    is_sorted = True
+    last_pos = -1
+
+    try:
+        with open(input_vcf, 'r') as reader, open(output, 'w') as writer:
+            while True:
+                lines = [line.rstrip().split('\t') for line in itertools.islice(reader, chunksize)]
+                if not lines:
+                    break
+
+                if first_chrom is None:
+                    first_chrom = lines[0][0]
+
+                positions = np.array([int(line[1]) for line in lines], dtype=np.int64)
+                if positions[0] < last_pos or np.any(positions[1:] < positions[:-1]):
+                    is_sorted = False
+                last_pos = positions[-1]
+
+                for annotator in annotators:
+                    annotator.annotate(chromosome, lines)
+
+                writer.write(''.join('\t'.join(line) + '\n' for line in lines))
+    finally:
+        for annotator in annotators:
+            annotator.close()
+
+    return first_chrom, is_sorted
+
+
+def main(infile, output, databases, tempdir, ncores=1):
+    '''
+    annotates infile with all configured databases in one
+    pass and writes a bgzf vcf with tbi and csi indexes
+    :param infile: snpeff annotated vcf
+    :param output: output vcf.gz
+    :param databases: dict with the same layout as the annotation workflow config
+    :param tempdir: temporary directory
+    :param ncores: number of chromosomes to annotate in parallel,
+    also used for bgzf compression
+    '''
+    helpers.makedirs(tempdir)
+
+    header = get_header(infile, get_annotators(databases))
+
+    split_dir = os.path.join(tempdir, 'split')
+    helpers.makedirs(split_dir)
+    chrom_inputs = add_db_anno.split_by_chromosome(infile, split_dir)
+
+    args = []
+    for chrom, chrom_input in chrom_inputs:
+        args.append((chrom_input, chrom, chrom_input + '.annotated', databases))
+
+    results = helpers.run_in_process_pool(annotate_chromosome, args, ncores)
+
+    key = vcfutils.get_sort_key(vcfutils.get_contig_order(header=header))
+
+    # order chromosomes the same way finalise_vcf would
+    outputs = sorted(
+        [(chrom, is_sorted, arg[2]) for arg, (chrom, is_sorted) in zip(args, results)],
+        key=lambda val: key('{}\t0'.format(val[0]))[:2]
+    )
+
+    with vcfutils.IndexedVcfWriter(output, ncores=ncores) as writer:
+        writer.write_header(header)
+
+        for _, is_sorted, chrom_output in outputs:
+            with open(chrom_output) as reader:
+                if is_sorted:
+                    records = reader
+                else:
+                    records = vcfutils.external_sort(
+                        reader, key, tempdir=os.path.join(tempdir, 'sort')
+                    )
+
+                for record in records:
+                    writer.write_record(record)
+
+    shutil.rmtree(split_dir)
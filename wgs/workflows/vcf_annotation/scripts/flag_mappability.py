@@ -1,58 +1,10 @@
 import numpy as np
-import pandas as pd
+from wgs.utils import blacklistutils
 from wgs.utils import helpers
 
 
 def load_blacklist(blacklist):
-    blacklist = pd.read_csv(blacklist, sep='\t', dtype={'chromosome': str})
-    return blacklist
-
-
-def in_any_region(pos, blacklist):
-    '''
-    checks if pos are in any of the regions
-    covered by blacklist. Expects that all positions
-    in both fall on same chromosome.
-    :param pos: pandas dataframe of blacklisted regions
-    :param pos: integer of pos to be searched in blacklist
-    '''
-    if not len(blacklist):
-        return []
-
-    idx = np.searchsorted(blacklist['start'], pos, side='right') - 1
-    return pos <= blacklist.loc[blacklist.index[idx], 'end'].values
-
-
-def is_low_mappability(muts, blacklist, chromname, posname):
-    '''
-    gets entries in muts that fall within low mappability regions
-    of blacklist.
-
-    :param muts: csv with variant calls
-    :param blacklist: csv of blacklist locations
-    :param chromname: column name for chromosomes in muts
-    :param posname: column name for positions in muts
-    '''
-    low_mappability_calls = []
-    for chrom in muts[chromname].unique():
-        chrom_muts = muts[muts[chromname] == chrom]
-        chrom_blacklist = blacklist[blacklist['chromosome'] == str(chrom)]
-        is_low_mapp = in_any_region(chrom_muts[posname], chrom_blacklist)
-        low_mappability_calls.extend(chrom_muts.index[is_low_mapp])
-    return low_mappability_calls
-
-
-def generate_low_mappability_annotation(low_mappability_indexes, size):
-    '''
-    generates a list of booleans
-    where the entries at low_mappability_indexes
-    are True
-
-    :param low_mappability_indexes: indexes to make True, in low mappability
-    regions
-    :param size: size of list
-    '''
-    return [True if i in low_mappability_indexes else False for i in range(size)]
+    return blacklistutils.load_index(blacklist)
 
 
 def load_vcf_file(vcf_file):
@@ -104,20 +56,13 @@ def write_to_file(output, lines):
 
 
 def annotate_vcf_data(vcf_data, blacklist):
-    chroms = []
-    positions = []
-    for line in vcf_data:
-        chroms.append(line[0])
-        positions.append(int(line[1]))
+    chroms = np.array([line[0] for line in vcf_data], dtype=str)
+    positions = np.array([int(line[1]) for line in vcf_data], dtype=np.int64)
 
-    call_locations = pd.DataFrame({"chromosome": chroms, "positions": positions})
-
-    low_mapp_indexes = is_low_mappability(call_locations, blacklist, "chromosome", "positions")
+    low_mapp = blacklist.mask(chroms, positions)
 
     annotated_data = []
-    for i, line in enumerate(vcf_data):
-
-        annotation = True if i in low_mapp_indexes else False
+    for line, annotation in zip(vcf_data, low_mapp.tolist()):
         if annotation:
             line[7] += ';LOW_MAPPABILITY'
 